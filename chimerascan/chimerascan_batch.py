@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Runs chimerascan on many samples that share the same index
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import sys
+import logging
+
+# check for python version 2.7.0 or greater
+if sys.version_info < (2,7,1):
+    sys.stderr.write("You need python 2.7.1 or later to run chimerascan\n")
+    sys.exit(1)
+
+import os
+import argparse
+import multiprocessing
+
+from chimerascan import __version__
+import chimerascan.lib.config as config
+from chimerascan.lib.base import parse_memory_size
+from chimerascan.lib.scheduler import Stage, StageScheduler
+from chimerascan.chimerascan_run import RunConfig, IndexData, run_chimerascan
+
+def parse_sample_sheet(line_iter):
+    """
+    parses a tab-delimited sample sheet with the columns sample name,
+    read1 FASTQ file, and read2 FASTQ file.  blank lines and lines
+    starting with '#' are ignored
+    """
+    for line in line_iter:
+        line = line.strip()
+        if (not line) or line.startswith("#"):
+            continue
+        fields = line.split('\t')
+        if len(fields) < 3:
+            raise ValueError("Sample sheet line '%s' has fewer than 3 "
+                             "tab-delimited fields" % (line))
+        yield fields[0], fields[1], fields[2]
+
+def _sample_stage(sample, runconfig, index_data):
+    def func(num_processors):
+        # tag log messages from this sample
+        formatter = logging.Formatter("%(asctime)s - " + sample +
+                                      " - %(levelname)s - %(message)s")
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(formatter)
+        runconfig.num_processors = num_processors
+        return run_chimerascan(runconfig, index_data)
+    return func
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(usage="%(prog)s [options] <index> "
+                                     "<sample_sheet> <output_dir> "
+                                     "[chimerascan_run.py options]",
+                                     description="Run chimerascan on each "
+                                     "sample in a tab-delimited sample sheet "
+                                     "(sample name, read1 FASTQ, read2 FASTQ). "
+                                     "Options not listed here are passed to "
+                                     "every sample run")
+    parser.add_argument("index_dir",
+                        help="Location of chimerascan index directory")
+    parser.add_argument("sample_sheet",
+                        help="Tab-delimited file of samples")
+    parser.add_argument("output_dir",
+                        help="Directory where a subdirectory is created "
+                        "for each sample")
+    parser.add_argument('--version', action='version',
+                        version='%s' % __version__)
+    parser.add_argument("--total-processors", dest="total_processors",
+                        type=int, default=multiprocessing.cpu_count(),
+                        metavar="N",
+                        help="Number of processor cores shared by all "
+                        "samples [default=%(default)s]")
+    parser.add_argument("--total-memory", dest="total_memory",
+                        default=None, metavar="SIZE",
+                        help="Memory shared by all samples (ex. 64G). "
+                        "Samples run without '--memory' get a share "
+                        "proportional to their processors "
+                        "[default=no limit]")
+    args, run_args = parser.parse_known_args()
+    total_memory = None
+    if args.total_memory is not None:
+        total_memory = parse_memory_size(args.total_memory)
+    index_dir = os.path.abspath(args.index_dir)
+    output_dir = os.path.abspath(args.output_dir)
+    # parse sample sheet and setup run configuration of each sample
+    runconfigs = []
+    for sample, read1, read2 in parse_sample_sheet(open(args.sample_sheet)):
+        runconfig = RunConfig()
+        runconfig.from_args([index_dir, os.path.abspath(read1),
+                             os.path.abspath(read2), 
+                             os.path.join(output_dir, sample)] + run_args)
+        runconfigs.append((sample, runconfig))
+    if len(runconfigs) == 0:
+        parser.error("no samples found in sample sheet")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # load index once and share it with every sample
+    index_data = IndexData(index_dir).load()
+    stages = []
+    for sample, runconfig in runconfigs:
+        if (runconfig.memory is None) and (total_memory is not None):
+            share = min(runconfig.num_processors, args.total_processors)
+            runconfig.memory = str(total_memory * share // args.total_processors)
+        sample_memory = 0
+        if runconfig.memory is not None:
+            sample_memory = parse_memory_size(runconfig.memory)
+        stages.append(Stage(sample, "Running sample %s" % (sample),
+                            _sample_stage(sample, runconfig, index_data),
+                            num_processors=runconfig.num_processors,
+                            memory=sample_memory))
+    scheduler = StageScheduler(stages, args.total_processors,
+                               max_memory=total_memory, keep_going=True)
+    retcode = scheduler.run()
+    profile_file = os.path.join(output_dir, config.STAGE_PROFILE_FILE)
+    scheduler.write_profile(profile_file)
+    if retcode != config.JOB_SUCCESS:
+        logging.error("One or more samples failed")
+    return retcode
+
+if __name__ == '__main__':
+    sys.exit(main())
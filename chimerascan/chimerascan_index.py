@@ -37,6 +37,8 @@ from chimerascan.lib.feature import TranscriptFeature
 from chimerascan.lib.seq import DNA_reverse_complement
 from chimerascan.lib.base import up_to_date, check_executable
 from chimerascan.lib import config
+from chimerascan.pipeline.transcriptome_to_genome import \
+    get_references_from_bowtie2_index, write_genome_refs
 
 BASES_PER_LINE = 50
 
@@ -204,6 +206,28 @@ def create_chimerascan_index(output_dir,
                 if os.path.exists(f):
                     os.remove(f)
             return config.JOB_ERROR
+    #
+    # Write genome reference names and lengths used for SAM headers
+    #
+    genome_refs_file = os.path.join(output_dir, config.GENOME_REFS_FILE)
+    genome_index_file = os.path.join(output_dir, config.GENOME_INDEX + 
+                                     config.BOWTIE2_INDEX_FILE_EXTS[0])
+    msg = "Writing genome references"
+    if up_to_date(genome_refs_file, genome_index_file):
+        logging.info("[SKIPPED] %s" % (msg))
+    else:
+        logging.info(msg)
+        if not check_executable(config.BOWTIE2_INSPECT_BIN):
+            logging.error("%s binary not found or not executable" % 
+                          (config.BOWTIE2_INSPECT_BIN))
+            return config.JOB_ERROR
+        refs = get_references_from_bowtie2_index(os.path.join(output_dir, 
+                                                              config.GENOME_INDEX))
+        # a tuple is returned when bowtie2-inspect fails
+        if not isinstance(refs, list):
+            logging.error("Failed to read references from genome index")
+            return config.JOB_ERROR
+        write_genome_refs(refs, genome_refs_file)
     logging.info("Chimerascan index created successfully")
     return config.JOB_SUCCESS
 
@@ -43,6 +43,7 @@ if sys.version_info < (2,7,1):
 import os
 import subprocess
 import shutil
+import hashlib
 import argparse
 import xml.etree.ElementTree as etree
 
@@ -52,25 +53,41 @@ import pysam
 # local imports
 import chimerascan.lib.config as config
 from chimerascan.lib.base import LibraryTypes, check_executable, \
-    parse_bool, indent_xml, up_to_date
-from chimerascan.lib.seq import FASTQ_QUAL_FORMATS, SANGER_FORMAT, detect_read_length
+    parse_bool, parse_string_none, parse_memory_size, indent_xml
+from chimerascan.lib.seq import FASTQ_QUAL_FORMATS, SANGER_FORMAT
 from chimerascan.lib.fragment_size_distribution import InsertSizeDistribution
 from chimerascan.lib.feature import TranscriptFeature
+from chimerascan.lib.scheduler import Stage, StageScheduler
+from chimerascan.lib.stage_cache import StageCache
+from chimerascan.lib.resource_planner import ResourcePlanner, format_memory_size
 
+from chimerascan.lib.fastq import parse_subsample
+from chimerascan.lib.input_stats import InputStats
 from chimerascan.pipeline.process_input_reads import process_input_reads
+from chimerascan.pipeline.stream_reads import stream_and_align_reads
 from chimerascan.pipeline.align_bowtie2 import bowtie2_align_transcriptome_pe, bowtie2_align_pe, bowtie2_align_pe_sr
 from chimerascan.pipeline.find_discordant_reads import find_discordant_fragments
-from chimerascan.pipeline.transcriptome_to_genome import transcriptome_to_genome
+from chimerascan.pipeline.transcriptome_to_genome import transcriptome_to_genome, \
+    get_genome_refs
 from chimerascan.pipeline.sam_to_bam import sam_to_bam
 from chimerascan.pipeline.cluster_discordant_reads import cluster_discordant_reads
 from chimerascan.pipeline.pair_clusters import pair_discordant_clusters
 from chimerascan.pipeline.breakpoint_realignment import realign_across_breakpoints
 from chimerascan.pipeline.process_spanning_alignments import process_spanning_alignments
 from chimerascan.pipeline.filter_chimeras import filter_chimeras
-from chimerascan.pipeline.write_output import write_output
+from chimerascan.pipeline.write_output import write_output, \
+    build_genome_transcript_trees
 
 # global default parameters
 DEFAULT_NUM_PROCESSORS = config.BASE_PROCESSORS
+DEFAULT_NUM_SHARDS = 1
+DEFAULT_MEMORY = None
+DEFAULT_STREAM_READS = False
+DEFAULT_SCRATCH_DIR = None
+DEFAULT_COMPRESS_READ_NAMES = False
+DEFAULT_COLLAPSE_DUPLICATES = False
+DEFAULT_SUBSAMPLE = None
+DEFAULT_SUBSAMPLE_SEED = 0
 DEFAULT_KEEP_TMP = True
 
 # default sequencing data parameters
@@ -87,7 +104,15 @@ DEFAULT_SEGMENT_LENGTH = None
 class RunConfig(object):
     
     attrs = (("num_processors", int, DEFAULT_NUM_PROCESSORS),
+             ("num_shards", int, DEFAULT_NUM_SHARDS),
+             ("memory", parse_string_none, DEFAULT_MEMORY),
+             ("stream_reads", parse_bool, DEFAULT_STREAM_READS),
              ("keep_tmp", parse_bool, DEFAULT_KEEP_TMP),
+             ("scratch_dir", parse_string_none, DEFAULT_SCRATCH_DIR),
+             ("compress_read_names", parse_bool, DEFAULT_COMPRESS_READ_NAMES),
+             ("collapse_duplicates", parse_bool, DEFAULT_COLLAPSE_DUPLICATES),
+             ("subsample", parse_string_none, DEFAULT_SUBSAMPLE),
+             ("subsample_seed", int, DEFAULT_SUBSAMPLE_SEED),
              ("quals", str, DEFAULT_FASTQ_QUAL_FORMAT),
              ("library_type", str, DEFAULT_LIBRARY_TYPE),
              ("isize_mean", int, DEFAULT_ISIZE_MEAN),
@@ -178,6 +203,24 @@ class RunConfig(object):
                             type=int, default=DEFAULT_NUM_PROCESSORS,
                             help="Number of processor cores to allocate to "
                             "chimerascan [default=%(default)s]")
+        parser.add_argument("--memory", dest="memory",
+                            default=DEFAULT_MEMORY, metavar="SIZE",
+                            help="Memory available to chimerascan (ex. "
+                            "16G), divided among sorts, alignments and "
+                            "other stages [default=75%% of physical "
+                            "memory]")
+        parser.add_argument("--shards", dest="num_shards", type=int,
+                            default=DEFAULT_NUM_SHARDS, metavar="N",
+                            help="Split reads into N shards that are "
+                            "aligned and classified in parallel before "
+                            "being merged [default=%(default)s]")
+        parser.add_argument("--stream-reads", dest="stream_reads",
+                            action="store_true",
+                            default=DEFAULT_STREAM_READS,
+                            help="Stream processed reads to the "
+                            "transcriptome aligner through named pipes "
+                            "and keep only a compressed copy of them "
+                            "[default=%(default)s]")
         parser.add_argument("--keep-tmp", dest="keep_tmp", 
                             action="store_true",
                             default=DEFAULT_KEEP_TMP,
@@ -187,6 +230,38 @@ class RunConfig(object):
                             action="store_false", 
                             help="Delete intermediate files after run "
                             "[default=%s]" % str(not DEFAULT_KEEP_TMP))
+        parser.add_argument("--scratch-dir", dest="scratch_dir",
+                            type=os.path.abspath,
+                            default=DEFAULT_SCRATCH_DIR, metavar="DIR",
+                            help="Write intermediate files to a run "
+                            "directory below DIR (ex. local disk) and "
+                            "move final outputs to the output directory "
+                            "as each stage finishes [default=output "
+                            "directory]")
+        parser.add_argument("--compress-read-names", dest="compress_read_names",
+                            action="store_true",
+                            default=DEFAULT_COMPRESS_READ_NAMES,
+                            help="Store the original read names in "
+                            "compressed blocks to save space "
+                            "[default=%(default)s]")
+        parser.add_argument("--collapse-duplicates", dest="collapse_duplicates",
+                            action="store_true",
+                            default=DEFAULT_COLLAPSE_DUPLICATES,
+                            help="Align only one copy of fragments with "
+                            "identical mate sequences and weight it by "
+                            "its number of copies when counting "
+                            "fragments [default=%(default)s]")
+        parser.add_argument("--subsample", dest="subsample",
+                            default=DEFAULT_SUBSAMPLE, metavar="N|FRAC",
+                            help="Run on a reproducible random sample of "
+                            "N fragments, or of a fraction (ex. 0.05) of "
+                            "the fragments, for a quick preview "
+                            "[default=all fragments]")
+        parser.add_argument("--subsample-seed", dest="subsample_seed",
+                            type=int, default=DEFAULT_SUBSAMPLE_SEED,
+                            metavar="N",
+                            help="Random seed used by --subsample "
+                            "[default=%(default)s]")
         parser.add_argument("--quals", dest="quals",
                             choices=FASTQ_QUAL_FORMATS, 
                             default=DEFAULT_FASTQ_QUAL_FORMAT, metavar="FMT",
@@ -315,29 +390,8 @@ class RunConfig(object):
                 logging.error("mate '%d' fastq file '%s' is not valid" % 
                               (mate, fastq_file))
                 config_passed = False
-        # check read lengths with trimming applied
-        logging.debug("Checking read lengths")
-        read_lengths = [detect_read_length(fq) for fq in self.fastq_files]
-        total_trimming = self.trim5 + self.trim3
-        for i,rlen in enumerate(read_lengths):
-            trimmed_rlen = rlen - total_trimming
-            logging.debug("File %s read length: %d after trimming: %d" % 
-                          (self.fastq_files[i], rlen, trimmed_rlen))
-            if trimmed_rlen < config.MIN_SEGMENT_LENGTH:
-                logging.error("Trimmed read length is less than the minimum length of %d" % 
-                              (trimmed_rlen, config.MIN_SEGMENT_LENGTH))
-                config_passed = False
-        # check that mate read lengths are equal
-        if len(set(read_lengths)) > 1:
-            logging.error("Unequal read lengths mate1=%d and mate2=%d" % 
-                          (read_lengths[0], read_lengths[1]))
-            config_passed = False
-        # check that seed length < read length
-        if self.segment_length is not None:
-            if any((self.segment_length > rlen) for rlen in read_lengths):
-                logging.error("seed length %d cannot be longer than read length" % 
-                              (self.segment_length))
-                config_passed = False
+        # read lengths are checked against the trimming and segment 
+        # length once the reads are processed (see InputStats)
         # ensure local anchor length is larger than minimum
         if self.local_anchor_length < config.LOCAL_ANCHOR_LENGTH_MIN:
             logging.error("Local anchor length of %d < %d" % 
@@ -379,14 +433,134 @@ class RunConfig(object):
             logging.error("chimerascan alignment index directory '%s' not valid" % 
                           (self.index_dir))
             config_passed = False
+        # check memory size
+        if self.memory is not None:
+            try:
+                parse_memory_size(self.memory)
+            except ValueError:
+                logging.error("Invalid memory size '%s'" % (self.memory))
+                config_passed = False
+        # check that scratch dir is not a regular file
+        if ((self.scratch_dir is not None) and os.path.exists(self.scratch_dir) and
+            (not os.path.isdir(self.scratch_dir))):
+            logging.error("Scratch directory name '%s' exists and is not a valid directory" % 
+                          (self.scratch_dir))
+            config_passed = False
+        # check subsampling
+        if self.subsample is not None:
+            try:
+                parse_subsample(self.subsample)
+            except ValueError:
+                logging.error("Invalid subsample '%s', must be a number of "
+                              "fragments or a fraction between 0 and 1" % 
+                              (self.subsample))
+                config_passed = False
+        # check number of shards
+        if self.num_shards < 1:
+            logging.error("Number of shards must be >= 1")
+            config_passed = False
         # check for sufficient processors
         if self.num_processors < config.BASE_PROCESSORS:
             logging.warning("Please specify >=2 processes using '-p' to allow program to run efficiently")
         return config_passed
 
-def run_chimerascan(runconfig):
+class IndexData(object):
+    """
+    structures derived from a chimerascan index directory.  these are 
+    loaded once per run, or once for many samples by the batch runner, 
+    and shared with the forked pipeline stages
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.transcript_file = os.path.join(index_dir, config.TRANSCRIPT_FEATURE_FILE)
+        self.genome_index = os.path.join(index_dir, config.GENOME_INDEX)
+        self.transcriptome_index = os.path.join(index_dir, config.TRANSCRIPTOME_INDEX)
+        self.transcripts = None
+        self.genome_transcript_trees = None
+        self.genome_refs = None
+        self.max_transcriptome_hits = None
+
+    def load(self):
+        logging.info("Reading transcript features")
+        self.transcripts = list(TranscriptFeature.parse(open(self.transcript_file)))
+        logging.info("\tread %d transcripts" % (len(self.transcripts)))
+        logging.debug("Creating mapping between genome coordinates and transcripts")
+        self.genome_transcript_trees = build_genome_transcript_trees(self.transcripts)
+        max_transcriptome_hits_file = os.path.join(self.index_dir,
+                                                   config.MAX_MULTIMAPPING_FILE)
+        self.max_transcriptome_hits = int(open(max_transcriptome_hits_file).next().strip())
+        # genome references are read once and shared with the 
+        # conversions, otherwise each conversion looks them up
+        logging.debug("Reading genome references")
+        self.genome_refs = get_genome_refs(self.genome_index)
+        return self
+
+def determine_segment_length(isize_dist, trimmed_read_length, 
+                             segment_length=None):
+    """
+    choose a soft-clipped segment length that optimizes mapping given 
+    the insert size distribution of the library
+    """
+    # log insert size statistics
+    logging.info("Insert size samples=%d mean=%f std=%f median=%d mode=%d" % 
+                 (isize_dist.n, isize_dist.mean(), isize_dist.std(), 
+                  isize_dist.isize_at_percentile(50.0), isize_dist.mode()))    
+    # choose a segment length to optimize mapping
+    optimal_isize = isize_dist.isize_at_percentile(DEFAULT_FRAG_SIZE_SENSITIVITY)
+    logging.info("Determining soft-clipped segment length")
+    logging.debug("\tInsert size at %f percent of distribution is %d" % 
+                 (DEFAULT_FRAG_SIZE_SENSITIVITY, optimal_isize))
+    optimal_segment_length = int(round(optimal_isize / 3.0))
+    logging.debug("\tOptimal segment length is %d/3.0 = %d" % (optimal_isize, optimal_segment_length))
+    auto_segment_length = min(optimal_segment_length, trimmed_read_length)
+    auto_segment_length = max(config.MIN_SEGMENT_LENGTH, auto_segment_length)
+    logging.debug("\tAfter adjusting for min %d and read length %d, final segment length is %d" % 
+                 (config.MIN_SEGMENT_LENGTH, trimmed_read_length, auto_segment_length))
+    if segment_length is not None:
+        logging.debug("\tOverriding auto segment length and using segment length of %d" % (segment_length))
+        return segment_length
+    return auto_segment_length
+
+def _sort_bam_stage(input_bam_file, sorted_bam_file, sort_memory):
+    def func(num_processors):
+        bam_prefix = os.path.splitext(sorted_bam_file)[0]
+        pysam.sort("-m", str(sort_memory), input_bam_file, bam_prefix)
+        return config.JOB_SUCCESS
+    return func
+
+def _merge_bam_stage(input_bam_files, merged_bam_file):
+    def func(num_processors):
+        pysam.merge("-f", merged_bam_file, *input_bam_files)
+        return config.JOB_SUCCESS
+    return func
+
+def _index_bam_stage(bam_file):
+    def func(num_processors):
+        pysam.index(bam_file)
+        return config.JOB_SUCCESS
+    return func
+
+def _transcriptome_to_genome_stage(genome_index, transcripts, input_bam_file,
+                                   sorted_genome_bam_file, library_type, 
+                                   sort_buffer_size, tmp_dir, 
+                                   genome_refs=None):
+    def func(num_processors):
+        # the converted reads are written as BAM in sorted order
+        return transcriptome_to_genome(genome_index, transcripts, 
+                                       input_file=input_bam_file, 
+                                       output_file=sorted_genome_bam_file,
+                                       library_type=library_type,
+                                       input_sam=False,
+                                       output_sam=False,
+                                       genome_refs=genome_refs,
+                                       sort_buffer_size=sort_buffer_size,
+                                       tmp_dir=tmp_dir)
+    return func
+
+def run_chimerascan(runconfig, index_data=None):
     """
-    main function for running the chimerascan pipeline
+    main function for running the chimerascan pipeline.  'index_data' 
+    is an optional IndexData object already loaded from the index
     """
     # print a welcome message
     title_string = "Running chimerascan version %s" % (__version__)
@@ -406,11 +580,31 @@ def run_chimerascan(runconfig):
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
         logging.debug("Created directory for log files: %s" % (log_dir))        
-    # create tmp dir if it does not exist
-    tmp_dir = os.path.join(runconfig.output_dir, config.TMP_DIR)
+    # create tmp dir if it does not exist.  with a scratch dir each run 
+    # gets its own subdirectory named after its output dir so that runs
+    # can share the scratch dir and still be resumed
+    if runconfig.scratch_dir is None:
+        tmp_dir = os.path.join(runconfig.output_dir, config.TMP_DIR)
+    else:
+        run_id = hashlib.md5(runconfig.output_dir).hexdigest()[:8]
+        tmp_dir = os.path.join(runconfig.scratch_dir, "%s-%s" % 
+                               (os.path.basename(runconfig.output_dir), run_id))
     if not os.path.exists(tmp_dir):
         os.makedirs(tmp_dir)
         logging.debug("Created directory for tmp files: %s" % (tmp_dir))
+    # final outputs are first written to the scratch dir and moved to
+    # the output dir when the stage writing them succeeds
+    scratch_output_dir = os.path.join(tmp_dir, config.SCRATCH_OUTPUT_DIR)
+    if (runconfig.scratch_dir is not None) and (not os.path.exists(scratch_output_dir)):
+        os.makedirs(scratch_output_dir)
+    def scratch_output(filename):
+        if runconfig.scratch_dir is None:
+            return filename
+        return os.path.join(scratch_output_dir, os.path.basename(filename))
+    def promote(*filenames):
+        if runconfig.scratch_dir is None:
+            return None
+        return dict((f, scratch_output(f)) for f in filenames)
     # write the run config to a file
     xmlstring = runconfig.to_xml()
     runconfig_xml_file = os.path.join(runconfig.output_dir, config.RUNCONFIG_XML_FILE)
@@ -429,133 +623,319 @@ def run_chimerascan(runconfig):
         logging.info("Reading references mask file")
         mask_rnames.update([line.strip() for line in open(runconfig.mask_rnames_file)])
         logging.info("\tread references: %s" % (','.join(sorted(mask_rnames))))
-    # read transcripts
-    logging.info("Reading transcript features")
-    transcript_file = os.path.join(runconfig.index_dir, config.TRANSCRIPT_FEATURE_FILE)
-    transcripts = list(TranscriptFeature.parse(open(transcript_file)))
-    logging.info("\tread %d transcripts" % (len(transcripts)))
+    # load transcripts and other index structures unless they were
+    # loaded once for many samples by the caller
+    if (index_data is None) or (index_data.index_dir != runconfig.index_dir):
+        index_data = IndexData(runconfig.index_dir).load()
+    transcript_file = index_data.transcript_file
+    transcripts = index_data.transcripts
     # setup alignment indexes
-    genome_index = os.path.join(runconfig.index_dir, config.GENOME_INDEX)
-    transcriptome_index = os.path.join(runconfig.index_dir, config.TRANSCRIPTOME_INDEX)
-    max_transcriptome_hits_file = os.path.join(runconfig.index_dir, 
-                                               config.MAX_MULTIMAPPING_FILE)
-    max_transcriptome_hits = int(open(max_transcriptome_hits_file).next().strip())
-    # detect read length
-    original_read_length = detect_read_length(runconfig.fastq_files[0])
-    # minimum fragment length cannot be smaller than the trimmed read length
-    trimmed_read_length = (original_read_length - runconfig.trim5 - runconfig.trim3)
-    min_fragment_length = max(runconfig.min_fragment_length, trimmed_read_length)
-    # 
-    # Process and inspect the FASTQ files, performing several alterations 
+    genome_index = index_data.genome_index
+    transcriptome_index = index_data.transcriptome_index
+    max_transcriptome_hits = index_data.max_transcriptome_hits
+    # divide the memory budget among sorts, alignments, and other stages
+    planner = ResourcePlanner.from_size(runconfig.memory, runconfig.num_processors)
+    planner.log_plan()
+    # list of pipeline stages in the order they would run sequentially.
+    # the scheduler derives dependencies between stages from their
+    # input and output files and runs independent stages concurrently
+    stages = []
+    #
+    # Reads are divided into shards of whole fragments.  The read-level
+    # stages below run independently on each shard, sharing the available
+    # processors, and the shard BAM files are merged before insert size
+    # profiling and clustering.  A single shard uses the tmp dir directly.
+    #
+    num_shards = max(1, runconfig.num_shards)
+    if num_shards == 1:
+        shard_dirs = [tmp_dir]
+        shard_log_dirs = [log_dir]
+    else:
+        shard_dirs = [os.path.join(tmp_dir, config.SHARD_DIR % (shard))
+                      for shard in xrange(num_shards)]
+        shard_log_dirs = [os.path.join(log_dir, config.SHARD_DIR % (shard))
+                          for shard in xrange(num_shards)]
+        for d in shard_dirs + shard_log_dirs:
+            if not os.path.exists(d):
+                os.makedirs(d)
+    shard_processors = max(1, runconfig.num_processors // num_shards)
+    def shard_stage_name(name, shard):
+        if num_shards == 1:
+            return name
+        return "%s.%d" % (name, shard)
+    def shard_stage_msg(msg, shard):
+        if num_shards == 1:
+            return msg
+        return "%s (shard %d/%d)" % (msg, shard+1, num_shards)
+    def add_sort_stages(name, msg, bam_files, sorted_bam_file, final=False):
+        # sort each shard and merge the sorted shards.  final outputs
+        # are written to the scratch dir and promoted
+        output_bam_file = scratch_output(sorted_bam_file) if final else sorted_bam_file
+        output_promote = promote(sorted_bam_file) if final else None
+        if len(bam_files) == 1:
+            stages.append(Stage(name, msg,
+                                _sort_bam_stage(bam_files[0], output_bam_file,
+                                                planner.sort_memory()),
+                                inputs=(bam_files[0],),
+                                outputs=(sorted_bam_file,),
+                                promote=output_promote))
+            return
+        sorted_shard_bam_files = []
+        for shard,bam_file in enumerate(bam_files):
+            sorted_shard_bam_file = os.path.splitext(bam_file)[0] + ".srt.bam"
+            stages.append(Stage(shard_stage_name(name, shard),
+                                shard_stage_msg(msg, shard),
+                                _sort_bam_stage(bam_file, sorted_shard_bam_file,
+                                                planner.sort_memory()),
+                                inputs=(bam_file,),
+                                outputs=(sorted_shard_bam_file,)))
+            sorted_shard_bam_files.append(sorted_shard_bam_file)
+        stages.append(Stage(name, "Merging %d sorted shards" % (num_shards),
+                            _merge_bam_stage(sorted_shard_bam_files,
+                                             output_bam_file),
+                            inputs=sorted_shard_bam_files,
+                            outputs=(sorted_bam_file,),
+                            promote=output_promote))
+    #
+    # Process and inspect the FASTQ files, performing several alterations
     # to the reads:
     #
     # 1) rename them from long string to numbers to save space throughout
-    #    the pipeline. also store mapping from read numbers to full names 
+    #    the pipeline. also store mapping from read numbers to full names
     #    in a separate file
     # 2) ensure the "/1" and "/2" suffixes exist to denote paired reads
     # 3) convert quality scores to sanger format
-    # 
-    converted_fastq_files = [os.path.join(tmp_dir, fq) 
-                             for fq in config.CONVERTED_FASTQ_FILES]
-    read_name_file = os.path.join(tmp_dir, config.READ_NAME_TXT_FILE)
-    msg = "Processing FASTQ files"
-    skip = all(up_to_date(cfq, fq) for cfq,fq in 
-               zip(converted_fastq_files, runconfig.fastq_files))
-    skip = skip and up_to_date(read_name_file, runconfig.fastq_files[0])
-    if skip:
-        logging.info("[SKIPPED] %s" % (msg))
+    # 4) split fragments into shards
+    #
+    # When streaming, the processed reads are fed to the transcriptome
+    # aligners through named pipes and only a compressed copy is kept
+    #
+    if runconfig.stream_reads:
+        converted_fastq_names = config.CONVERTED_FASTQ_GZ_FILES
     else:
-        logging.info(msg)
-        converted_fastq_prefix = \
-            os.path.join(tmp_dir, config.CONVERTED_FASTQ_PREFIX)
-        try:
-            retcode = process_input_reads(runconfig.fastq_files, 
+        converted_fastq_names = config.CONVERTED_FASTQ_FILES
+    converted_fastq_files = [[os.path.join(d, fq) for fq in converted_fastq_names]
+                             for d in shard_dirs]
+    converted_fastq_prefix = os.path.join(tmp_dir, config.CONVERTED_FASTQ_PREFIX)
+    shard_prefixes = [os.path.join(d, config.CONVERTED_FASTQ_PREFIX)
+                      for d in shard_dirs]
+    read_name_file = os.path.join(tmp_dir, config.READ_NAME_FILE)
+    # counts of collapsed duplicate fragments used by the stages that
+    # count fragments
+    if runconfig.collapse_duplicates:
+        multiplicity_file = os.path.join(tmp_dir, config.DUPLICATE_COUNT_FILE)
+        multiplicity_files = [multiplicity_file]
+        # the fragment hashes are bounded by the memory budget
+        max_duplicates = planner.duplicate_table_entries()
+        duplicate_table_memory = planner.duplicate_table_memory()
+    else:
+        multiplicity_file = None
+        multiplicity_files = []
+        max_duplicates = None
+        duplicate_table_memory = 0
+    # cpu time measured in piped alignments, used to divide the
+    # processors of later ones
+    pipe_calibration_file = os.path.join(tmp_dir, config.PIPE_CALIBRATION_FILE)
+    # statistics of the input reads written while they are processed
+    input_stats_file = os.path.join(runconfig.output_dir, config.INPUT_STATS_FILE)
+    def get_trimmed_read_length():
+        # most common length of all the reads rather than the length 
+        # of the first read
+        input_stats = InputStats.from_file(input_stats_file)
+        return input_stats.trimmed_read_length(runconfig.trim5, runconfig.trim3)
+    def get_min_fragment_length(trimmed_read_length):
+        # minimum fragment length cannot be smaller than the trimmed 
+        # read length
+        if trimmed_read_length is None:
+            return runconfig.min_fragment_length
+        return max(runconfig.min_fragment_length, trimmed_read_length)
+    process_reads_params = {'quals': runconfig.quals,
+                            'trim5': runconfig.trim5,
+                            'trim3': runconfig.trim3,
+                            'num_shards': num_shards,
+                            'compress_read_names': runconfig.compress_read_names,
+                            'collapse_duplicates': runconfig.collapse_duplicates,
+                            'max_duplicates': max_duplicates,
+                            'subsample': runconfig.subsample,
+                            'subsample_seed': runconfig.subsample_seed}
+    def process_reads_stage(num_processors):
+        return process_input_reads(runconfig.fastq_files,
+                                   converted_fastq_prefix,
+                                   quals=runconfig.quals,
+                                   trim5=runconfig.trim5,
+                                   trim3=runconfig.trim3,
+                                   shard_prefixes=shard_prefixes,
+                                   num_threads=max(1, num_processors // len(runconfig.fastq_files)),
+                                   compress_read_names=runconfig.compress_read_names,
+                                   collapse_duplicates=runconfig.collapse_duplicates,
+                                   max_duplicates=max_duplicates,
+                                   subsample=runconfig.subsample,
+                                   subsample_seed=runconfig.subsample_seed,
+                                   stats_file=input_stats_file)
+    if not runconfig.stream_reads:
+        stages.append(Stage("process_reads", "Processing FASTQ files",
+                            process_reads_stage,
+                            inputs=runconfig.fastq_files,
+                            outputs=[f for files in converted_fastq_files for f in files] +
+                                    [read_name_file, input_stats_file] + multiplicity_files,
+                            params=process_reads_params,
+                            num_processors=runconfig.num_processors,
+                            memory=(planner.slot_memory * runconfig.num_processors +
+                                    duplicate_table_memory)))
+    transcriptome_bam_files = [os.path.join(d, config.TRANSCRIPTOME_BAM_FILE)
+                               for d in shard_dirs]
+    transcriptome_unaligned_fastq_files = [tuple(os.path.join(d, fq) for fq in config.TRANSCRIPTOME_UNALIGNED_FASTQ_FILES)
+                                           for d in shard_dirs]
+    genome_bam_files = [os.path.join(d, config.GENOME_BAM_FILE)
+                        for d in shard_dirs]
+    genome_unaligned_fastq_files = [tuple(os.path.join(d, fq) for fq in config.GENOME_UNALIGNED_FASTQ_FILES)
+                                    for d in shard_dirs]
+    transcriptome_align_params = {'index_dir': runconfig.index_dir,
+                                  'library_type': runconfig.library_type,
+                                  'min_fragment_length': runconfig.min_fragment_length,
+                                  'max_fragment_length': runconfig.max_fragment_length,
+                                  'max_transcriptome_hits': max_transcriptome_hits}
+    transcriptome_align_funcs = []
+    def add_alignment_stages(shard):
+        shard_dir = shard_dirs[shard]
+        shard_log_dir = shard_log_dirs[shard]
+        #
+        # Transcriptome alignment step
+        #
+        # Align to transcriptome in paired-end mode, trying to resolve as many
+        # reads as possible.
+        #
+        transcriptome_unaligned_path = os.path.join(shard_dir, config.TRANSCRIPTOME_UNALIGNED_PATH)
+        def align_transcriptome(fastq_files, num_processors, trimmed_read_length):
+            log_file = os.path.join(shard_log_dir, config.TRANSCRIPTOME_LOG_FILE)
+            return bowtie2_align_transcriptome_pe(transcriptome_index=transcriptome_index,
+                                                  genome_index=genome_index,
+                                                  transcript_file=transcript_file,
+                                                  fastq_files=fastq_files,
+                                                  unaligned_path=transcriptome_unaligned_path,
+                                                  bam_file=transcriptome_bam_files[shard],
+                                                  log_file=log_file,
+                                                  library_type=runconfig.library_type,
+                                                  min_fragment_length=get_min_fragment_length(trimmed_read_length),
+                                                  max_fragment_length=runconfig.max_fragment_length,
+                                                  max_transcriptome_hits=max_transcriptome_hits,
+                                                  num_processors=num_processors,
+                                                  calibration_file=pipe_calibration_file)
+        transcriptome_align_funcs.append(align_transcriptome)
+        def transcriptome_align_stage(num_processors):
+            return align_transcriptome(converted_fastq_files[shard], num_processors,
+                                       get_trimmed_read_length())
+        if not runconfig.stream_reads:
+            stages.append(Stage(shard_stage_name("transcriptome_align", shard),
+                                shard_stage_msg("Aligning paired-end reads to transcriptome", shard),
+                                transcriptome_align_stage,
+                                inputs=converted_fastq_files[shard] + [transcript_file, input_stats_file],
+                                outputs=(transcriptome_bam_files[shard],) + transcriptome_unaligned_fastq_files[shard],
+                                params=transcriptome_align_params,
+                                num_processors=shard_processors,
+                                min_processors=2,
+                                memory=(planner.bowtie2_memory(transcriptome_index, shard_processors) +
+                                        planner.slot_memory)))
+        #
+        # Genome alignment step
+        #
+        # Align any unaligned transcriptome reads to genome in paired-end mode.
+        # Resolve as many reads as possible.
+        #
+        genome_unaligned_path = os.path.join(shard_dir, config.GENOME_UNALIGNED_PATH)
+        def genome_align_stage(num_processors):
+            log_file = os.path.join(shard_log_dir, config.GENOME_LOG_FILE)
+            return bowtie2_align_pe(index=genome_index,
+                                    fastq_files=transcriptome_unaligned_fastq_files[shard],
+                                    unaligned_path=genome_unaligned_path,
+                                    bam_file=genome_bam_files[shard],
+                                    log_file=log_file,
+                                    library_type=runconfig.library_type,
+                                    min_fragment_length=get_min_fragment_length(get_trimmed_read_length()),
+                                    max_fragment_length=runconfig.max_fragment_length,
+                                    max_hits=max_transcriptome_hits,
+                                    num_processors=num_processors)
+        stages.append(Stage(shard_stage_name("genome_align", shard),
+                            shard_stage_msg("Realigning unaligned paired-end reads to genome", shard),
+                            genome_align_stage,
+                            inputs=transcriptome_unaligned_fastq_files[shard] + (input_stats_file,),
+                            outputs=(genome_bam_files[shard],) + genome_unaligned_fastq_files[shard],
+                            params={'index_dir': runconfig.index_dir,
+                                    'library_type': runconfig.library_type,
+                                    'min_fragment_length': runconfig.min_fragment_length,
+                                    'max_fragment_length': runconfig.max_fragment_length,
+                                    'max_hits': max_transcriptome_hits},
+                            num_processors=shard_processors,
+                            memory=planner.bowtie2_memory(genome_index, shard_processors)))
+    for shard in xrange(num_shards):
+        add_alignment_stages(shard)
+    #
+    # Streaming replaces the read processing and transcriptome alignment
+    # stages with a single stage that runs them concurrently
+    #
+    if runconfig.stream_reads:
+        def stream_stage(num_processors):
+            # one processor is left for processing the reads
+            align_processors = max(2, (num_processors - 1) // num_shards)
+            return stream_and_align_reads(runconfig.fastq_files,
                                           converted_fastq_prefix,
                                           quals=runconfig.quals,
                                           trim5=runconfig.trim5,
-                                          trim3=runconfig.trim3)
-            if retcode != config.JOB_SUCCESS:
-                logging.error("%s step failed" % (msg))
-                return config.JOB_ERROR
-        except Exception as e:
-            logging.info("Cleaning up after error %s" % (str(e)))
-            for fq in converted_fastq_files:
-                if os.path.isfile(fq):
-                    os.remove(fq)
-    #
-    # Transcriptome alignment step
-    #
-    # Align to transcriptome in paired-end mode, trying to resolve as many 
-    # reads as possible.
-    #
-    transcriptome_bam_file = os.path.join(tmp_dir, config.TRANSCRIPTOME_BAM_FILE)
-    transcriptome_unaligned_path = os.path.join(tmp_dir, config.TRANSCRIPTOME_UNALIGNED_PATH)
-    transcriptome_unaligned_fastq_files = tuple(os.path.join(tmp_dir, fq) for fq in config.TRANSCRIPTOME_UNALIGNED_FASTQ_FILES)
-    msg = "Aligning paired-end reads to transcriptome"
-    if (all(up_to_date(transcriptome_bam_file, fq) for fq in converted_fastq_files) and 
-        all(up_to_date(a,b) for a,b in zip(transcriptome_unaligned_fastq_files, converted_fastq_files))):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        log_file = os.path.join(log_dir, config.TRANSCRIPTOME_LOG_FILE)
-        retcode = bowtie2_align_transcriptome_pe(transcriptome_index=transcriptome_index,
-                                                 genome_index=genome_index,
-                                                 transcript_file=transcript_file,     
-                                                 fastq_files=converted_fastq_files,
-                                                 unaligned_path=transcriptome_unaligned_path,
-                                                 bam_file=transcriptome_bam_file,
-                                                 log_file=log_file,
-                                                 library_type=runconfig.library_type,
-                                                 min_fragment_length=min_fragment_length,
-                                                 max_fragment_length=runconfig.max_fragment_length,
-                                                 max_transcriptome_hits=max_transcriptome_hits,
-                                                 num_processors=runconfig.num_processors)
-        # cleanup if job failed
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(transcriptome_bam_file):
-                os.remove(transcriptome_bam_file)
-            for f in transcriptome_unaligned_fastq_files:
-                if os.path.exists(f):
-                    os.remove(f)
-            return config.JOB_ERROR
+                                          trim3=runconfig.trim3,
+                                          shard_prefixes=shard_prefixes,
+                                          align_funcs=transcriptome_align_funcs,
+                                          align_processors=align_processors,
+                                          compress_read_names=runconfig.compress_read_names,
+                                          collapse_duplicates=runconfig.collapse_duplicates,
+                                          max_duplicates=max_duplicates,
+                                          subsample=runconfig.subsample,
+                                          subsample_seed=runconfig.subsample_seed,
+                                          stats_file=input_stats_file)
+        stream_outputs = ([f for files in converted_fastq_files for f in files] + 
+                          [read_name_file, input_stats_file] + multiplicity_files)
+        for shard in xrange(num_shards):
+            stream_outputs.append(transcriptome_bam_files[shard])
+            stream_outputs.extend(transcriptome_unaligned_fastq_files[shard])
+        stream_params = dict(process_reads_params)
+        stream_params.update(transcriptome_align_params)
+        stages.append(Stage("stream_transcriptome_align",
+                            "Processing FASTQ files and streaming reads to "
+                            "transcriptome alignment",
+                            stream_stage,
+                            inputs=list(runconfig.fastq_files) + [transcript_file],
+                            outputs=stream_outputs,
+                            params=stream_params,
+                            num_processors=runconfig.num_processors,
+                            min_processors=2,
+                            memory=(num_shards * (planner.bowtie2_memory(transcriptome_index, shard_processors) +
+                                                  planner.slot_memory) +
+                                    planner.slot_memory + duplicate_table_memory)))
     #
     # Sort transcriptome reads by position
     #
-    msg = "Sorting transcriptome reads"
-    sorted_transcriptome_bam_file = os.path.join(runconfig.output_dir, 
+    sorted_transcriptome_bam_file = os.path.join(runconfig.output_dir,
                                                  config.SORTED_TRANSCRIPTOME_BAM_FILE)
-    if (up_to_date(sorted_transcriptome_bam_file, transcriptome_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        sorted_aligned_bam_prefix = os.path.splitext(sorted_transcriptome_bam_file)[0]
-        pysam.sort("-m", str(int(1e9)), transcriptome_bam_file, sorted_aligned_bam_prefix)
+    add_sort_stages("sort_transcriptome", "Sorting transcriptome reads",
+                    transcriptome_bam_files, sorted_transcriptome_bam_file,
+                    final=True)
     #
     # Index BAM file
     #
-    msg = "Indexing BAM file"
     sorted_transcriptome_bam_index_file = sorted_transcriptome_bam_file + ".bai"
-    if (up_to_date(sorted_transcriptome_bam_index_file, sorted_transcriptome_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        pysam.index(sorted_transcriptome_bam_file)
+    stages.append(Stage("index_transcriptome", "Indexing BAM file",
+                        _index_bam_stage(sorted_transcriptome_bam_file),
+                        inputs=(sorted_transcriptome_bam_file,),
+                        outputs=(sorted_transcriptome_bam_index_file,)))
     #
     # Get insert size distribution
     #
-    isize_dist_file = os.path.join(runconfig.output_dir, 
+    isize_dist_file = os.path.join(runconfig.output_dir,
                                    config.ISIZE_DIST_FILE)
-    msg = "Profiling insert size distribution"
-    if up_to_date(isize_dist_file, transcriptome_bam_file):
-        logging.info("[SKIPPED] %s" % msg)
-        isize_dist = InsertSizeDistribution.from_file(open(isize_dist_file, "r"))
-    else:
-        logging.info(msg)
+    def profile_isize_stage(num_processors):
         bamfh = pysam.Samfile(sorted_transcriptome_bam_file, "rb")
-        isize_dist = InsertSizeDistribution.from_genome_bam(bamfh, transcripts, 
-                                                            min_isize=min_fragment_length, 
-                                                            max_isize=runconfig.max_fragment_length, 
+        isize_dist = InsertSizeDistribution.from_genome_bam(bamfh, transcripts,
+                                                            min_isize=get_min_fragment_length(get_trimmed_read_length()),
+                                                            max_isize=runconfig.max_fragment_length,
                                                             max_samples=config.ISIZE_MAX_SAMPLES)
         bamfh.close()
         # if not enough samples, use a normal distribution instead
@@ -563,235 +943,189 @@ def run_chimerascan(runconfig):
         if isize_dist.n < config.ISIZE_MIN_SAMPLES:
             logging.warning("Not enough fragments to sample insert size "
                             "distribution empirically.  Using mean=%d "
-                            "stdev=%f instead" % 
-                            (runconfig.isize_mean, 
+                            "stdev=%f instead" %
+                            (runconfig.isize_mean,
                              runconfig.isize_stdev))
-            isize_dist = InsertSizeDistribution.from_random(runconfig.isize_mean, 
-                                                            runconfig.isize_stdev, 
+            isize_dist = InsertSizeDistribution.from_random(runconfig.isize_mean,
+                                                            runconfig.isize_stdev,
                                                             min_isize=runconfig.min_fragment_length,
                                                             max_isize=runconfig.max_fragment_length,
                                                             samples=config.ISIZE_MAX_SAMPLES)
         isize_dist.to_file(open(isize_dist_file, "w"))
+        return config.JOB_SUCCESS
+    stages.append(Stage("profile_isize", "Profiling insert size distribution",
+                        profile_isize_stage,
+                        inputs=(sorted_transcriptome_bam_file,
+                                sorted_transcriptome_bam_index_file,
+                                transcript_file,
+                                input_stats_file),
+                        outputs=(isize_dist_file,),
+                        params={'min_fragment_length': runconfig.min_fragment_length,
+                                'max_fragment_length': runconfig.max_fragment_length,
+                                'isize_mean': runconfig.isize_mean,
+                                'isize_stdev': runconfig.isize_stdev}))
+    # each shard converts its discordant and unpaired reads into sorted
+    # BAM files, which are already the final files when there is a 
+    # single shard and otherwise are merged
+    sorted_discordant_genome_bam_file = os.path.join(tmp_dir, config.SORTED_DISCORDANT_GENOME_BAM_FILE)
+    sorted_unpaired_genome_bam_file = os.path.join(tmp_dir, config.SORTED_UNPAIRED_GENOME_BAM_FILE)
+    discordant_genome_bam_files = [os.path.join(d, config.SORTED_DISCORDANT_GENOME_BAM_FILE)
+                                   for d in shard_dirs]
+    unpaired_genome_bam_files = [os.path.join(d, config.SORTED_UNPAIRED_GENOME_BAM_FILE)
+                                 for d in shard_dirs]
+    def add_discordant_stages(shard):
+        shard_dir = shard_dirs[shard]
+        shard_log_dir = shard_log_dirs[shard]
+        #
+        # Realignment step
+        #
+        # trim and realign all the initially unaligned reads in order to
+        # increase sensitivity to detect reads spanning fusion junctions
+        #
+        realigned_bam_file = os.path.join(shard_dir, config.REALIGNED_BAM_FILE)
+        realigned_log_file = os.path.join(shard_log_dir, config.REALIGNED_LOG_FILE)
+        def realign_stage(num_processors):
+            isize_dist = InsertSizeDistribution.from_file(open(isize_dist_file, "r"))
+            trimmed_read_length = get_trimmed_read_length()
+            if trimmed_read_length is None:
+                trimmed_read_length = 0
+            # check that seed length < read length
+            if ((runconfig.segment_length is not None) and 
+                (runconfig.segment_length > trimmed_read_length)):
+                logging.error("seed length %d cannot be longer than read length %d" % 
+                              (runconfig.segment_length, trimmed_read_length))
+                return config.JOB_ERROR
+            segment_length = determine_segment_length(isize_dist,
+                                                      trimmed_read_length,
+                                                      runconfig.segment_length)
+            return bowtie2_align_pe_sr(index=transcriptome_index,
+                                       transcript_file=transcript_file,
+                                       fastq_files=genome_unaligned_fastq_files[shard],
+                                       bam_file=realigned_bam_file,
+                                       log_file=realigned_log_file,
+                                       tmp_dir=shard_dir,
+                                       segment_length=segment_length,
+                                       max_hits=max_transcriptome_hits,
+                                       num_processors=num_processors)
+        stages.append(Stage(shard_stage_name("realign", shard),
+                            shard_stage_msg("Trimming and realigning initially unmapped reads", shard),
+                            realign_stage,
+                            inputs=genome_unaligned_fastq_files[shard] + (isize_dist_file, input_stats_file),
+                            outputs=(realigned_bam_file,),
+                            params={'index_dir': runconfig.index_dir,
+                                    'trim5': runconfig.trim5,
+                                    'trim3': runconfig.trim3,
+                                    'segment_length': runconfig.segment_length,
+                                    'max_hits': max_transcriptome_hits},
+                            num_processors=shard_processors,
+                            memory=(planner.bowtie2_memory(transcriptome_index, shard_processors) +
+                                    planner.slot_memory)))
+        #
+        # Find discordant reads
+        #
+        # iterate through realigned reads and divide them into groups of
+        # concordant, discordant within a gene (isoforms), discordant
+        # between different genes, and discordant in the genome
+        #
+        paired_bam_file = os.path.join(shard_dir, config.PAIRED_BAM_FILE)
+        discordant_bam_file = os.path.join(shard_dir, config.DISCORDANT_BAM_FILE)
+        unpaired_bam_file = os.path.join(shard_dir, config.UNPAIRED_BAM_FILE)
+        unmapped_bam_file = os.path.join(shard_dir, config.UNMAPPED_BAM_FILE)
+        multimap_bam_file = os.path.join(shard_dir, config.MULTIMAP_BAM_FILE)
+        unresolved_bam_file = os.path.join(shard_dir, config.UNRESOLVED_BAM_FILE)
+        def classify_stage(num_processors):
+            return find_discordant_fragments(transcripts=transcripts,
+                                             input_bam_file=realigned_bam_file,
+                                             paired_bam_file=paired_bam_file,
+                                             discordant_bam_file=discordant_bam_file,
+                                             unpaired_bam_file=unpaired_bam_file,
+                                             unmapped_bam_file=unmapped_bam_file,
+                                             multimap_bam_file=multimap_bam_file,
+                                             unresolved_bam_file=unresolved_bam_file,
+                                             max_isize=runconfig.max_fragment_length,
+                                             max_multihits=runconfig.max_multihits,
+                                             library_type=runconfig.library_type,
+                                             num_workers=num_processors,
+                                             tmp_dir=shard_dir)
+        stages.append(Stage(shard_stage_name("classify_reads", shard),
+                            shard_stage_msg("Classifying concordant and discordant read pairs", shard),
+                            classify_stage,
+                            inputs=[realigned_bam_file, transcript_file],
+                            outputs=(paired_bam_file, discordant_bam_file,
+                                     unpaired_bam_file, unmapped_bam_file,
+                                     multimap_bam_file, unresolved_bam_file),
+                            params={'max_fragment_length': runconfig.max_fragment_length,
+                                    'max_multihits': runconfig.max_multihits,
+                                    'library_type': runconfig.library_type},
+                            num_processors=shard_processors))
+        #
+        # Convert discordant transcriptome reads to genome coordinates
+        #
+        stages.append(Stage(shard_stage_name("convert_discordant", shard),
+                            shard_stage_msg("Converting discordant transcriptome hits to genomic coordinates", shard),
+                            _transcriptome_to_genome_stage(genome_index, transcripts,
+                                                           discordant_bam_file,
+                                                           discordant_genome_bam_files[shard],
+                                                           runconfig.library_type,
+                                                           planner.bam_sort_buffer_size(),
+                                                           shard_dir,
+                                                           index_data.genome_refs),
+                            inputs=(discordant_bam_file, transcript_file),
+                            outputs=(discordant_genome_bam_files[shard],),
+                            params={'index_dir': runconfig.index_dir,
+                                    'library_type': runconfig.library_type}))
+        #
+        # Convert unpaired transcriptome reads to genome coordinates
+        #
+        stages.append(Stage(shard_stage_name("convert_unpaired", shard),
+                            shard_stage_msg("Converting unpaired transcriptome hits to genomic coordinates", shard),
+                            _transcriptome_to_genome_stage(genome_index, transcripts,
+                                                           unpaired_bam_file,
+                                                           unpaired_genome_bam_files[shard],
+                                                           runconfig.library_type,
+                                                           planner.bam_sort_buffer_size(),
+                                                           shard_dir,
+                                                           index_data.genome_refs),
+                            inputs=(unpaired_bam_file, transcript_file),
+                            outputs=(unpaired_genome_bam_files[shard],),
+                            params={'index_dir': runconfig.index_dir,
+                                    'library_type': runconfig.library_type}))
+    for shard in xrange(num_shards):
+        add_discordant_stages(shard)
     #
-    # Determine ideal segment length automatically
-    #
-    # log insert size statistics
-    logging.info("Insert size samples=%d mean=%f std=%f median=%d mode=%d" % 
-                 (isize_dist.n, isize_dist.mean(), isize_dist.std(), 
-                  isize_dist.isize_at_percentile(50.0), isize_dist.mode()))    
-    # choose a segment length to optimize mapping
-    optimal_isize = isize_dist.isize_at_percentile(DEFAULT_FRAG_SIZE_SENSITIVITY)
-    logging.info("Determining soft-clipped segment length")
-    logging.debug("\tInsert size at %f percent of distribution is %d" % 
-                 (DEFAULT_FRAG_SIZE_SENSITIVITY, optimal_isize))
-    optimal_segment_length = int(round(optimal_isize / 3.0))
-    logging.debug("\tOptimal segment length is %d/3.0 = %d" % (optimal_isize, optimal_segment_length))
-    segment_length = min(optimal_segment_length, trimmed_read_length)
-    segment_length = max(config.MIN_SEGMENT_LENGTH, segment_length)
-    logging.debug("\tAfter adjusting for min %d and read length %d, final segment length is %d" % 
-                 (config.MIN_SEGMENT_LENGTH, trimmed_read_length, segment_length))
-    if runconfig.segment_length is not None:
-        logging.debug("\tOverriding auto segment length and using segment length of %d" % (runconfig.segment_length))
-        segment_length = runconfig.segment_length
-    #
-    # Genome alignment step
-    #
-    # Align any unaligned transcriptome reads to genome in paired-end mode.
-    # Resolve as many reads as possible.
-    #
-    genome_bam_file = os.path.join(tmp_dir, config.GENOME_BAM_FILE)
-    genome_unaligned_path = os.path.join(tmp_dir, config.GENOME_UNALIGNED_PATH)
-    genome_unaligned_fastq_files = tuple(os.path.join(tmp_dir, fq) for fq in config.GENOME_UNALIGNED_FASTQ_FILES)
-    msg = "Realigning unaligned paired-end reads to genome"
-    if (all(up_to_date(genome_bam_file, fq) for fq in converted_fastq_files) and 
-        all(up_to_date(a,b) for a,b in zip(genome_unaligned_fastq_files, converted_fastq_files))):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        log_file = os.path.join(log_dir, config.GENOME_LOG_FILE)
-        retcode = bowtie2_align_pe(index=genome_index,
-                                   fastq_files=transcriptome_unaligned_fastq_files,
-                                   unaligned_path=genome_unaligned_path,
-                                   bam_file=genome_bam_file,
-                                   log_file=log_file,
-                                   library_type=runconfig.library_type,
-                                   min_fragment_length=min_fragment_length,
-                                   max_fragment_length=runconfig.max_fragment_length,
-                                   max_hits=max_transcriptome_hits,
-                                   num_processors=runconfig.num_processors)
-        # cleanup if job failed
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(genome_bam_file):
-                os.remove(genome_bam_file)
-            for f in genome_unaligned_fastq_files:
-                if os.path.exists(f):
-                    os.remove(f)
-            return config.JOB_ERROR
-    #
-    # Realignment step
-    #
-    # trim and realign all the initially unaligned reads in order to
-    # increase sensitivity to detect reads spanning fusion junctions
-    #
-    realigned_bam_file = os.path.join(tmp_dir, config.REALIGNED_BAM_FILE)
-    realigned_log_file = os.path.join(log_dir, config.REALIGNED_LOG_FILE)
-    msg = "Trimming and realigning initially unmapped reads"
-    if (all(up_to_date(realigned_bam_file, fq) for fq in genome_unaligned_fastq_files) and
-        up_to_date(realigned_bam_file, isize_dist_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        retcode = bowtie2_align_pe_sr(index=transcriptome_index,
-                                      transcript_file=transcript_file,
-                                      fastq_files=genome_unaligned_fastq_files,
-                                      bam_file=realigned_bam_file,
-                                      log_file=realigned_log_file,
-                                      tmp_dir=tmp_dir,
-                                      segment_length=segment_length,
-                                      max_hits=max_transcriptome_hits,
-                                      num_processors=runconfig.num_processors)
-        if retcode != config.JOB_SUCCESS:
-            if os.path.exists(realigned_bam_file):
-                os.remove(realigned_bam_file)
-            return config.JOB_ERROR
-    #
-    # Find discordant reads
-    #
-    # iterate through realigned reads and divide them into groups of
-    # concordant, discordant within a gene (isoforms), discordant
-    # between different genes, and discordant in the genome
-    #
-    paired_bam_file = os.path.join(tmp_dir, config.PAIRED_BAM_FILE)
-    discordant_bam_file = os.path.join(tmp_dir, config.DISCORDANT_BAM_FILE)
-    unpaired_bam_file = os.path.join(tmp_dir, config.UNPAIRED_BAM_FILE)
-    unmapped_bam_file = os.path.join(tmp_dir, config.UNMAPPED_BAM_FILE)
-    multimap_bam_file = os.path.join(tmp_dir, config.MULTIMAP_BAM_FILE)
-    unresolved_bam_file = os.path.join(tmp_dir, config.UNRESOLVED_BAM_FILE)
-    output_files = (paired_bam_file, discordant_bam_file, unpaired_bam_file,
-                    unmapped_bam_file, multimap_bam_file, unresolved_bam_file)
-    msg = "Classifying concordant and discordant read pairs"
-    if (all(up_to_date(f, realigned_bam_file) for f in output_files)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        retcode = find_discordant_fragments(transcripts=transcripts,
-                                            input_bam_file=realigned_bam_file,
-                                            paired_bam_file=paired_bam_file,
-                                            discordant_bam_file=discordant_bam_file,
-                                            unpaired_bam_file=unpaired_bam_file,
-                                            unmapped_bam_file=unmapped_bam_file,
-                                            multimap_bam_file=multimap_bam_file,
-                                            unresolved_bam_file=unresolved_bam_file,
-                                            max_isize=runconfig.max_fragment_length,
-                                            max_multihits=runconfig.max_multihits,
-                                            library_type=runconfig.library_type)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            for f in output_files:
-                if os.path.exists(f):
-                    os.remove(f)
-            return config.JOB_ERROR
-    #
-    # Convert discordant transcriptome reads to genome coordinates
-    #
-    discordant_genome_bam_file = os.path.join(tmp_dir, config.DISCORDANT_GENOME_BAM_FILE)
-    msg = "Converting discordant transcriptome hits to genomic coordinates"
-    if (up_to_date(discordant_genome_bam_file, discordant_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)        
-        discordant_genome_sam_file = os.path.join(tmp_dir, config.DISCORDANT_GENOME_SAM_FILE)
-        retcode = transcriptome_to_genome(genome_index, transcripts, 
-                                          input_file=discordant_bam_file, 
-                                          output_file=discordant_genome_sam_file,
-                                          library_type=runconfig.library_type,
-                                          input_sam=False,
-                                          output_sam=True)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(discordant_genome_sam_file):
-                os.remove(discordant_genome_sam_file)
-            return config.JOB_ERROR
-        retcode = sam_to_bam(discordant_genome_sam_file, discordant_genome_bam_file)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(discordant_genome_bam_file):
-                os.remove(discordant_genome_bam_file)
-            return config.JOB_ERROR
-        if os.path.exists(discordant_genome_sam_file):
-            os.remove(discordant_genome_sam_file)
-    #
-    # Sort discordant reads by position
+    # Merge sorted discordant reads
     #
-    msg = "Sorting discordant BAM file"
-    sorted_discordant_genome_bam_file = os.path.join(tmp_dir, config.SORTED_DISCORDANT_GENOME_BAM_FILE)
-    if (up_to_date(sorted_discordant_genome_bam_file, discordant_genome_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        bam_prefix = os.path.splitext(sorted_discordant_genome_bam_file)[0]
-        pysam.sort("-m", str(int(1e9)), discordant_genome_bam_file, bam_prefix)
+    if num_shards > 1:
+        stages.append(Stage("merge_discordant", "Merging %d sorted discordant shards" % (num_shards),
+                            _merge_bam_stage(discordant_genome_bam_files,
+                                             sorted_discordant_genome_bam_file),
+                            inputs=discordant_genome_bam_files,
+                            outputs=(sorted_discordant_genome_bam_file,)))
     #
     # Index BAM file
     #
-    msg = "Indexing discordant BAM file"
     sorted_discordant_bam_index_file = sorted_discordant_genome_bam_file + ".bai"
-    if (up_to_date(sorted_discordant_bam_index_file, sorted_discordant_genome_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        pysam.index(sorted_discordant_genome_bam_file)
+    stages.append(Stage("index_discordant", "Indexing discordant BAM file",
+                        _index_bam_stage(sorted_discordant_genome_bam_file),
+                        inputs=(sorted_discordant_genome_bam_file,),
+                        outputs=(sorted_discordant_bam_index_file,)))
     #
-    # Convert unpaired transcriptome reads to genome coordinates
+    # Merge sorted unpaired reads
     #
-    unpaired_genome_bam_file = os.path.join(tmp_dir, config.UNPAIRED_GENOME_BAM_FILE)
-    msg = "Converting unpaired transcriptome hits to genomic coordinates"
-    if (up_to_date(unpaired_genome_bam_file, unpaired_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)        
-        unpaired_genome_sam_file = os.path.join(tmp_dir, config.UNPAIRED_GENOME_SAM_FILE)
-        retcode = transcriptome_to_genome(genome_index, transcripts, 
-                                          input_file=unpaired_bam_file, 
-                                          output_file=unpaired_genome_sam_file,
-                                          library_type=runconfig.library_type,
-                                          input_sam=False,
-                                          output_sam=True)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(unpaired_genome_sam_file):
-                os.remove(unpaired_genome_sam_file)
-            return config.JOB_ERROR
-        retcode = sam_to_bam(unpaired_genome_sam_file, unpaired_genome_bam_file)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(unpaired_genome_bam_file):
-                os.remove(unpaired_genome_bam_file)
-            return config.JOB_ERROR
-        if os.path.exists(unpaired_genome_sam_file):
-            os.remove(unpaired_genome_sam_file)        
-    #
-    # Sort unpaired reads by position
-    #
-    msg = "Sorting unpaired BAM file"
-    sorted_unpaired_genome_bam_file = os.path.join(tmp_dir, config.SORTED_UNPAIRED_GENOME_BAM_FILE)
-    if (up_to_date(sorted_unpaired_genome_bam_file, unpaired_genome_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        bam_prefix = os.path.splitext(sorted_unpaired_genome_bam_file)[0]
-        pysam.sort("-m", str(int(1e9)), unpaired_genome_bam_file, bam_prefix)
+    if num_shards > 1:
+        stages.append(Stage("merge_unpaired", "Merging %d sorted unpaired shards" % (num_shards),
+                            _merge_bam_stage(unpaired_genome_bam_files,
+                                             sorted_unpaired_genome_bam_file),
+                            inputs=unpaired_genome_bam_files,
+                            outputs=(sorted_unpaired_genome_bam_file,)))
     #
     # Index BAM file
     #
-    msg = "Indexing unpaired BAM file"
     sorted_unpaired_bam_index_file = sorted_unpaired_genome_bam_file + ".bai"
-    if (up_to_date(sorted_unpaired_bam_index_file, sorted_unpaired_genome_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        pysam.index(sorted_unpaired_genome_bam_file)
+    stages.append(Stage("index_unpaired", "Indexing unpaired BAM file",
+                        _index_bam_stage(sorted_unpaired_genome_bam_file),
+                        inputs=(sorted_unpaired_genome_bam_file,),
+                        outputs=(sorted_unpaired_bam_index_file,)))
     #
     # Cluster discordant reads into chimera candidates
     #
@@ -799,196 +1133,214 @@ def run_chimerascan(runconfig):
     cluster_shelve_file = \
         os.path.join(tmp_dir, config.DISCORDANT_CLUSTER_SHELVE_FILE)
     sorted_discordant_genome_cluster_bam_file = \
-        os.path.join(runconfig.output_dir, 
+        os.path.join(runconfig.output_dir,
                      config.SORTED_DISCORDANT_GENOME_CLUSTER_BAM_FILE)
-    input_files = (sorted_discordant_genome_bam_file, 
-                   sorted_unpaired_genome_bam_file)
-    output_files = (cluster_file, cluster_shelve_file,                      
-                    sorted_discordant_genome_cluster_bam_file)
-    msg = "Clustering discordant reads"
-    skip = True
-    for input_file in input_files:
-        for output_file in output_files:
-            skip = skip and up_to_date(output_file, input_file)
-    if skip:
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.debug(msg)
-        retcode = cluster_discordant_reads(discordant_bam_file=sorted_discordant_genome_bam_file, 
-                                           unpaired_bam_file=sorted_unpaired_genome_bam_file, 
-                                           concordant_bam_file=sorted_transcriptome_bam_file, 
-                                           output_bam_file=sorted_discordant_genome_cluster_bam_file, 
-                                           cluster_file=cluster_file,
-                                           cluster_shelve_file=cluster_shelve_file)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            for f in output_files:
-                if os.path.exists(f):
-                    os.remove(f)
+    def cluster_stage(num_processors):
+        return cluster_discordant_reads(discordant_bam_file=sorted_discordant_genome_bam_file,
+                                        unpaired_bam_file=sorted_unpaired_genome_bam_file,
+                                        concordant_bam_file=sorted_transcriptome_bam_file,
+                                        output_bam_file=scratch_output(sorted_discordant_genome_cluster_bam_file),
+                                        cluster_file=cluster_file,
+                                        cluster_shelve_file=cluster_shelve_file,
+                                        multiplicity_file=multiplicity_file)
+    stages.append(Stage("cluster_discordant", "Clustering discordant reads",
+                        cluster_stage,
+                        inputs=(sorted_discordant_genome_bam_file,
+                                sorted_discordant_bam_index_file,
+                                sorted_unpaired_genome_bam_file,
+                                sorted_unpaired_bam_index_file,
+                                sorted_transcriptome_bam_file,
+                                sorted_transcriptome_bam_index_file) + tuple(multiplicity_files),
+                        outputs=(cluster_file, cluster_shelve_file,
+                                 sorted_discordant_genome_cluster_bam_file),
+                        promote=promote(sorted_discordant_genome_cluster_bam_file)))
     #
     # Pair discordant clusters
     #
     cluster_pair_file = \
         os.path.join(tmp_dir, config.DISCORDANT_CLUSTER_PAIR_FILE)
-    msg = "Pairing discordant clusters"
-    output_files = (cluster_pair_file,)
-    if up_to_date(cluster_pair_file, sorted_discordant_genome_cluster_bam_file):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.debug(msg)
-        retcode = pair_discordant_clusters(discordant_bam_file=sorted_discordant_genome_cluster_bam_file, 
-                                           cluster_pair_file=cluster_pair_file, 
-                                           tmp_dir=tmp_dir)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            for f in output_files:
-                if os.path.exists(f):
-                    os.remove(f)
+    def pair_clusters_stage(num_processors):
+        return pair_discordant_clusters(discordant_bam_file=sorted_discordant_genome_cluster_bam_file,
+                                        cluster_pair_file=cluster_pair_file,
+                                        tmp_dir=tmp_dir,
+                                        sort_memory=planner.sort_memory(),
+                                        sort_buffer_size=planner.batch_sort_buffer_size())
+    stages.append(Stage("pair_clusters", "Pairing discordant clusters",
+                        pair_clusters_stage,
+                        inputs=(sorted_discordant_genome_cluster_bam_file,),
+                        outputs=(cluster_pair_file,)))
     #
     # Perform realignment across putative fusion breakpoints
     #
     breakpoint_bam_file = os.path.join(tmp_dir, config.BREAKPOINT_BAM_FILE)
-    msg = "Realigning to find breakpoint-spanning reads"
-    input_files = (sorted_discordant_genome_bam_file, 
-                   sorted_unpaired_genome_bam_file, 
-                   cluster_shelve_file, 
-                   cluster_pair_file)
-    output_files = (breakpoint_bam_file,)
-    skip = True
-    for inp in input_files:
-        for outp in output_files:
-            if not up_to_date(outp, inp):
-                skip = False
-    if skip:
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.debug(msg)
-        retcode = realign_across_breakpoints(index_dir=runconfig.index_dir,
-                                             discordant_bam_file=sorted_discordant_genome_bam_file,
-                                             unpaired_bam_file=sorted_unpaired_genome_bam_file,
-                                             cluster_shelve_file=cluster_shelve_file,
-                                             cluster_pair_file=cluster_pair_file,
-                                             breakpoint_bam_file=breakpoint_bam_file,
-                                             log_dir=log_dir,
-                                             tmp_dir=tmp_dir,
-                                             num_processors=runconfig.num_processors,
-                                             local_anchor_length=runconfig.local_anchor_length,
-                                             local_multihits=runconfig.local_multihits)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            for f in output_files:
-                if os.path.exists(f):
-                    os.remove(f)
+    def breakpoint_realign_stage(num_processors):
+        return realign_across_breakpoints(index_dir=runconfig.index_dir,
+                                          discordant_bam_file=sorted_discordant_genome_bam_file,
+                                          unpaired_bam_file=sorted_unpaired_genome_bam_file,
+                                          cluster_shelve_file=cluster_shelve_file,
+                                          cluster_pair_file=cluster_pair_file,
+                                          breakpoint_bam_file=breakpoint_bam_file,
+                                          log_dir=log_dir,
+                                          tmp_dir=tmp_dir,
+                                          num_processors=num_processors,
+                                          local_anchor_length=runconfig.local_anchor_length,
+                                          local_multihits=runconfig.local_multihits)
+    stages.append(Stage("breakpoint_realign",
+                        "Realigning to find breakpoint-spanning reads",
+                        breakpoint_realign_stage,
+                        inputs=(sorted_discordant_genome_bam_file,
+                                sorted_discordant_bam_index_file,
+                                sorted_unpaired_genome_bam_file,
+                                sorted_unpaired_bam_index_file,
+                                cluster_shelve_file,
+                                cluster_pair_file),
+                        outputs=(breakpoint_bam_file,),
+                        params={'index_dir': runconfig.index_dir,
+                                'local_anchor_length': runconfig.local_anchor_length,
+                                'local_multihits': runconfig.local_multihits},
+                        num_processors=runconfig.num_processors,
+                        min_processors=2))
     #
     # Nominate breakpoint spanning reads (split reads)
     #
     spanning_sam_file = os.path.join(tmp_dir, config.SPANNING_SAM_FILE)
     spanning_bam_file = os.path.join(tmp_dir, config.SPANNING_BAM_FILE)
     spanning_cluster_pair_file = os.path.join(tmp_dir, config.SPANNING_CLUSTER_PAIR_FILE)
-    msg = "Processing breakpoint-spanning alignments"
-    input_files = (breakpoint_bam_file,
-                   cluster_shelve_file, 
-                   cluster_pair_file)
-    output_files = (spanning_bam_file,
-                    spanning_cluster_pair_file)
-    skip = True
-    for inp in input_files:
-        for outp in output_files:
-            if not up_to_date(outp, inp):
-                skip = False
-    if skip:
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
+    def spanning_stage(num_processors):
         retcode = process_spanning_alignments(cluster_shelve_file=cluster_shelve_file,
                                               cluster_pair_file=cluster_pair_file,
-                                              bam_file=breakpoint_bam_file,                                              
+                                              bam_file=breakpoint_bam_file,
                                               output_sam_file=spanning_sam_file,
                                               output_cluster_pair_file=spanning_cluster_pair_file,
                                               local_anchor_length=runconfig.local_anchor_length)
         if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            for f in output_files:
-                if os.path.exists(f):
-                    os.remove(f)
+            if os.path.exists(spanning_sam_file):
+                os.remove(spanning_sam_file)
+            return retcode
         retcode = sam_to_bam(spanning_sam_file, spanning_bam_file)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(spanning_bam_file):
-                os.remove(spanning_bam_file)
-            return config.JOB_ERROR
         if os.path.exists(spanning_sam_file):
             os.remove(spanning_sam_file)
+        return retcode
+    stages.append(Stage("process_spanning",
+                        "Processing breakpoint-spanning alignments",
+                        spanning_stage,
+                        inputs=(breakpoint_bam_file,
+                                cluster_shelve_file,
+                                cluster_pair_file),
+                        outputs=(spanning_bam_file,
+                                 spanning_cluster_pair_file),
+                        params={'local_anchor_length': runconfig.local_anchor_length}))
     #
-    # Sort unpaired reads by position
+    # Sort spanning reads by position
     #
-    msg = "Sorting spanning BAM file"
     sorted_spanning_bam_file = os.path.join(runconfig.output_dir, config.SORTED_SPANNING_BAM_FILE)
-    if (up_to_date(sorted_spanning_bam_file, spanning_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        bam_prefix = os.path.splitext(sorted_spanning_bam_file)[0]
-        pysam.sort("-m", str(int(1e9)), spanning_bam_file, bam_prefix)
+    stages.append(Stage("sort_spanning", "Sorting spanning BAM file",
+                        _sort_bam_stage(spanning_bam_file,
+                                        scratch_output(sorted_spanning_bam_file),
+                                        planner.sort_memory()),
+                        inputs=(spanning_bam_file,),
+                        outputs=(sorted_spanning_bam_file,),
+                        promote=promote(sorted_spanning_bam_file)))
     #
     # Index BAM file
     #
-    msg = "Indexing spanning BAM file"
     sorted_spanning_bam_index_file = sorted_spanning_bam_file + ".bai"
-    if (up_to_date(sorted_spanning_bam_index_file, sorted_spanning_bam_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        pysam.index(sorted_spanning_bam_file)
+    stages.append(Stage("index_spanning", "Indexing spanning BAM file",
+                        _index_bam_stage(sorted_spanning_bam_file),
+                        inputs=(sorted_spanning_bam_file,),
+                        outputs=(sorted_spanning_bam_index_file,)))
     #
     # Write chimera file
-    # 
-    unfiltered_chimera_bedpe_file = os.path.join(runconfig.output_dir, 
+    #
+    unfiltered_chimera_bedpe_file = os.path.join(runconfig.output_dir,
                                                  config.UNFILTERED_CHIMERA_BEDPE_FILE)
-    msg = "Writing unfiltered chimeras to file %s" % (unfiltered_chimera_bedpe_file)
-    if (up_to_date(unfiltered_chimera_bedpe_file, spanning_cluster_pair_file) and
-        up_to_date(unfiltered_chimera_bedpe_file, cluster_shelve_file)):                
-        logging.info("[SKIPPED] %s" % (msg))
-    else:
-        logging.info(msg)
-        retcode = write_output(transcripts, 
-                               cluster_shelve_file=cluster_shelve_file, 
-                               cluster_pair_file=spanning_cluster_pair_file, 
-                               read_name_file=read_name_file, 
-                               output_file=unfiltered_chimera_bedpe_file, 
-                               annotation_source="ensembl")
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(unfiltered_chimera_bedpe_file):
-                os.remove(unfiltered_chimera_bedpe_file)
+    # original names of the reads supporting each chimera
+    chimera_reads_file = os.path.join(runconfig.output_dir,
+                                      config.CHIMERA_READS_FILE)
+    def write_output_stage(num_processors):
+        return write_output(transcripts,
+                            cluster_shelve_file=cluster_shelve_file,
+                            cluster_pair_file=spanning_cluster_pair_file,
+                            read_name_file=read_name_file,
+                            output_file=scratch_output(unfiltered_chimera_bedpe_file),
+                            annotation_source="ensembl",
+                            genome_transcript_trees=index_data.genome_transcript_trees,
+                            multiplicity_file=multiplicity_file,
+                            chimera_reads_file=scratch_output(chimera_reads_file))
+    stages.append(Stage("write_output",
+                        "Writing unfiltered chimeras to file %s" %
+                        (unfiltered_chimera_bedpe_file),
+                        write_output_stage,
+                        inputs=(spanning_cluster_pair_file,
+                                cluster_shelve_file,
+                                read_name_file,
+                                transcript_file) + tuple(multiplicity_files),
+                        outputs=(unfiltered_chimera_bedpe_file,
+                                 chimera_reads_file),
+                        params={'annotation_source': "ensembl"},
+                        promote=promote(unfiltered_chimera_bedpe_file,
+                                        chimera_reads_file)))
     #
     # Filter chimeras
     #
     chimera_bedpe_file = os.path.join(runconfig.output_dir, config.CHIMERA_BEDPE_FILE)
-    msg = "Filtering chimeras"
-    if (up_to_date(chimera_bedpe_file, unfiltered_chimera_bedpe_file)):
-        logging.info("[SKIPPED] %s" % (msg))
-    else:        
-        logging.info(msg)
-        retcode = filter_chimeras(input_file=unfiltered_chimera_bedpe_file, 
-                                  output_file=chimera_bedpe_file,
-                                  filter_num_frags=runconfig.filter_num_frags,
-                                  filter_allele_fraction=runconfig.filter_allele_fraction,
-                                  mask_biotypes=mask_biotypes,
-                                  mask_rnames=mask_rnames)
-        if retcode != config.JOB_SUCCESS:
-            logging.error("[FAILED] %s" % (msg))
-            if os.path.exists(chimera_bedpe_file):
-                os.remove(chimera_bedpe_file)
+    def filter_stage(num_processors):
+        return filter_chimeras(input_file=unfiltered_chimera_bedpe_file,
+                               output_file=scratch_output(chimera_bedpe_file),
+                               filter_num_frags=runconfig.filter_num_frags,
+                               filter_allele_fraction=runconfig.filter_allele_fraction,
+                               mask_biotypes=mask_biotypes,
+                               mask_rnames=mask_rnames)
+    stages.append(Stage("filter_chimeras", "Filtering chimeras",
+                        filter_stage,
+                        inputs=(unfiltered_chimera_bedpe_file,),
+                        outputs=(chimera_bedpe_file,),
+                        promote=promote(chimera_bedpe_file),
+                        params={'filter_num_frags': runconfig.filter_num_frags,
+                                'filter_allele_fraction': runconfig.filter_allele_fraction,
+                                'mask_biotypes': sorted(mask_biotypes),
+                                'mask_rnames': sorted(mask_rnames)}))
+    #
+    # Run the pipeline
+    #
+    # stage manifests record input/output checksums and parameters
+    # so that reruns only recompute stages that are no longer valid
+    manifest_dir = os.path.join(runconfig.output_dir, config.STAGE_MANIFEST_DIR)
+    cache = StageCache(manifest_dir, base_dir=runconfig.output_dir)
+    # stages without their own estimate reserve one share of the
+    # memory budget per processor
+    for stage in stages:
+        if stage.memory == 0:
+            stage.memory = planner.slot_memory * stage.num_processors
+    # with --rm-tmp intermediate files are deleted as soon as the last
+    # stage that reads them finishes
+    release_files = None
+    if not runconfig.keep_tmp:
+        release_files = [f for stage in stages for f in stage.outputs
+                         if os.path.abspath(f).startswith(os.path.abspath(tmp_dir) + os.sep)]
+    scheduler = StageScheduler(stages, runconfig.num_processors, cache=cache,
+                               max_memory=planner.memory,
+                               release_files=release_files,
+                               scratch_dir=tmp_dir)
+    retcode = scheduler.run()
+    logging.info("Peak temporary disk usage: %s" %
+                 (format_memory_size(scheduler.peak_scratch)))
+    # per-stage wall time, cpu, memory, and i/o usage
+    profile_file = os.path.join(runconfig.output_dir, config.STAGE_PROFILE_FILE)
+    logging.info("Writing stage resource profile to: %s" % (profile_file))
+    scheduler.write_profile(profile_file)
+    if retcode != config.JOB_SUCCESS:
+        logging.error("Pipeline failed, aborting.")
+        return config.JOB_ERROR
     #
     # Cleanup
-    # 
+    #
     if not runconfig.keep_tmp:
         logging.info("Cleaning up temporary files")
         shutil.rmtree(tmp_dir)
     #
     # Done
-    # 
+    #
     logging.info("Finished run.")
     return config.JOB_SUCCESS
 
@@ -0,0 +1,192 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Writes BAM files with multithreaded compression or in sorted order
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import sys
+import heapq
+import logging
+import tempfile
+import subprocess
+
+import pysam
+
+from chimerascan.lib import config
+
+import chimerascan.pipeline
+
+_pipeline_dir = chimerascan.pipeline.__path__[0]
+
+# processors per extra BAM compression thread when a stage shares its
+# processors between an aligner and the BAM writer
+PROCESSORS_PER_COMPRESSION_THREAD = 4
+
+# whether samtools supports threaded 'view' (samtools 1.0 and later),
+# checked the first time it is needed
+_samtools_threads = None
+
+def samtools_supports_threads():
+    global _samtools_threads
+    if _samtools_threads is None:
+        devnullfh = open(os.devnull, "w")
+        try:
+            retcode = subprocess.call([config.SAMTOOLS_BIN, "--version"],
+                                      stdout=devnullfh, stderr=devnullfh)
+            _samtools_threads = (retcode == 0)
+        except OSError:
+            _samtools_threads = False
+        devnullfh.close()
+        if not _samtools_threads:
+            logging.debug("samtools 1.0 or later not found, BAM files will "
+                          "be written with pysam")
+    return _samtools_threads
+
+def compression_threads(num_processors):
+    """
+    number of compression threads given to the BAM writer of a stage
+    that runs on 'num_processors' processors
+    """
+    return max(1, num_processors // PROCESSORS_PER_COMPRESSION_THREAD)
+
+def samtools_sam_to_bam_args(input_sam_file, output_bam_file, num_threads=1):
+    """
+    samtools command line that compresses a SAM file (or '-' for stdin)
+    to BAM using 'num_threads' threads, or None if samtools cannot do it
+    """
+    if not samtools_supports_threads():
+        return None
+    return [config.SAMTOOLS_BIN, "view", "-b",
+            "-@", str(max(0, num_threads - 1)),
+            "-o", output_bam_file, input_sam_file]
+
+def start_bam_writer(stdin, bam_file, stderr, num_threads=1):
+    """
+    starts a process that reads SAM text from 'stdin' and writes it to
+    'bam_file'.  the records are passed unchanged to samtools when it is
+    available and otherwise to the sam_to_bam.py script.  returns a
+    tuple with the subprocess.Popen object and the name of the program
+    """
+    args = samtools_sam_to_bam_args("-", bam_file, num_threads)
+    name = "samtools_view"
+    if args is None:
+        py_script = os.path.join(_pipeline_dir, "sam_to_bam.py")
+        args = [sys.executable, py_script, "-", bam_file]
+        name = "sam_to_bam"
+    logging.debug("SAM to BAM converter args: %s" % (' '.join(args)))
+    # other pipes are not inherited so that their readers see the end
+    # of the input when the writers close them
+    p = subprocess.Popen(args, stdin=stdin, stderr=stderr, close_fds=True)
+    return p, name
+
+def coordinate_sort_key(r):
+    """
+    sort key that orders reads as 'samtools sort' does, with the reads
+    that have no reference last
+    """
+    if r.tid < 0:
+        return (sys.maxint, r.pos)
+    return (r.tid, r.pos)
+
+class SortingBamWriter(object):
+    """
+    writes reads to a coordinate sorted BAM file.  reads are held and
+    sorted in memory 'buffer_size' at a time, and when there are more
+    each sorted batch is spilled to a temporary BAM file in 'tmp_dir'.
+    the batches are merged into 'bam_file' when the writer is closed.
+    reads with the same position keep the order they were written in
+    """
+    def __init__(self, bam_file, header, buffer_size, tmp_dir=None):
+        self.bam_file = bam_file
+        self.header = dict(header)
+        hd = dict(self.header.get('HD', {'VN': '1.0'}))
+        hd['SO'] = 'coordinate'
+        self.header['HD'] = hd
+        self.buffer_size = max(1, buffer_size)
+        self.tmp_dir = tmp_dir
+        self.buf = []
+        self.chunk_files = []
+
+    def write(self, r):
+        self.buf.append(r)
+        if len(self.buf) >= self.buffer_size:
+            self._spill()
+
+    def _spill(self):
+        self.buf.sort(key=coordinate_sort_key)
+        fd, chunk_file = tempfile.mkstemp(suffix=".bam", prefix="tmp", 
+                                          dir=self.tmp_dir)
+        os.close(fd)
+        self.chunk_files.append(chunk_file)
+        outfh = pysam.Samfile(chunk_file, "wb", header=self.header)
+        for r in self.buf:
+            outfh.write(r)
+        outfh.close()
+        self.buf = []
+
+    def _iter_chunk(self, i):
+        infh = pysam.Samfile(self.chunk_files[i], "rb")
+        for n,r in enumerate(infh):
+            yield coordinate_sort_key(r), i, n, r
+        infh.close()
+
+    def close(self):
+        try:
+            outfh = pysam.Samfile(self.bam_file, "wb", header=self.header)
+            if len(self.chunk_files) == 0:
+                self.buf.sort(key=coordinate_sort_key)
+                for r in self.buf:
+                    outfh.write(r)
+            else:
+                if len(self.buf) > 0:
+                    self._spill()
+                logging.debug("Merging %d sorted batches of reads" % 
+                              (len(self.chunk_files)))
+                chunk_iters = [self._iter_chunk(i) 
+                               for i in xrange(len(self.chunk_files))]
+                for key,i,n,r in heapq.merge(*chunk_iters):
+                    outfh.write(r)
+            outfh.close()
+        finally:
+            self.buf = []
+            for f in self.chunk_files:
+                if os.path.exists(f):
+                    os.remove(f)
+            self.chunk_files = []
+
+def concatenate_bam_files(bam_files, output_bam_file):
+    """
+    concatenates BAM files that share a header into 'output_bam_file',
+    keeping the order of the files and of the reads within them.  the
+    compressed blocks are copied by 'samtools cat' when it is available
+    """
+    if samtools_supports_threads():
+        args = [config.SAMTOOLS_BIN, "cat", "-o", output_bam_file] + list(bam_files)
+        logging.debug("BAM concatenation args: %s" % (' '.join(args)))
+        if subprocess.call(args) == 0:
+            return config.JOB_SUCCESS
+        logging.error("samtools cat failed")
+        return config.JOB_ERROR
+    infh = pysam.Samfile(bam_files[0], "rb")
+    outfh = pysam.Samfile(output_bam_file, "wb", template=infh)
+    infh.close()
+    for bam_file in bam_files:
+        infh = pysam.Samfile(bam_file, "rb")
+        for r in infh:
+            outfh.write(r)
+        infh.close()
+    outfh.close()
+    return config.JOB_SUCCESS
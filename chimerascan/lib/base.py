@@ -21,11 +21,14 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 import os
+import errno
+import shutil
 import subprocess
 import tempfile
 import gzip
 import bz2
 import zipfile
+from distutils.spawn import find_executable
 
 #
 # constants used for library type
@@ -47,6 +50,16 @@ class LibraryTypes:
 
 imin2 = lambda a,b: a if a <= b else b
 
+# external programs used to compress output files and to decompress
+# input files
+GZIP_BIN = "gzip"
+PIGZ_BIN = "pigz"
+BGZIP_BIN = "bgzip"
+BZIP2_BIN = "bzip2"
+PBZIP2_BIN = "pbzip2"
+# read-ahead buffer for the output of decompression processes
+DECOMPRESS_BUFFER_SIZE = 1 << 20
+
 def detect_format(f):
     if f.endswith(".gz") or f.endswith(".z"):
         return "gz"
@@ -57,8 +70,111 @@ def detect_format(f):
     else:
         return "txt"
 
-def open_compressed(f):    
-    compression_format = detect_format(f)    
+def is_bgzf(f):
+    """
+    checks for the BGZF block header written by bgzip and samtools
+    """
+    fh = open(f, "rb")
+    header = fh.read(16)
+    fh.close()
+    return ((len(header) == 16) and (header[:4] == "\x1f\x8b\x08\x04") and
+            (header[12:14] == "BC"))
+
+def _decompress_command(f, compression_format, num_threads):
+    """
+    returns the external command that decompresses 'f' to stdout using 
+    the fastest decompressor found on the PATH, or None
+    """
+    if compression_format == "gz":
+        # BGZF blocks are independent and are inflated in parallel 
+        # by bgzip, while pigz offloads reading and checksums
+        if find_executable(BGZIP_BIN) and is_bgzf(f):
+            return [BGZIP_BIN, "-d", "-c", "-@", str(num_threads), f]
+        if find_executable(PIGZ_BIN):
+            return [PIGZ_BIN, "-d", "-c", "-p", str(num_threads), f]
+        if find_executable(GZIP_BIN):
+            return [GZIP_BIN, "-d", "-c", f]
+    elif compression_format == "bz2":
+        if find_executable(PBZIP2_BIN):
+            return [PBZIP2_BIN, "-d", "-c", "-p%d" % (num_threads), f]
+        if find_executable(BZIP2_BIN):
+            return [BZIP2_BIN, "-d", "-c", f]
+    return None
+
+class PipedDecompressFile(object):
+    """
+    read-only file object over the output of an external decompression
+    process.  decompression runs on other processors while the caller
+    parses lines, and the pipe is read through a large buffer
+    """
+    def __init__(self, filename, args, bufsize=DECOMPRESS_BUFFER_SIZE):
+        self.name = filename
+        self._args = args
+        self._p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                   bufsize=bufsize, close_fds=True)
+        self._fh = self._p.stdout
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self._fh.readline()
+        if not line:
+            self._finish()
+            raise StopIteration
+        return line
+
+    def read(self, size=-1):
+        data = self._fh.read(size)
+        if (not data) and (size != 0):
+            self._finish()
+        return data
+
+    def readline(self):
+        line = self._fh.readline()
+        if not line:
+            self._finish()
+        return line
+
+    def _finish(self):
+        # the whole stream was read so the decompressor must have 
+        # succeeded, otherwise the input was truncated or corrupt
+        if self._p is None:
+            return
+        retcode = self._p.wait()
+        self._fh.close()
+        self._p = None
+        if retcode != 0:
+            raise IOError("%s exited with code %d while reading %s" % 
+                          (self._args[0], retcode, self.name))
+
+    def close(self):
+        if self._p is None:
+            return
+        # closing the pipe early stops the decompressor
+        self._fh.close()
+        if self._p.poll() is None:
+            try:
+                self._p.terminate()
+            except OSError:
+                pass
+        self._p.wait()
+        self._p = None
+
+def open_compressed(f, num_threads=1):
+    """
+    opens a possibly compressed file for reading.  gzip and bzip2 files
+    are decompressed by an external process using up to 'num_threads'
+    threads when one is available
+    """
+    compression_format = detect_format(f)
+    if compression_format in ("gz", "bz2"):
+        args = _decompress_command(f, compression_format, max(1, num_threads))
+        if args is not None:
+            try:
+                return PipedDecompressFile(f, args)
+            except OSError:
+                pass
     if compression_format == "gz":
         fh = gzip.open(f, "r")
     elif compression_format == "bz2":
@@ -69,6 +185,46 @@ def open_compressed(f):
         fh = open(f, "r")
     return fh
 
+class PipedGzipFile(object):
+    """
+    write-only file object that compresses data with an external gzip
+    process so that compression runs on a separate processor
+    """
+    def __init__(self, filename, compresslevel=1):
+        self.name = filename
+        self._outfh = open(filename, "wb")
+        try:
+            self._p = subprocess.Popen([GZIP_BIN, "-c", "-%d" % (compresslevel)],
+                                       stdin=subprocess.PIPE, 
+                                       stdout=self._outfh, close_fds=True)
+        except OSError:
+            self._outfh.close()
+            raise
+
+    def write(self, s):
+        self._p.stdin.write(s)
+
+    def close(self):
+        if self._p is None:
+            return
+        self._p.stdin.close()
+        retcode = self._p.wait()
+        self._outfh.close()
+        self._p = None
+        if retcode != 0:
+            raise IOError("%s exited with code %d while writing %s" % 
+                          (GZIP_BIN, retcode, self.name))
+
+def open_compressed_writer(f, compresslevel=1):
+    """
+    opens a gzip file for writing, compressing in a separate gzip process
+    when one can be started
+    """
+    try:
+        return PipedGzipFile(f, compresslevel)
+    except OSError:
+        return gzip.open(f, "wb", compresslevel)
+
 def parse_lines(line_iter, numlines=1):
     """
     generator that returns list of 'numlines' lines at a time
@@ -85,11 +241,48 @@ def parse_bool(s):
 def parse_string_none(s):
     return None if s == "None" else s
 
+_MEMORY_SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+def parse_memory_size(s):
+    """
+    converts a memory size such as '512M' or '16G' to a number of bytes.
+    sizes without a suffix are in bytes
+    """
+    s = str(s).strip().lower()
+    if s.endswith('b'):
+        s = s[:-1]
+    if len(s) > 0 and s[-1] in _MEMORY_SIZE_SUFFIXES:
+        return int(float(s[:-1]) * _MEMORY_SIZE_SUFFIXES[s[-1]])
+    return int(float(s))
+
 def make_temp(base_dir, suffix=''):
     fd,name = tempfile.mkstemp(suffix=suffix, prefix='tmp', dir=base_dir)
     os.close(fd)
     return name
 
+def promote_file(src, dst):
+    """
+    moves 'src' to 'dst' so that 'dst' appears complete or not at all.
+    files on another filesystem are first copied next to 'dst' and then
+    renamed into place
+    """
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp_dst = os.path.join(os.path.dirname(dst), 
+                           ".%s.part" % (os.path.basename(dst)))
+    try:
+        shutil.copyfile(src, tmp_dst)
+        os.rename(tmp_dst, dst)
+    except:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+        raise
+    os.remove(src)
+
 def check_executable(filename):
     # check that samtools binary exists
     devnullfh = open(os.devnull, 'w')        
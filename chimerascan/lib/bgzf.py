@@ -0,0 +1,144 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Scans the BGZF blocks of BAM files for record offsets without decoding
+the alignments
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import bisect
+import struct
+import zlib
+
+# gzip member header up to and including the extra field length
+BGZF_HEADER = struct.Struct("<BBBBIBBH")
+BGZF_SUBFIELD = struct.Struct("<BBH")
+# gzip trailer holding the crc32 and uncompressed size
+BGZF_TRAILER_SIZE = 8
+BAM_MAGIC = "BAM\1"
+INT32 = struct.Struct("<i")
+# position of the read name length and the read name within a BAM
+# record, after its length field
+BAM_READ_NAME_LENGTH_OFFSET = 8
+BAM_READ_NAME_OFFSET = 32
+
+def iter_bgzf_blocks(fh):
+    """
+    generator of (file offset, uncompressed data) tuples for the BGZF
+    blocks of file object 'fh'
+    """
+    coffset = 0
+    while True:
+        header = fh.read(BGZF_HEADER.size)
+        if not header:
+            break
+        if len(header) < BGZF_HEADER.size:
+            raise ValueError("truncated BGZF block at offset %d" % (coffset))
+        id1, id2, cm, flg, mtime, xfl, os_type, xlen = BGZF_HEADER.unpack(header)
+        if (id1, id2, cm, flg) != (31, 139, 8, 4):
+            raise ValueError("invalid BGZF block at offset %d" % (coffset))
+        extra = fh.read(xlen)
+        bsize = None
+        pos = 0
+        while pos + BGZF_SUBFIELD.size <= len(extra):
+            si1, si2, slen = BGZF_SUBFIELD.unpack_from(extra, pos)
+            if (si1, si2, slen) == (66, 67, 2):
+                bsize = struct.unpack_from("<H", extra, pos + BGZF_SUBFIELD.size)[0]
+            pos += BGZF_SUBFIELD.size + slen
+        if bsize is None:
+            raise ValueError("BGZF block at offset %d has no size" % (coffset))
+        cdata = fh.read(bsize + 1 - BGZF_HEADER.size - xlen - BGZF_TRAILER_SIZE)
+        fh.read(BGZF_TRAILER_SIZE)
+        yield coffset, zlib.decompress(cdata, -15)
+        coffset += bsize + 1
+
+class _BlockBuffer(object):
+    """
+    uncompressed data of consecutive BGZF blocks that keeps the file
+    offset of each block to compute virtual offsets
+    """
+    def __init__(self, fh):
+        self.blocks = iter_bgzf_blocks(fh)
+        self.data = ''
+        self.pos = 0
+        # positions in 'data' and file offsets of the blocks in 'data'
+        self.block_starts = []
+        self.block_offsets = []
+
+    def _discard(self):
+        # drop the blocks that end before the current position
+        i = bisect.bisect_right(self.block_starts, self.pos) - 1
+        if i <= 0:
+            return
+        shift = self.block_starts[i]
+        self.data = self.data[shift:]
+        self.pos -= shift
+        self.block_starts = [s - shift for s in self.block_starts[i:]]
+        self.block_offsets = self.block_offsets[i:]
+
+    def fill(self, n):
+        """
+        reads blocks until 'n' bytes follow the current position and
+        returns False if the file ends first
+        """
+        while len(self.data) - self.pos < n:
+            try:
+                coffset, data = self.blocks.next()
+            except StopIteration:
+                return False
+            if len(data) == 0:
+                continue
+            self._discard()
+            self.block_starts.append(len(self.data))
+            self.block_offsets.append(coffset)
+            self.data += data
+        return True
+
+    def read(self, n):
+        if not self.fill(n):
+            raise ValueError("truncated BAM file")
+        data = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def tell(self):
+        """virtual offset of the current position"""
+        i = bisect.bisect_right(self.block_starts, self.pos) - 1
+        return (self.block_offsets[i] << 16) | (self.pos - self.block_starts[i])
+
+def iter_bam_read_names(filename):
+    """
+    generator of (virtual offset, read name) tuples for the records of
+    BAM file 'filename'.  the offsets can be passed to the seek method
+    of pysam.Samfile
+    """
+    fh = open(filename, "rb")
+    buf = _BlockBuffer(fh)
+    if buf.read(4) != BAM_MAGIC:
+        fh.close()
+        raise ValueError("%s is not a BAM file" % (filename))
+    l_text, = INT32.unpack(buf.read(4))
+    buf.read(l_text)
+    n_ref, = INT32.unpack(buf.read(4))
+    for i in xrange(n_ref):
+        l_name, = INT32.unpack(buf.read(4))
+        buf.read(l_name + 4)
+    while buf.fill(4):
+        offset = buf.tell()
+        block_size, = INT32.unpack(buf.read(4))
+        record = buf.read(block_size)
+        l_read_name = ord(record[BAM_READ_NAME_LENGTH_OFFSET])
+        # the read name is terminated by a NUL character
+        yield offset, record[BAM_READ_NAME_OFFSET:BAM_READ_NAME_OFFSET + l_read_name - 1]
+    fh.close()
@@ -28,6 +28,7 @@ JOB_ERROR = 1
 BOWTIE2_BIN = "bowtie2"
 BOWTIE2_BUILD_BIN = "bowtie2-build"
 BOWTIE2_INSPECT_BIN = "bowtie2-inspect"
+SAMTOOLS_BIN = "samtools"
 
 # constants for index
 TRANSCRIPTOME_INDEX = 'transcriptome'
@@ -39,13 +40,20 @@ BOWTIE2_INDEX_FILE_EXTS = ('.1.bt2', '.2.bt2', '.3.bt2', '.4.bt2', '.rev.1.bt2',
 GENOME_BOWTIE2_FILES = ((GENOME_INDEX + x) for x in BOWTIE2_INDEX_FILE_EXTS)  
 TRANSCRIPTOME_BOWTIE2_FILES = ((TRANSCRIPTOME_INDEX + x) for x in BOWTIE2_INDEX_FILE_EXTS) 
 MAX_MULTIMAPPING_FILE = 'max_multihits.txt'
+GENOME_REFS_FILE = 'genome_refs.txt'
 
 # chimerascan subdirectories
 LOG_DIR = "log"
 TMP_DIR = "tmp"
+STAGE_MANIFEST_DIR = "manifests"
+SHARD_DIR = "shard%03d"
+# final outputs written to the scratch dir before promotion
+SCRATCH_OUTPUT_DIR = "output"
 
 # defaults and constraints for run configuration
 RUNCONFIG_XML_FILE = "runconfig.xml"
+STAGE_PROFILE_FILE = "stage_profile.json"
+PIPE_CALIBRATION_FILE = "pipe_calibration.json"
 BASE_PROCESSORS = 2
 MIN_SEGMENT_LENGTH = 25
 DEFAULT_MIN_FRAG_LENGTH = 0
@@ -55,6 +63,8 @@ DEFAULT_LOCAL_MULTIHITS = 1000
 DEFAULT_LOCAL_ANCHOR_LENGTH = 15
 DEFAULT_FILTER_FRAGS = 2.0
 DEFAULT_FILTER_ALLELE_FRACTION = 0.0
+DEFAULT_SORT_MEMORY = int(1e9)
+DEFAULT_SORT_BUFFER_SIZE = 32000
 
 # default min/max for anchor length
 LOCAL_ANCHOR_LENGTH_MIN = 12
@@ -64,7 +74,10 @@ LOCAL_ANCHOR_LENGTH_MIN = 12
 CONVERTED_FASTQ_PREFIX = "reads"
 CONVERTED_FASTQ_FILES = tuple(CONVERTED_FASTQ_PREFIX + "_%d.fq" % (x+1) 
                               for x in xrange(2))
-READ_NAME_TXT_FILE = CONVERTED_FASTQ_PREFIX + ".txt"
+CONVERTED_FASTQ_GZ_FILES = tuple(f + ".gz" for f in CONVERTED_FASTQ_FILES)
+READ_NAME_FILE = CONVERTED_FASTQ_PREFIX + ".names"
+DUPLICATE_COUNT_FILE = CONVERTED_FASTQ_PREFIX + ".dups"
+INPUT_STATS_FILE = "input_stats.json"
 
 # output from initial alignment
 TRANSCRIPTOME_BAM_FILE = "transcriptome_reads.bam"
@@ -102,13 +115,9 @@ MULTIMAP_BAM_FILE = "realigned_multimap_reads.bam"
 UNRESOLVED_BAM_FILE = "realigned_unresolved_reads.bam"
 
 # unpaired alignment files
-UNPAIRED_GENOME_SAM_FILE = "realigned_unpaired_reads.genome.sam"
-UNPAIRED_GENOME_BAM_FILE = "realigned_unpaired_reads.genome.bam"
 SORTED_UNPAIRED_GENOME_BAM_FILE = "realigned_unpaired_reads.genome.srt.bam"
 
 # discordant pairs files
-DISCORDANT_GENOME_SAM_FILE = "realigned_discordant_pairs.genome.sam"
-DISCORDANT_GENOME_BAM_FILE = "realigned_discordant_pairs.genome.bam"
 SORTED_DISCORDANT_GENOME_BAM_FILE = "realigned_discordant_pairs.genome.srt.bam"
 
 # discordant clusters
@@ -131,3 +140,4 @@ SPANNING_CLUSTER_PAIR_FILE = "spanning_cluster_pairs.txt"
 # output files
 UNFILTERED_CHIMERA_BEDPE_FILE = "chimeras.unfiltered.bedpe"
 CHIMERA_BEDPE_FILE = "chimeras.bedpe"
+CHIMERA_READS_FILE = "chimera_reads.txt"
@@ -0,0 +1,149 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Collapsing of exact duplicate fragments and lookup of their counts
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import sys
+import mmap
+import array
+import struct
+import hashlib
+import logging
+
+# multiplicity of each fragment stored as an unsigned 32-bit integer
+MULTIPLICITY_STRUCT = struct.Struct("<I")
+# approximate memory used by each fragment hash held by DuplicateFilter
+DUPLICATE_ENTRY_BYTES = 256
+
+class DuplicateFilter(object):
+    """
+    keeps the first fragment with each combination of mate sequences
+    and writes how many fragments it represents to 'filename'.
+    fragments that duplicate an earlier one get a count of zero.
+
+    the counts are written as the fragments are seen, so only the
+    hashes of the kept fragments and the counts of the duplicated ones
+    are held in memory.  once 'max_entries' hashes are held, fragments
+    with new sequences are kept without being remembered, which bounds
+    the memory used at the cost of collapsing fewer duplicates
+    """
+    def __init__(self, filename, max_entries=None):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.num_fragments = 0
+        self.num_unique = 0
+        # map sequence hash -> read id of the kept fragment
+        self.representatives = {}
+        # map read id -> count of kept fragments with duplicates
+        self.dup_counts = {}
+        self._fh = open(filename, "w+b")
+
+    def filter(self, seq_lists, first_id):
+        """
+        'seq_lists' holds the sequences of each mate of consecutive
+        fragments starting at read id 'first_id'.  returns the indexes
+        of the fragments to keep
+        """
+        keep = []
+        representatives = self.representatives
+        dup_counts = self.dup_counts
+        counts = array.array("I")
+        full = ((self.max_entries is not None) and 
+                (len(representatives) >= self.max_entries))
+        for i,seqs in enumerate(zip(*seq_lists)):
+            key = hashlib.md5('\t'.join(seqs)).digest()
+            rep_id = representatives.get(key)
+            if rep_id is None:
+                if not full:
+                    representatives[key] = first_id + i
+                    full = ((self.max_entries is not None) and
+                            (len(representatives) >= self.max_entries))
+                    if full:
+                        logging.warning("Duplicate table is full after %d "
+                                        "unique fragments, later fragments "
+                                        "are only collapsed into these" %
+                                        (len(representatives)))
+                counts.append(1)
+                keep.append(i)
+            else:
+                dup_counts[rep_id] = dup_counts.get(rep_id, 1) + 1
+                counts.append(0)
+        if sys.byteorder == "big":
+            counts.byteswap()
+        counts.tofile(self._fh)
+        self.num_fragments += len(counts)
+        self.num_unique += len(keep)
+        return keep
+
+    def close(self):
+        """writes the counts of the duplicated fragments"""
+        if self._fh is None:
+            return
+        self.representatives = {}
+        for rep_id in sorted(self.dup_counts):
+            self._fh.seek((rep_id - 1) * MULTIPLICITY_STRUCT.size)
+            self._fh.write(MULTIPLICITY_STRUCT.pack(self.dup_counts[rep_id]))
+        self.dup_counts = {}
+        self._fh.close()
+        self._fh = None
+
+    def abort(self):
+        """closes and removes a partially written file"""
+        if self._fh is None:
+            return
+        self._fh.close()
+        self._fh = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class FragmentMultiplicity(object):
+    """
+    memory-mapped view of the fragment counts written by DuplicateFilter.
+    looks up the number of input fragments represented by a read id
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = open(filename, "rb")
+        self.num_fragments = os.fstat(self._fh.fileno()).st_size // MULTIPLICITY_STRUCT.size
+        self._mm = None
+        if self.num_fragments > 0:
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, read_id):
+        i = int(read_id) - 1
+        if (i < 0) or (i >= self.num_fragments):
+            raise KeyError(read_id)
+        return MULTIPLICITY_STRUCT.unpack_from(self._mm, i * MULTIPLICITY_STRUCT.size)[0]
+
+    def count(self, read_ids):
+        """total number of fragments represented by 'read_ids'"""
+        return sum(self.get(read_id) for read_id in read_ids)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._fh.close()
+
+def count_fragments(read_ids, multiplicity=None):
+    """
+    number of fragments represented by a collection of unique read ids,
+    which is the number of ids when duplicates were not collapsed
+    """
+    if multiplicity is None:
+        return len(read_ids)
+    return multiplicity.count(read_ids)
@@ -0,0 +1,192 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Reads and writes FASTQ records in large batches
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import random
+import logging
+
+# number of bytes read from a FASTQ file at a time
+FASTQ_READ_SIZE = 1 << 22
+# number of records in each batch
+FASTQ_BATCH_SIZE = 16384
+
+def take(items, indexes):
+    """
+    returns the elements of list 'items' at 'indexes', which is either
+    a slice or a list of positions
+    """
+    if isinstance(indexes, slice):
+        return items[indexes]
+    return [items[i] for i in indexes]
+
+class FASTQBatch(object):
+    """
+    a batch of FASTQ records kept as parallel lists of header lines
+    (including the leading '@'), sequences, and quality strings
+    """
+    __slots__ = ("names", "seqs", "quals")
+    def __init__(self, names, seqs, quals):
+        self.names = names
+        self.seqs = seqs
+        self.quals = quals
+
+    def __len__(self):
+        return len(self.names)
+
+    def subset(self, indexes):
+        """returns a new batch with the records at 'indexes'"""
+        return FASTQBatch(take(self.names, indexes), 
+                          take(self.seqs, indexes),
+                          take(self.quals, indexes))
+
+    def trim(self, trim5, trim3):
+        """removes bases from the 5' and 3' ends of every read"""
+        if (trim5 == 0) and (trim3 == 0):
+            return
+        self.seqs = [s[trim5:max(trim5+1, len(s) - trim3)] for s in self.seqs]
+        self.quals = [q[trim5:max(trim5+1, len(q) - trim3)] for q in self.quals]
+
+    def convert_quals(self, tbl):
+        """
+        converts all quality strings in a single call using a table
+        from seq.get_qual_batch_conversion_table()
+        """
+        self.quals = '\n'.join(self.quals).translate(tbl).split('\n')
+
+    def to_string(self):
+        """returns the batch in FASTQ format"""
+        n = len(self.names)
+        if n == 0:
+            return ''
+        lines = [None] * (4 * n)
+        lines[0::4] = self.names
+        lines[1::4] = self.seqs
+        lines[2::4] = ['+'] * n
+        lines[3::4] = self.quals
+        lines.append('')
+        return '\n'.join(lines)
+
+def parse_fastq_batches(fh, batch_size=FASTQ_BATCH_SIZE,
+                        read_size=FASTQ_READ_SIZE):
+    """
+    generator that parses the FASTQ file object 'fh' and returns
+    FASTQBatch objects of 'batch_size' records (the last batch may be
+    smaller).  the file is read 'read_size' bytes at a time
+    """
+    names = []
+    seqs = []
+    quals = []
+    partial = ''
+    while True:
+        data = fh.read(read_size)
+        if not data:
+            break
+        if '\r' in data:
+            data = data.replace('\r', '')
+        lines = (partial + data).split('\n')
+        # the last line is incomplete and complete records are kept
+        n = ((len(lines) - 1) // 4) * 4
+        partial = '\n'.join(lines[n:])
+        names.extend(lines[0:n:4])
+        seqs.extend(lines[1:n:4])
+        quals.extend(lines[3:n:4])
+        while len(names) >= batch_size:
+            yield FASTQBatch(names[:batch_size], seqs[:batch_size],
+                             quals[:batch_size])
+            del names[:batch_size]
+            del seqs[:batch_size]
+            del quals[:batch_size]
+    # final record may lack a newline
+    lines = partial.split('\n')
+    while lines and (not lines[-1]):
+        lines.pop()
+    if len(lines) >= 4:
+        n = (len(lines) // 4) * 4
+        names.extend(lines[0:n:4])
+        seqs.extend(lines[1:n:4])
+        quals.extend(lines[3:n:4])
+        lines = lines[n:]
+    if len(lines) > 0:
+        logging.warning("Ignoring incomplete FASTQ record at end of file")
+    for i in xrange(0, len(names), batch_size):
+        yield FASTQBatch(names[i:i+batch_size], seqs[i:i+batch_size],
+                         quals[i:i+batch_size])
+
+def next_pe_batches(batch_iters):
+    """
+    returns the next batch of each mate and checks that the mates have
+    the same number of records
+    """
+    batches = [it.next() for it in batch_iters]
+    if any(len(batch) != len(batches[0]) for batch in batches):
+        raise ValueError("FASTQ files have different numbers of reads")
+    return batches
+
+def parse_subsample(s):
+    """
+    interprets a subsample option as either a fraction of fragments
+    (values below 1) or a number of fragments.  returns a tuple
+    (fraction, count) with the unused element set to None
+    """
+    value = float(s)
+    if value <= 0:
+        raise ValueError("subsample must be greater than zero")
+    if value < 1:
+        return value, None
+    if value != int(value):
+        raise ValueError("subsample count must be an integer")
+    return None, int(value)
+
+def subsample_pe_batches(batch_iters, fraction=None, count=None, seed=0):
+    """
+    generator that samples whole fragments from iterators of FASTQBatch
+    objects, one per mate, and returns a list with the batch of each mate.
+    a 'fraction' of fragments is sampled as the batches are read, while
+    'count' fragments are sampled with a reservoir and returned in their
+    original order once the input is exhausted.  the same 'seed' always
+    samples the same fragments
+    """
+    rng = random.Random(seed)
+    if count is None:
+        while True:
+            batches = next_pe_batches(batch_iters)
+            keep = [i for i in xrange(len(batches[0])) if rng.random() < fraction]
+            yield [batch.subset(keep) for batch in batches]
+    # reservoir of (fragment index, records of each mate)
+    reservoir = []
+    seen = 0
+    try:
+        while True:
+            batches = next_pe_batches(batch_iters)
+            for i in xrange(len(batches[0])):
+                if seen < count:
+                    j = seen
+                    reservoir.append(None)
+                else:
+                    j = rng.randint(0, seen)
+                if j < count:
+                    reservoir[j] = (seen, [(b.names[i], b.seqs[i], b.quals[i]) 
+                                           for b in batches])
+                seen += 1
+    except StopIteration:
+        pass
+    reservoir.sort()
+    num_mates = len(batch_iters)
+    for start in xrange(0, len(reservoir), FASTQ_BATCH_SIZE):
+        records = [recs for index,recs in reservoir[start:start+FASTQ_BATCH_SIZE]]
+        yield [FASTQBatch(*[list(x) for x in zip(*[recs[m] for recs in records])])
+               for m in xrange(num_mates)]
@@ -0,0 +1,165 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Statistics of the input reads collected while they are converted
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import json
+import collections
+
+from chimerascan.lib.seq import SANGER_FORMAT, SOLEXA_FORMAT, ILLUMINA_FORMAT
+
+# lowest quality character of each quality score format
+QUAL_FORMAT_MIN_CHAR = {SANGER_FORMAT: 33,
+                        SOLEXA_FORMAT: 59,
+                        ILLUMINA_FORMAT: 64}
+BASES = "ACGTN"
+
+def detect_qual_format(min_qual, max_qual):
+    """
+    guesses the quality score format from the range of quality
+    characters observed, or returns None if nothing was observed
+    """
+    if min_qual is None:
+        return None
+    if min_qual < QUAL_FORMAT_MIN_CHAR[SOLEXA_FORMAT]:
+        return SANGER_FORMAT
+    if min_qual < QUAL_FORMAT_MIN_CHAR[ILLUMINA_FORMAT]:
+        return SOLEXA_FORMAT
+    return ILLUMINA_FORMAT
+
+class MateStats(object):
+    """
+    read length histogram, quality character range and base counts of
+    the reads of one mate
+    """
+    def __init__(self):
+        self.num_reads = 0
+        self.length_hist = collections.Counter()
+        self.min_qual = None
+        self.max_qual = None
+        self.base_counts = dict((b, 0) for b in BASES)
+        self.num_bases = 0
+
+    def update(self, seqs, quals):
+        if len(seqs) == 0:
+            return
+        self.num_reads += len(seqs)
+        self.length_hist.update(len(s) for s in seqs)
+        qual_string = ''.join(quals)
+        if qual_string:
+            lo = ord(min(qual_string))
+            hi = ord(max(qual_string))
+            self.min_qual = lo if self.min_qual is None else min(self.min_qual, lo)
+            self.max_qual = hi if self.max_qual is None else max(self.max_qual, hi)
+        seq_string = ''.join(seqs).upper()
+        self.num_bases += len(seq_string)
+        for b in BASES:
+            self.base_counts[b] += seq_string.count(b)
+
+    @property
+    def n_rate(self):
+        if self.num_bases == 0:
+            return 0.0
+        return self.base_counts['N'] / float(self.num_bases)
+
+    def to_dict(self):
+        return {'num_reads': self.num_reads,
+                'length_hist': dict((str(k), v) for k,v in self.length_hist.iteritems()),
+                'min_qual': self.min_qual,
+                'max_qual': self.max_qual,
+                'qual_format': detect_qual_format(self.min_qual, self.max_qual),
+                'base_counts': self.base_counts,
+                'num_bases': self.num_bases,
+                'n_rate': self.n_rate}
+
+    @staticmethod
+    def from_dict(d):
+        m = MateStats()
+        m.num_reads = d['num_reads']
+        m.length_hist = collections.Counter(dict((int(k), v) for k,v in d['length_hist'].iteritems()))
+        m.min_qual = d['min_qual']
+        m.max_qual = d['max_qual']
+        m.base_counts = d['base_counts']
+        m.num_bases = d['num_bases']
+        return m
+
+class InputStats(object):
+    """
+    statistics of the reads of every mate, updated one batch at a time
+    """
+    def __init__(self, num_mates=2):
+        self.mates = [MateStats() for x in xrange(num_mates)]
+
+    def update(self, mate, batch):
+        self.mates[mate].update(batch.seqs, batch.quals)
+
+    @property
+    def num_fragments(self):
+        return self.mates[0].num_reads
+
+    @property
+    def min_qual(self):
+        quals = [m.min_qual for m in self.mates if m.min_qual is not None]
+        return min(quals) if quals else None
+
+    @property
+    def max_qual(self):
+        quals = [m.max_qual for m in self.mates if m.max_qual is not None]
+        return max(quals) if quals else None
+
+    def qual_format(self):
+        return detect_qual_format(self.min_qual, self.max_qual)
+
+    def length_hist(self):
+        hist = collections.Counter()
+        for m in self.mates:
+            hist.update(m.length_hist)
+        return hist
+
+    def read_lengths(self):
+        return sorted(self.length_hist())
+
+    def modal_read_length(self):
+        """most common read length across mates, or None if no reads"""
+        hist = self.length_hist()
+        if len(hist) == 0:
+            return None
+        return max(hist.iteritems(), key=lambda x: (x[1], x[0]))[0]
+
+    def trimmed_read_length(self, trim5, trim3):
+        """
+        most common read length after removing 'trim5' and 'trim3' 
+        bases, or None if no reads
+        """
+        read_length = self.modal_read_length()
+        if read_length is None:
+            return None
+        return max(1, read_length - trim5 - trim3)
+
+    def to_file(self, filename):
+        fh = open(filename, "w")
+        json.dump({'num_fragments': self.num_fragments,
+                   'qual_format': self.qual_format(),
+                   'mates': [m.to_dict() for m in self.mates]},
+                  fh, indent=2, sort_keys=True)
+        fh.close()
+
+    @staticmethod
+    def from_file(filename):
+        d = json.load(open(filename))
+        stats = InputStats(num_mates=0)
+        stats.mates = [MateStats.from_dict(m) for m in d['mates']]
+        return stats
@@ -0,0 +1,169 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Binary store of the original read names indexed by numeric read id
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import mmap
+import zlib
+import struct
+
+# the file holds blocks of read names followed by a table of the
+# offsets of the blocks and a fixed size footer:
+#   magic, version, flags, names per block, number of names,
+#   offset of the block table
+READ_NAME_MAGIC = "CSRN"
+READ_NAME_VERSION = 1
+READ_NAME_FOOTER = struct.Struct("<4sIIIQQ")
+READ_NAME_OFFSET = struct.Struct("<Q")
+FLAG_ZLIB = 0x1
+# names per block when blocks are compressed
+COMPRESSED_BLOCK_SIZE = 256
+
+class ReadNameWriter(object):
+    """
+    writes read names in the order of their numeric read ids.  names
+    are stored one per block, or 'block_size' per zlib compressed
+    block when 'compress' is set
+    """
+    def __init__(self, filename, compress=False, block_size=COMPRESSED_BLOCK_SIZE):
+        self.filename = filename
+        self.flags = FLAG_ZLIB if compress else 0
+        self.block_size = block_size if compress else 1
+        self.num_names = 0
+        self._fh = open(filename, "wb")
+        # block offsets are kept in a separate file until the names
+        # are complete and then appended
+        self._table_file = filename + ".offsets"
+        self._table_fh = open(self._table_file, "wb")
+        self._offset = 0
+        self._pending = []
+        self._write_offsets([0])
+
+    def _write_offsets(self, offsets):
+        self._table_fh.write(struct.pack("<%dQ" % len(offsets), *offsets))
+
+    def _write_block(self, names):
+        data = zlib.compress('\n'.join(names))
+        self._fh.write(data)
+        self._offset += len(data)
+        self._write_offsets([self._offset])
+
+    def write_many(self, names):
+        self.num_names += len(names)
+        if self.flags & FLAG_ZLIB:
+            self._pending.extend(names)
+            while len(self._pending) >= self.block_size:
+                self._write_block(self._pending[:self.block_size])
+                del self._pending[:self.block_size]
+            return
+        self._fh.write(''.join(names))
+        offsets = []
+        offset = self._offset
+        for name in names:
+            offset += len(name)
+            offsets.append(offset)
+        self._offset = offset
+        self._write_offsets(offsets)
+
+    def write(self, name):
+        self.write_many([name])
+
+    def close(self):
+        if self._fh is None:
+            return
+        if len(self._pending) > 0:
+            self._write_block(self._pending)
+            self._pending = []
+        self._table_fh.close()
+        table_offset = self._offset
+        table_fh = open(self._table_file, "rb")
+        while True:
+            data = table_fh.read(1 << 20)
+            if not data:
+                break
+            self._fh.write(data)
+        table_fh.close()
+        os.remove(self._table_file)
+        self._fh.write(READ_NAME_FOOTER.pack(READ_NAME_MAGIC, READ_NAME_VERSION,
+                                             self.flags, self.block_size,
+                                             self.num_names, table_offset))
+        self._fh.close()
+        self._fh = None
+
+    def abort(self):
+        """closes and removes a partially written file"""
+        if self._fh is None:
+            return
+        self._table_fh.close()
+        self._fh.close()
+        self._fh = None
+        for f in (self.filename, self._table_file):
+            if os.path.exists(f):
+                os.remove(f)
+
+class ReadNameStore(object):
+    """
+    memory-mapped read-only view of a file written by ReadNameWriter.
+    the read ids assigned by process_input_reads start at 1 and
+    'get' returns the original name of a read id in constant time
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = open(filename, "rb")
+        size = os.fstat(self._fh.fileno()).st_size
+        if size < READ_NAME_FOOTER.size:
+            raise ValueError("read name file %s is truncated" % (filename))
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.flags, self.block_size, self.num_names, \
+            self._table_offset = READ_NAME_FOOTER.unpack_from(self._mm, size - READ_NAME_FOOTER.size)
+        if magic != READ_NAME_MAGIC:
+            raise ValueError("%s is not a read name file" % (filename))
+        if version != READ_NAME_VERSION:
+            raise ValueError("read name file %s has unsupported version %d" %
+                             (filename, version))
+        # most recently decompressed block
+        self._block_id = None
+        self._block = None
+
+    def __len__(self):
+        return self.num_names
+
+    def _block_bytes(self, block_id):
+        pos = self._table_offset + block_id * READ_NAME_OFFSET.size
+        start, = READ_NAME_OFFSET.unpack_from(self._mm, pos)
+        end, = READ_NAME_OFFSET.unpack_from(self._mm, pos + READ_NAME_OFFSET.size)
+        return self._mm[start:end]
+
+    def get(self, read_id):
+        i = int(read_id) - 1
+        if (i < 0) or (i >= self.num_names):
+            raise KeyError(read_id)
+        if not (self.flags & FLAG_ZLIB):
+            return self._block_bytes(i)
+        block_id = i // self.block_size
+        if block_id != self._block_id:
+            self._block = zlib.decompress(self._block_bytes(block_id)).split('\n')
+            self._block_id = block_id
+        return self._block[i % self.block_size]
+
+    __getitem__ = get
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._fh.close()
+            self._mm = None
@@ -0,0 +1,245 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Division of memory and processors among the stages of a run
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import json
+import fcntl
+import logging
+
+from chimerascan.lib import config
+from chimerascan.lib.base import parse_memory_size
+from chimerascan.lib.duplicates import DUPLICATE_ENTRY_BYTES
+
+# fraction of physical memory used when no budget is given
+DEFAULT_MEMORY_FRACTION = 0.75
+# fraction of a processor slot given to sort buffers, the rest
+# is left for the interpreter and samtools itself
+SORT_MEMORY_FRACTION = 0.75
+MIN_SORT_MEMORY = 64 << 20
+# approximate memory used per line held in memory by batch_sort
+BATCH_SORT_LINE_BYTES = 256
+MIN_BATCH_SORT_BUFFER = 32000
+# approximate memory used per read held in memory by SortingBamWriter
+BAM_SORT_READ_BYTES = 512
+MIN_BAM_SORT_BUFFER = 100000
+# memory used by each bowtie2 thread in addition to the index
+BOWTIE2_THREAD_MEMORY = 32 << 20
+# fraction of the budget held by the table of duplicate fragments
+DUPLICATE_TABLE_FRACTION = 0.25
+MIN_DUPLICATE_TABLE_MEMORY = 256 << 20
+
+def physical_memory():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+def format_memory_size(n):
+    for suffix, size in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if n >= size:
+            return "%.1f%s" % (n / float(size), suffix)
+    return "%d" % (n)
+
+class ResourcePlanner(object):
+    """
+    divides a memory budget among the stages of a run.  the budget is
+    split into one slot per processor so that any set of single
+    processor stages fits in memory, and stages that need more (such
+    as bowtie2 with a large index) reserve more so that the scheduler
+    runs fewer of them at the same time
+    """
+    def __init__(self, memory, num_processors):
+        self.memory = memory
+        self.num_processors = max(1, num_processors)
+
+    @staticmethod
+    def from_size(memory_size, num_processors):
+        """
+        creates a planner from a size string such as '16G', or from the
+        physical memory of the machine when 'memory_size' is None
+        """
+        if memory_size is None:
+            total = physical_memory()
+            if total is None:
+                total = config.BASE_PROCESSORS << 30
+            memory = int(total * DEFAULT_MEMORY_FRACTION)
+        else:
+            memory = parse_memory_size(memory_size)
+        return ResourcePlanner(memory, num_processors)
+
+    @property
+    def slot_memory(self):
+        return self.memory // self.num_processors
+
+    def sort_memory(self):
+        """bytes of sort buffer given to 'samtools sort -m'"""
+        return max(MIN_SORT_MEMORY, int(self.slot_memory * SORT_MEMORY_FRACTION))
+
+    def batch_sort_buffer_size(self):
+        """number of lines sorted in memory by batch_sort"""
+        lines = int(self.slot_memory * SORT_MEMORY_FRACTION) // BATCH_SORT_LINE_BYTES
+        return max(MIN_BATCH_SORT_BUFFER, lines)
+
+    def bam_sort_buffer_size(self):
+        """number of reads sorted in memory by SortingBamWriter"""
+        reads = int(self.slot_memory * SORT_MEMORY_FRACTION) // BAM_SORT_READ_BYTES
+        return max(MIN_BAM_SORT_BUFFER, reads)
+
+    def duplicate_table_memory(self):
+        """bytes reserved for the fragment hashes of DuplicateFilter"""
+        return max(MIN_DUPLICATE_TABLE_MEMORY,
+                   int(self.memory * DUPLICATE_TABLE_FRACTION))
+
+    def duplicate_table_entries(self):
+        """number of fragment hashes held by DuplicateFilter"""
+        return self.duplicate_table_memory() // DUPLICATE_ENTRY_BYTES
+
+    def bowtie2_memory(self, index, num_threads):
+        """
+        bytes used by a bowtie2 process with 'num_threads' threads
+        searching the index with prefix 'index'
+        """
+        index_size = 0
+        for ext in config.BOWTIE2_INDEX_FILE_EXTS:
+            filename = index + ext
+            if os.path.exists(filename):
+                index_size += os.path.getsize(filename)
+        return index_size + num_threads * BOWTIE2_THREAD_MEMORY
+
+    def log_plan(self):
+        logging.info("Memory budget %s for %d processors" %
+                     (format_memory_size(self.memory), self.num_processors))
+        logging.debug("\tmemory per processor: %s" %
+                      (format_memory_size(self.slot_memory)))
+        logging.debug("\tsort buffer: %s" %
+                      (format_memory_size(self.sort_memory())))
+        logging.debug("\tbatch sort buffer: %d lines" %
+                      (self.batch_sort_buffer_size()))
+        logging.debug("\tBAM sort buffer: %d reads" %
+                      (self.bam_sort_buffer_size()))
+        logging.debug("\tduplicate table: %s (%d fragments)" %
+                      (format_memory_size(self.duplicate_table_memory()),
+                       self.duplicate_table_entries()))
+
+# cpu time used by the converters and by BAM compression for each
+# second of aligner cpu time, assumed until a pipe has been measured
+DEFAULT_CONVERTER_LOAD = 0.2
+DEFAULT_COMPRESSION_LOAD = 0.1
+
+class PipeThreadPlan(object):
+    """
+    division of the processors of a piped alignment between the aligner
+    threads, the converter processes and the BAM compression threads
+    """
+    def __init__(self, aligner_threads, num_converters, compression_threads):
+        self.aligner_threads = aligner_threads
+        self.num_converters = num_converters
+        self.compression_threads = compression_threads
+
+    def __repr__(self):
+        return ("<PipeThreadPlan aligner=%d converters=%d compression=%d>" %
+                (self.aligner_threads, self.num_converters, 
+                 self.compression_threads))
+
+def plan_pipe_threads(num_processors, converter_load=DEFAULT_CONVERTER_LOAD,
+                      compression_load=DEFAULT_COMPRESSION_LOAD,
+                      max_converters=1):
+    """
+    divides 'num_processors' so that the converters and compression keep
+    up with the aligner.  'converter_load' and 'compression_load' are the
+    cpu seconds each needs per aligner cpu second.  the aligner gets the
+    processors left after at least one converter and one compression 
+    thread, and always at least one thread
+    """
+    num_processors = max(1, num_processors)
+    aligner_share = num_processors / (1.0 + converter_load + compression_load)
+    num_converters = int(round(aligner_share * converter_load))
+    num_converters = max(1, min(max_converters, num_converters))
+    compression_threads = max(1, int(round(aligner_share * compression_load)))
+    aligner_threads = max(1, num_processors - num_converters - compression_threads)
+    return PipeThreadPlan(aligner_threads, num_converters, compression_threads)
+
+def _cpu_sec(usage):
+    return usage['user_cpu_sec'] + usage['sys_cpu_sec']
+
+class PipeCalibration(object):
+    """
+    cpu time measured for the processes of each kind of piped alignment,
+    kept in a JSON file so that later alignments (other shards or runs
+    resumed in the same output directory) divide their processors in
+    proportion to the measured work rather than the default loads
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _load(self):
+        if (self.filename is None) or (not os.path.exists(self.filename)):
+            return {}
+        try:
+            return json.load(open(self.filename))
+        except ValueError:
+            return {}
+
+    def loads(self, name):
+        """
+        returns the measured (converter_load, compression_load) of the
+        pipe 'name', or the default loads if it was not measured
+        """
+        d = self._load().get(name)
+        if (d is None) or (d['aligner_cpu_sec'] <= 0):
+            return DEFAULT_CONVERTER_LOAD, DEFAULT_COMPRESSION_LOAD
+        return (d['converter_cpu_sec'] / d['aligner_cpu_sec'],
+                d['compression_cpu_sec'] / d['aligner_cpu_sec'])
+
+    def plan(self, name, num_processors, max_converters=1):
+        converter_load, compression_load = self.loads(name)
+        plan = plan_pipe_threads(num_processors, converter_load,
+                                 compression_load, max_converters)
+        logging.debug("Pipe %s loads converter=%.3f compression=%.3f plan %s" %
+                      (name, converter_load, compression_load, plan))
+        return plan
+
+    def record(self, name, aligner_usage, converter_usages, compression_usages):
+        """
+        adds the resource usage (from wait_process) of the processes of 
+        a finished pipe to the measurements of 'name'
+        """
+        if self.filename is None:
+            return
+        # shards may finish at the same time, so the file is locked 
+        # while its measurements are read and updated
+        lockfh = open(self.filename + ".lock", "w")
+        fcntl.flock(lockfh, fcntl.LOCK_EX)
+        try:
+            calibration = self._load()
+            d = calibration.setdefault(name, {'aligner_cpu_sec': 0.0,
+                                              'converter_cpu_sec': 0.0,
+                                              'compression_cpu_sec': 0.0})
+            d['aligner_cpu_sec'] += _cpu_sec(aligner_usage)
+            d['converter_cpu_sec'] += sum(_cpu_sec(u) for u in converter_usages)
+            d['compression_cpu_sec'] += sum(_cpu_sec(u) for u in compression_usages)
+            # replace the file in one step so that readers never see
+            # a partial file
+            tmp_file = self.filename + ".%d.tmp" % (os.getpid())
+            fh = open(tmp_file, "w")
+            json.dump(calibration, fh, indent=2, sort_keys=True)
+            fh.close()
+            os.rename(tmp_file, self.filename)
+        finally:
+            fcntl.flock(lockfh, fcntl.LOCK_UN)
+            lockfh.close()
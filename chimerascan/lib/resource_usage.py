@@ -0,0 +1,116 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Collection of cpu, memory, and i/o usage of pipeline stages
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import errno
+import collections
+import signal
+import resource
+
+# fields of /proc/<pid>/io reported in the profile
+PROC_IO_FIELDS = ("rchar", "wchar", "read_bytes", "write_bytes")
+
+# usage of the external processes waited on by the current stage
+_subprocess_usage = []
+# group of the processes waited on, see begin_pipe
+_pipe_number = 0
+
+def read_proc_io(pid="self"):
+    """
+    returns the i/o counters of a process (including the children it
+    has waited on) or an empty dictionary when i/o accounting is not
+    available.  'read_bytes' and 'write_bytes' count storage i/o while
+    'rchar' and 'wchar' also include pipes and the page cache
+    """
+    counters = {}
+    try:
+        with open("/proc/%s/io" % (pid)) as fh:
+            for line in fh:
+                key, value = line.split(':', 1)
+                if key in PROC_IO_FIELDS:
+                    counters[key] = int(value)
+    except (IOError, ValueError):
+        return {}
+    return counters
+
+def rusage_to_dict(ru):
+    # ru_maxrss is reported in kilobytes on linux
+    return {'user_cpu_sec': ru.ru_utime,
+            'sys_cpu_sec': ru.ru_stime,
+            'max_rss_kb': ru.ru_maxrss}
+
+def begin_pipe():
+    """
+    starts a new group of processes for wait_process.  processes of a
+    group are assumed to run at the same time and groups one after 
+    another.  processes waited on before any call share one group
+    """
+    global _pipe_number
+    _pipe_number += 1
+
+def wait_process(p, name):
+    """
+    waits for a subprocess.Popen object to terminate, records its
+    resource usage under 'name' (also kept as the 'usage' attribute of
+    'p'), and returns its return code
+    """
+    if p.returncode is not None:
+        return p.returncode
+    while True:
+        try:
+            pid, status, ru = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    elif os.WIFEXITED(status):
+        p.returncode = os.WEXITSTATUS(status)
+    else:
+        p.returncode = -signal.SIGKILL
+    usage = rusage_to_dict(ru)
+    usage['name'] = name
+    usage['returncode'] = p.returncode
+    usage['pipe'] = _pipe_number
+    _subprocess_usage.append(usage)
+    p.usage = usage
+    return p.returncode
+
+def stage_usage():
+    """
+    returns the usage of the calling process and all children it has
+    waited on.  meant to be called by a forked stage just before it exits
+    """
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {'user_cpu_sec': self_ru.ru_utime + child_ru.ru_utime,
+             'sys_cpu_sec': self_ru.ru_stime + child_ru.ru_stime,
+             'max_rss_self_kb': self_ru.ru_maxrss,
+             'max_rss_children_kb': child_ru.ru_maxrss,
+             'subprocesses': list(_subprocess_usage)}
+    # the processes of a pipe run at the same time as each other and 
+    # the stage itself, so their peaks add up.  children that were not
+    # waited on with wait_process are only counted by the largest one
+    pipe_rss = collections.defaultdict(int)
+    for u in _subprocess_usage:
+        pipe_rss[u['pipe']] += u['max_rss_kb']
+    children_rss = max([child_ru.ru_maxrss] + pipe_rss.values())
+    usage['peak_rss_kb'] = self_ru.ru_maxrss + children_rss
+    usage.update(read_proc_io())
+    return usage
@@ -20,6 +20,7 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
+import re
 import operator
 import collections
 import pysam
@@ -41,6 +42,11 @@ CIGAR_X = 8 # sequence mismatch
 REF_ADVANCING_CIGAR_CODES = frozenset((CIGAR_M, CIGAR_D, CIGAR_N, CIGAR_E, CIGAR_X))
 SEQ_ADVANCING_CIGAR_CODES = frozenset((CIGAR_M, CIGAR_I, CIGAR_S, CIGAR_E, CIGAR_X))
 
+CIGAR_OPS = "MIDNSHP=X"
+_cigar_re = re.compile(r'(\d+)([MIDNSHP=X])')
+# python types of SAM optional field values
+_tag_types = {'i': int, 'f': float}
+
 class CIGAR:
     M = 0 #match  Alignment match (can be a sequence match or mismatch)
     I = 1 #insertion  Insertion to the reference
@@ -156,7 +162,37 @@ def select_primary_alignments(reads):
         return unmapped_reads
     return primary_reads
 
-def copy_read(r):
+def replace_tags(tags, new_tags=(), delete_tags=()):
+    '''
+    returns a list of the (tag, value) pairs in 'tags' with the tags 
+    named in 'delete_tags' removed and the (tag, value) pairs in 
+    'new_tags' set.  tags that already exist keep their place and other 
+    new tags are added at the end, in the same order as when the tags
+    are edited through an OrderedDict
+    '''
+    values = dict(new_tags)
+    result = []
+    for tag, value in tags:
+        if tag in delete_tags:
+            continue
+        if tag in values:
+            value = values.pop(tag)
+        result.append((tag, value))
+    result.extend((tag, value) for tag, value in new_tags if tag in values)
+    return result
+
+def set_tags(r, new_tags=(), delete_tags=()):
+    '''
+    sets and deletes several tags of read 'r' (see replace_tags) while 
+    decoding and encoding its optional fields only once
+    '''
+    r.tags = replace_tags(r.tags, new_tags, delete_tags)
+
+def copy_read(r, new_tags=()):
+    '''
+    returns a copy of read 'r' with the (tag, value) pairs in 'new_tags'
+    set on the copy
+    '''
     a = pysam.AlignedRead()
     a.qname = r.qname
     a.seq = r.seq
@@ -169,7 +205,7 @@ def copy_read(r):
     a.pnext = r.pnext
     a.isize = r.isize
     a.qual = r.qual
-    a.tags = list(r.tags)
+    a.tags = replace_tags(r.tags, new_tags)
     return a
 
 def soft_pad_read(fq, r):
@@ -197,12 +233,113 @@ def soft_pad_read(fq, r):
     r.qual = qual
     r.cigar = cigar
 
+def parse_sam_line(line, rname_tid_map, tag_fields=None):
+    """
+    creates an AlignedRead from a line of SAM text.  'rname_tid_map' 
+    maps the reference names in the SAM header to tids.  when the dict
+    'tag_fields' is given the original text of each optional field is
+    added to it so that format_sam_read can copy unchanged tags with
+    their original type and value
+    """
+    fields = line.rstrip('\n').split('\t')
+    a = pysam.AlignedRead()
+    a.qname = fields[0]
+    a.flag = int(fields[1])
+    a.tid = -1 if fields[2] == '*' else rname_tid_map[fields[2]]
+    a.pos = int(fields[3]) - 1
+    a.mapq = int(fields[4])
+    if fields[5] != '*':
+        a.cigar = [(CIGAR_OPS.index(op), int(n)) 
+                   for n,op in _cigar_re.findall(fields[5])]
+    if fields[6] == '=':
+        a.rnext = a.tid
+    else:
+        a.rnext = -1 if fields[6] == '*' else rname_tid_map[fields[6]]
+    a.pnext = int(fields[7]) - 1
+    a.tlen = int(fields[8])
+    if fields[9] != '*':
+        a.seq = fields[9]
+        if fields[10] != '*':
+            a.qual = fields[10]
+    tags = []
+    for field in fields[11:]:
+        tag, tagtype, value = field.split(':', 2)
+        tags.append((tag, _tag_types.get(tagtype, str)(value)))
+    a.tags = tags
+    if tag_fields is not None:
+        # key on the values stored in the read, which may have been 
+        # rounded (floats are kept in single precision)
+        for (tag, value), field in zip(a.tags, fields[11:]):
+            tag_fields[_tag_field_key(a, tag, value)] = field
+    return a
+
+def _tag_field_key(r, tag, value):
+    return (r.qname, r.is_read2, tag, value)
+
+def _format_tag(tag, value):
+    # types are chosen as pysam chooses them when writing tags
+    if isinstance(value, float):
+        return '%s:f:%r' % (tag, value)
+    if isinstance(value, (int, long)):
+        return '%s:i:%d' % (tag, value)
+    if len(value) == 1:
+        return '%s:A:%s' % (tag, value)
+    return '%s:Z:%s' % (tag, value)
+
+def format_sam_read(r, references, tag_fields=None):
+    """
+    returns the SAM text (without a newline) of AlignedRead 'r'.
+    'references' is the list of reference names indexed by tid.  tags
+    found in 'tag_fields' (see parse_sam_line) keep their original text
+    """
+    rname = '*' if r.tid < 0 else references[r.tid]
+    if r.rnext < 0:
+        rnext = '*'
+    elif r.rnext == r.tid:
+        rnext = '='
+    else:
+        rnext = references[r.rnext]
+    cigar = r.cigar
+    if cigar:
+        cigar = ''.join(['%d%s' % (n, CIGAR_OPS[op]) for op,n in cigar])
+    else:
+        cigar = '*'
+    fields = [r.qname, str(r.flag), rname, str(r.pos + 1), str(r.mapq),
+              cigar, rnext, str(r.pnext + 1), str(r.tlen), 
+              r.seq or '*', r.qual or '*']
+    for tag,value in r.tags:
+        field = None
+        if tag_fields is not None:
+            field = tag_fields.get(_tag_field_key(r, tag, value))
+        if field is None:
+            field = _format_tag(tag, value)
+        fields.append(field)
+    return '\t'.join(fields)
+
+def soft_pad_sam_fields(fields, seq, qual):
+    """
+    text version of soft_pad_read for the tab separated 'fields' of a
+    SAM record.  replaces the trimmed sequence and qualities with the
+    full length 'seq' and 'qual' and soft clips the extra bases
+    """
+    ext_length = len(seq) - len(fields[9])
+    cigar = fields[5]
+    if int(fields[1]) & 0x10:
+        seq = DNA_reverse_complement(seq)
+        qual = qual[::-1]
+        if (cigar != '*') and (ext_length > 0):
+            cigar = '%dS%s' % (ext_length, cigar)
+    else:
+        if (cigar != '*') and (ext_length > 0):
+            cigar = '%s%dS' % (cigar, ext_length)
+    fields[5] = cigar
+    fields[9] = seq
+    fields[10] = qual
+
 def pair_reads(r1, r2, tags=None):
     '''
     fill in paired-end fields in SAM record
     '''
-    if tags is None:
-        tags = []
     # convert read1 to paired-end
     r1.is_paired = True
     r1.is_proper_pair = True
@@ -211,9 +348,8 @@ def pair_reads(r1, r2, tags=None):
     r1.mate_is_unmapped = r2.is_unmapped
     r1.rnext = r2.tid
     r1.pnext = r2.pos
-    tags1 = collections.OrderedDict(r1.tags)
-    tags1.update(tags)
-    r1.tags = tags1.items()
+    if tags:
+        set_tags(r1, tags)
     # convert read2 to paired-end        
     r2.is_paired = True
     r2.is_proper_pair = True
@@ -222,9 +358,8 @@ def pair_reads(r1, r2, tags=None):
     r2.mate_is_unmapped = r1.is_unmapped
     r2.rnext = r1.tid
     r2.pnext = r1.pos
-    tags2 = collections.OrderedDict(r2.tags)
-    tags2.update(tags)
-    r2.tags = tags2.items()
+    if tags:
+        set_tags(r2, tags)
     # compute insert size
     if r1.tid != r2.tid:
         r1.isize = 0
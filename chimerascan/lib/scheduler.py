@@ -0,0 +1,429 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Dependency-driven scheduler for the stages of the chimerascan pipeline
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import sys
+import json
+import time
+import fcntl
+import errno
+import signal
+import logging
+
+from chimerascan.lib import config
+from chimerascan.lib.base import up_to_date, promote_file
+from chimerascan.lib.resource_usage import stage_usage, rusage_to_dict
+
+class Stage(object):
+    """
+    a single step of the pipeline.  'func' is called with the number of
+    processors granted by the scheduler and must return a job return code.
+    dependencies between stages are inferred from the declared input and
+    output files.  'params' holds the settings that affect the outputs
+    of the stage and is recorded in the stage manifest.  'memory' is the
+    number of bytes the stage is expected to use.  'promote' maps output
+    files to the scratch files that 'func' actually writes, which are
+    moved into place once the stage succeeds
+    """
+    def __init__(self, name, msg, func, inputs=(), outputs=(), params=None,
+                 num_processors=1, min_processors=1, memory=0,
+                 promote=None):
+        self.name = name
+        self.msg = msg
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.params = {} if params is None else params
+        self.min_processors = max(1, min_processors)
+        self.num_processors = max(self.min_processors, num_processors)
+        self.memory = max(0, memory)
+        self.promote = {} if promote is None else promote
+
+    def up_to_date(self):
+        if len(self.outputs) == 0:
+            return False
+        for outp in self.outputs:
+            if not os.path.exists(outp):
+                return False
+            for inp in self.inputs:
+                if not up_to_date(outp, inp):
+                    return False
+        return True
+
+    def cleanup(self):
+        for f in self.outputs + tuple(self.promote.values()):
+            if os.path.exists(f):
+                os.remove(f)
+
+def _run_stage_child(stage, num_processors, cache, usage_fd):
+    """
+    executes a stage in a forked child process, reports its resource
+    usage on 'usage_fd', and exits with its return code
+    """
+    retcode = config.JOB_ERROR
+    try:
+        retcode = stage.func(num_processors)
+        if retcode is None:
+            retcode = config.JOB_SUCCESS
+        if retcode == config.JOB_SUCCESS:
+            for output_file, scratch_file in stage.promote.iteritems():
+                promote_file(scratch_file, output_file)
+        if (retcode == config.JOB_SUCCESS) and (cache is not None):
+            cache.record(stage)
+    except:
+        logging.exception("Unexpected error in stage '%s'" % (stage.name))
+        retcode = config.JOB_ERROR
+    finally:
+        logging.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            os.write(usage_fd, json.dumps(stage_usage()))
+            os.close(usage_fd)
+        except:
+            pass
+        os._exit(int(retcode) & 0xff)
+
+def disk_usage(path):
+    """
+    returns the number of bytes used by the files below 'path'
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+class StageScheduler(object):
+    """
+    runs a directed acyclic graph of stages, launching every stage whose
+    dependencies have completed as long as the total number of processors
+    in use stays within 'num_processors' and the memory expected to be in
+    use stays within 'max_memory' bytes.  after a stage fails no new
+    stages are started unless 'keep_going' is set, in which case only
+    the stages depending on the failed stage are not run.  when a
+    StageCache is provided stages are skipped based on their manifests,
+    otherwise the file modification times are compared.  the resource
+    usage of every stage is kept in 'profiles' in the order the stages
+    finished.
+
+    files in 'release_files' are intermediates that are deleted as soon
+    as every stage that reads them has finished.  with a StageCache the
+    deleted files are recorded in the manifest of the stage producing
+    them, which then stays valid while every stage reading them is
+    valid.  a producer is run again if a stage that must run needs one
+    of its deleted files.  when 'scratch_dir' is
+    given its size is measured each time a stage finishes and the peak
+    is kept in 'peak_scratch'
+    """
+    def __init__(self, stages, num_processors, cache=None, max_memory=None,
+                 keep_going=False, release_files=None, scratch_dir=None):
+        self.stages = list(stages)
+        self.num_processors = max(1, num_processors)
+        self.max_memory = max_memory
+        self.keep_going = keep_going
+        self.cache = cache
+        self.deps = self._build_dependencies(self.stages)
+        self.profiles = []
+        self.scratch_dir = scratch_dir
+        self.peak_scratch = 0
+        # map intermediate file -> names of stages that still read it
+        self.release_files = set() if release_files is None else set(release_files)
+        self.consumers = {}
+        # map intermediate file -> stages that read it
+        self.readers = {}
+        for stage in self.stages:
+            for f in stage.inputs:
+                if f in self.release_files:
+                    self.consumers.setdefault(f, set()).add(stage.name)
+                    self.readers.setdefault(f, []).append(stage)
+        # map file -> stage that writes it
+        self.producers = dict((f, stage) for stage in self.stages
+                              for f in stage.outputs)
+
+    @staticmethod
+    def _build_dependencies(stages):
+        producers = {}
+        names = set()
+        for stage in stages:
+            if stage.name in names:
+                raise ValueError("Duplicate stage name '%s'" % (stage.name))
+            names.add(stage.name)
+            for f in stage.outputs:
+                if f in producers:
+                    raise ValueError("File '%s' produced by stages '%s' and '%s'" %
+                                     (f, producers[f], stage.name))
+                producers[f] = stage.name
+        deps = {}
+        for stage in stages:
+            deps[stage.name] = set(producers[f] for f in stage.inputs
+                                   if f in producers)
+            deps[stage.name].discard(stage.name)
+        # check for cycles by repeatedly removing stages without
+        # unresolved dependencies
+        resolved = set()
+        remaining = set(names)
+        while remaining:
+            ready = set(name for name in remaining
+                        if deps[name].issubset(resolved))
+            if not ready:
+                raise ValueError("Cyclic dependency among stages: %s" %
+                                 (','.join(sorted(remaining))))
+            resolved.update(ready)
+            remaining.difference_update(ready)
+        return deps
+
+    def _up_to_date(self, stage):
+        if self.cache is None:
+            return stage.up_to_date()
+        return self.cache.is_valid(stage, self._released_ok)
+
+    def _released_ok(self, f):
+        # a deleted intermediate is not needed while every stage 
+        # reading it can be skipped
+        return all(self._up_to_date(stage) 
+                   for stage in self.readers.get(f, ()))
+
+    def _cleanup(self, stage):
+        stage.cleanup()
+        if self.cache is not None:
+            self.cache.invalidate(stage)
+
+    def _release(self, stage):
+        """
+        deletes the intermediate files that are no longer needed once
+        'stage' is done
+        """
+        released = []
+        for f in stage.inputs:
+            if f not in self.consumers:
+                continue
+            self.consumers[f].discard(stage.name)
+            if len(self.consumers[f]) == 0:
+                del self.consumers[f]
+                released.append(f)
+        # outputs that no other stage reads
+        for f in stage.outputs:
+            if (f in self.release_files) and (f not in self.consumers):
+                released.append(f)
+        for f in released:
+            if os.path.exists(f):
+                logging.debug("\tremoving intermediate file %s" % (f))
+                os.remove(f)
+            if (self.cache is not None) and (f in self.producers):
+                self.cache.release(self.producers[f], f)
+
+    def _missing_producers(self, stage, done):
+        """
+        returns the completed stages that must run again to recreate
+        deleted inputs of 'stage'
+        """
+        return [self.producers[f] for f in stage.inputs
+                if (not os.path.exists(f)) and (f in self.producers) and
+                (self.producers[f].name in done)]
+
+    def _measure_scratch(self):
+        if self.scratch_dir is None:
+            return None
+        scratch = disk_usage(self.scratch_dir)
+        self.peak_scratch = max(self.peak_scratch, scratch)
+        return scratch
+
+    def _start(self, stage, num_processors):
+        if self.cache is not None:
+            self.cache.invalidate(stage)
+        # flush buffered output so the child does not duplicate it
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # the child reports its resource usage through a pipe
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            # keep external programs started by the stage from holding
+            # the pipe open after the stage exits
+            fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            _run_stage_child(stage, num_processors, self.cache, write_fd)
+        os.close(write_fd)
+        return pid, read_fd
+
+    @staticmethod
+    def _read_usage(fd):
+        chunks = []
+        while True:
+            try:
+                buf = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not buf:
+                break
+            chunks.append(buf)
+        os.close(fd)
+        try:
+            return json.loads(''.join(chunks))
+        except ValueError:
+            return {}
+
+    def _profile(self, stage, status, num_processors=0, start_time=None,
+                 end_time=None, ru=None, usage_fd=None):
+        p = {'stage': stage.name,
+             'status': status,
+             'num_processors': num_processors}
+        if usage_fd is not None:
+            p.update(self._read_usage(usage_fd))
+        if ru is not None:
+            # cpu time and memory as accounted by the kernel for the
+            # stage and all of its waited-on descendants
+            p.update(rusage_to_dict(ru))
+        if start_time is not None:
+            p['start_time'] = start_time
+            p['end_time'] = end_time
+            p['wall_time_sec'] = end_time - start_time
+        self.profiles.append(p)
+
+    def write_profile(self, filename):
+        with open(filename, "w") as fh:
+            json.dump({'num_processors': self.num_processors,
+                       'max_memory': self.max_memory,
+                       'peak_scratch_bytes': self.peak_scratch,
+                       'stages': self.profiles}, fh, indent=2,
+                      sort_keys=True)
+
+    def _terminate(self, running):
+        for pid in running:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in running:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            os.close(running[pid][3])
+
+    def run(self):
+        pending = list(self.stages)
+        # map pid -> (stage, processors, start time, usage pipe)
+        running = {}
+        done = set()
+        # stages whose outputs were found to be out of date
+        stale = set()
+        failed = False
+        try:
+            while True:
+                if self.keep_going or (not failed):
+                    launched = True
+                    while launched:
+                        launched = False
+                        used = sum(v[1] for v in running.itervalues())
+                        used_memory = sum(v[0].memory for v in running.itervalues())
+                        for stage in list(pending):
+                            if not self.deps[stage.name].issubset(done):
+                                continue
+                            if stage.name not in stale:
+                                if self._up_to_date(stage):
+                                    logging.info("[SKIPPED] %s" % (stage.msg))
+                                    self._profile(stage, "skipped")
+                                    pending.remove(stage)
+                                    done.add(stage.name)
+                                    self._release(stage)
+                                    launched = True
+                                    break
+                                stale.add(stage.name)
+                            requeue = self._missing_producers(stage, done)
+                            if len(requeue) > 0:
+                                for producer in requeue:
+                                    logging.debug("\tstage '%s' must run again "
+                                                  "for stage '%s'" %
+                                                  (producer.name, stage.name))
+                                    done.discard(producer.name)
+                                    stale.add(producer.name)
+                                    pending.append(producer)
+                                launched = True
+                                break
+                            avail = self.num_processors - used
+                            nprocs = min(stage.num_processors, avail)
+                            if ((self.max_memory is not None) and
+                                (used_memory + stage.memory > self.max_memory) and
+                                (len(running) > 0)):
+                                # wait for running stages to free up memory
+                                continue
+                            if nprocs < stage.min_processors:
+                                if len(running) > 0:
+                                    # wait for running stages to free up
+                                    # processors
+                                    continue
+                                nprocs = stage.min_processors
+                            logging.info("%s" % (stage.msg))
+                            logging.debug("\tstage '%s' started with %d processors" %
+                                          (stage.name, nprocs))
+                            start_time = time.time()
+                            pid, usage_fd = self._start(stage, nprocs)
+                            running[pid] = (stage, nprocs, start_time, usage_fd)
+                            pending.remove(stage)
+                            launched = True
+                            break
+                if len(running) == 0:
+                    break
+                # wait for a stage to finish
+                try:
+                    pid, status, ru = os.wait4(-1, 0)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if pid not in running:
+                    continue
+                end_time = time.time()
+                stage, nprocs, start_time, usage_fd = running.pop(pid)
+                if os.WIFEXITED(status):
+                    retcode = os.WEXITSTATUS(status)
+                else:
+                    retcode = config.JOB_ERROR
+                self._profile(stage,
+                              "completed" if retcode == config.JOB_SUCCESS else "failed",
+                              nprocs, start_time, end_time, ru, usage_fd)
+                # scratch space is measured before intermediates are
+                # released to capture the high-water mark
+                scratch = self._measure_scratch()
+                if scratch is not None:
+                    self.profiles[-1]['scratch_bytes'] = scratch
+                if retcode != config.JOB_SUCCESS:
+                    logging.error("[FAILED] %s" % (stage.msg))
+                    self._cleanup(stage)
+                    failed = True
+                else:
+                    logging.debug("\tstage '%s' finished" % (stage.name))
+                    if self.cache is not None:
+                        self.cache.remember(stage)
+                    done.add(stage.name)
+                    self._release(stage)
+        except:
+            self._terminate(running)
+            for v in running.itervalues():
+                self._cleanup(v[0])
+            raise
+        if failed or len(pending) > 0:
+            return config.JOB_ERROR
+        return config.JOB_SUCCESS
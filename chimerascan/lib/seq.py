@@ -9,8 +9,9 @@ Contains methods to transform sequence strings
 import string
 from math import log10
 from string import maketrans
+from itertools import izip
 
-from base import open_compressed
+from fastq import parse_fastq_batches
 
 # Quality score formats
 SANGER_FORMAT = "sanger"
@@ -76,13 +77,24 @@ def get_sanger_qual_conversion_table():
     tbl[offset+40:] = "I" * (256-(offset+40))
     return maketrans(''.join(map(chr, range(256))), ''.join(tbl))
 
+def get_qual_conversion_table(qual_format):
+    conv_tables = {SANGER_FORMAT: get_sanger_qual_conversion_table,
+                   ILLUMINA_FORMAT: get_illumina_qual_conversion_table,
+                   SOLEXA_FORMAT: get_solexa_qual_conversion_table}
+    return conv_tables[qual_format]()
+
 def get_qual_conversion_func(qual_format):
-    conv_tables = {SANGER_FORMAT: get_sanger_qual_conversion_table(),
-                   ILLUMINA_FORMAT: get_illumina_qual_conversion_table(),
-                   SOLEXA_FORMAT: get_solexa_qual_conversion_table()}
-    tbl = conv_tables[qual_format]
+    tbl = get_qual_conversion_table(qual_format)
     return lambda q: q.translate(tbl)
 
+def get_qual_batch_conversion_table(qual_format):
+    """
+    returns a conversion table that leaves newlines unchanged so that
+    many newline separated quality strings can be converted at once
+    """
+    tbl = get_qual_conversion_table(qual_format)
+    return tbl[:10] + '\n' + tbl[11:]
+
 class FASTQRecord:
     __slots__ = ("qname", "seq", "qual", "readnum")
     def __init__(self, qname, seq, qual, readnum):
@@ -98,33 +110,17 @@ class FASTQRecord:
 def parse_fastq_record(line_iter, 
                        convert_quals=False,
                        qual_format=SANGER_FORMAT):
-    qual_func = get_qual_conversion_func(qual_format)    
-    try:        
-        qname = line_iter.next().rstrip()[1:]
-        readnum = int(qname[-1])
-        qname = qname[:-2]
-        seq = line_iter.next().rstrip()
-        line_iter.next()
-        qual = line_iter.next().rstrip()
+    """
+    generator of FASTQRecord objects from a FASTQ file object whose read
+    names end with the read number (/1 or /2)
+    """
+    if convert_quals:
+        tbl = get_qual_batch_conversion_table(qual_format)
+    for batch in parse_fastq_batches(line_iter):
         if convert_quals:
-            qual = qual_func(qual)
-        yield FASTQRecord(qname, seq, qual, readnum)
-        while True:
-            # qname
-            qname = line_iter.next().rstrip()[1:]
-            readnum = int(qname[-1])
-            qname = qname[:-2]
-            # seq
-            seq = line_iter.next().rstrip()
-            # qname again (skip)
-            line_iter.next()
-            # qual
-            qual = line_iter.next().rstrip()
-            if convert_quals:
-                qual = qual_func(qual)
-            yield FASTQRecord(qname, seq, qual, readnum)
-    except StopIteration:
-        pass
+            batch.convert_quals(tbl)
+        for name, seq, qual in izip(batch.names, batch.seqs, batch.quals):
+            yield FASTQRecord(name[1:-2], seq, qual, int(name[-1]))
 
 def calc_homology(seq1, seq2, num_mismatches):
     smallest_len = min(len(seq1), len(seq2))
@@ -149,10 +145,3 @@ def split_seq(seq, chars_per_line=BASES_PER_LINE):
         newseq.append(seq[pos:endpos])
         pos = endpos
     return '\n'.join(newseq)
-
-def detect_read_length(filename):
-    fh = open_compressed(filename)
-    fh.next()
-    seq = fh.next()
-    fh.close()
-    return len(seq)
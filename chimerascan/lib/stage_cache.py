@@ -0,0 +1,230 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Content-based manifests used to decide whether pipeline stages are up to date
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import json
+import hashlib
+import logging
+
+from chimerascan import __version__
+
+# size of blocks read when computing file checksums
+HASH_BLOCK_SIZE = 1 << 20
+
+def md5_file(filename):
+    m = hashlib.md5()
+    with open(filename, "rb") as fh:
+        while True:
+            buf = fh.read(HASH_BLOCK_SIZE)
+            if not buf:
+                break
+            m.update(buf)
+    return m.hexdigest()
+
+def _normalize(obj):
+    # round trip through json so that tuples and lists compare equal
+    return json.loads(json.dumps(obj))
+
+class StageCache(object):
+    """
+    records a manifest for every completed stage containing checksums of
+    its input and output files, the stage parameters, and the code
+    version.  a stage is valid only when all of these still match.
+
+    checksums are cached by (size, mtime) so unchanged files are hashed
+    once, while files whose timestamps changed (for example after copying
+    the output directory) are rehashed and compared by content
+
+    outputs deleted as intermediates after the stage completed are kept
+    in the 'released' list of the manifest.  a released file that no
+    longer exists is compared using its recorded checksum
+    """
+    def __init__(self, manifest_dir, base_dir=None):
+        self.manifest_dir = manifest_dir
+        self.base_dir = base_dir
+        # map absolute path -> (size, mtime, md5)
+        self.fingerprints = {}
+        # map absolute path of released files -> (size, md5)
+        self.released = {}
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+
+    def manifest_file(self, stage):
+        return os.path.join(self.manifest_dir, "%s.json" % (stage.name))
+
+    def _relpath(self, path):
+        if self.base_dir is None:
+            return path
+        relpath = os.path.relpath(path, self.base_dir)
+        if relpath.startswith(os.pardir):
+            return path
+        return relpath
+
+    def fingerprint(self, path):
+        st = os.stat(path)
+        cached = self.fingerprints.get(path)
+        if ((cached is not None) and (cached[0] == st.st_size) and
+            (cached[1] == st.st_mtime)):
+            return cached
+        logging.debug("\tcomputing checksum of %s" % (path))
+        fp = (st.st_size, st.st_mtime, md5_file(path))
+        self.fingerprints[path] = fp
+        return fp
+
+    def _seed(self, paths, entries):
+        for path, entry in zip(paths, entries):
+            if path not in self.fingerprints:
+                self.fingerprints[path] = (entry['size'], entry['mtime'],
+                                           entry['md5'])
+
+    def _seed_released(self, stage, m):
+        released = set(m.get('released', ()))
+        for path, entry in zip(stage.outputs, m['outputs']):
+            if self._relpath(path) in released:
+                self.released[path] = (entry['size'], entry['md5'])
+            else:
+                self.released.pop(path, None)
+
+    def load(self, stage):
+        filename = self.manifest_file(stage)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename) as fh:
+                return json.load(fh)
+        except ValueError:
+            logging.warning("Ignoring corrupt stage manifest %s" % (filename))
+            return None
+
+    def remember(self, stage):
+        """
+        load checksums recorded by a stage that just completed
+        """
+        m = self.load(stage)
+        if m is not None:
+            self._seed(stage.inputs, m['inputs'])
+            self._seed(stage.outputs, m['outputs'])
+            self._seed_released(stage, m)
+
+    def is_valid(self, stage, released_ok=None):
+        """
+        checks the manifest of 'stage' against its current inputs and
+        outputs.  an input that was released by the stage producing it
+        is accepted while it matches the recorded checksum.  a released
+        output is accepted when 'released_ok' returns True for it,
+        meaning that no stage needs the file anymore
+        """
+        m = self.load(stage)
+        if m is None:
+            return False
+        if m['version'] != __version__:
+            logging.debug("\tstage '%s' was run by version %s" %
+                          (stage.name, m['version']))
+            return False
+        if m['params'] != _normalize(stage.params):
+            logging.debug("\tstage '%s' parameters changed" % (stage.name))
+            return False
+        if ((len(m['inputs']) != len(stage.inputs)) or
+            (len(m['outputs']) != len(stage.outputs))):
+            return False
+        self._seed_released(stage, m)
+        if not all(os.path.exists(f) or (f in self.released)
+                   for f in stage.inputs):
+            return False
+        for f in stage.outputs:
+            if os.path.exists(f):
+                continue
+            if (f not in self.released) or (released_ok is None):
+                return False
+            if not released_ok(f):
+                logging.debug("\tstage '%s' released file %s is needed" %
+                              (stage.name, f))
+                return False
+        self._seed(stage.inputs, m['inputs'])
+        self._seed(stage.outputs, m['outputs'])
+        changed = False
+        for paths, entries in ((stage.inputs, m['inputs']),
+                               (stage.outputs, m['outputs'])):
+            for path, entry in zip(paths, entries):
+                if not os.path.exists(path):
+                    size, md5 = self.released[path]
+                    if (size != entry['size']) or (md5 != entry['md5']):
+                        logging.debug("\tstage '%s' file %s changed" %
+                                      (stage.name, path))
+                        return False
+                    continue
+                size, mtime, md5 = self.fingerprint(path)
+                if (size != entry['size']) or (md5 != entry['md5']):
+                    logging.debug("\tstage '%s' file %s changed" %
+                                  (stage.name, path))
+                    return False
+                if mtime != entry['mtime']:
+                    changed = True
+        if changed:
+            # contents match but timestamps differ, so update the
+            # manifest to avoid hashing these files again
+            self.record(stage, [f for f in stage.outputs if f in self.released])
+        return True
+
+    def _entries(self, paths):
+        entries = []
+        for path in paths:
+            if os.path.exists(path):
+                size, mtime, md5 = self.fingerprint(path)
+            else:
+                size, mtime, md5 = self.fingerprints[path]
+            entries.append({'path': self._relpath(path), 'size': size,
+                            'mtime': mtime, 'md5': md5})
+        return entries
+
+    def record(self, stage, released=()):
+        m = {'stage': stage.name,
+             'version': __version__,
+             'params': _normalize(stage.params),
+             'inputs': self._entries(stage.inputs),
+             'outputs': self._entries(stage.outputs),
+             'released': sorted(self._relpath(f) for f in released)}
+        self._write(stage, m)
+
+    def _write(self, stage, m):
+        filename = self.manifest_file(stage)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w") as fh:
+            json.dump(m, fh, indent=2, sort_keys=True)
+        os.rename(tmp_filename, filename)
+
+    def release(self, stage, path):
+        """
+        marks output 'path' of 'stage' as deleted after the stage
+        completed
+        """
+        m = self.load(stage)
+        if m is None:
+            return
+        relpath = self._relpath(path)
+        if relpath not in m.get('released', []):
+            m['released'] = sorted(m.get('released', []) + [relpath])
+            self._write(stage, m)
+        for f, entry in zip(stage.outputs, m['outputs']):
+            if f == path:
+                self.released[path] = (entry['size'], entry['md5'])
+
+    def invalidate(self, stage):
+        filename = self.manifest_file(stage)
+        if os.path.exists(filename):
+            os.remove(filename)
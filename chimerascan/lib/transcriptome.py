@@ -21,7 +21,9 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 import logging
+import bisect
 import collections
+from array import array
 
 from chimerascan.bx.cluster import ClusterTree
 from chimerascan.bx.intersection import Interval, IntervalTree
@@ -107,4 +109,101 @@ def transcript_to_genome_pos(rname, pos, transcript_genome_map):
                 return chrom, strand, start + (pos - offset)
         #print start, end, offset, pos
         offset += exon_size
-    return None
\ No newline at end of file
+    return None
+
+class TranscriptCoordinateMap(object):
+    """
+    compiled map from transcript to genome coordinates.  the exons of 
+    all transcripts are stored in flat arrays in transcript order 
+    (reversed for transcripts on the negative strand).  the exons of the
+    transcript with tid 't' are at indexes exon_index[t] to 
+    exon_index[t+1], and 'exon_offsets' holds the transcript position 
+    where each exon begins so that the exon containing a position is
+    found by bisection
+    """
+    def __init__(self, num_tids):
+        self.references = []
+        self.ref_ids = array('l', [-1] * num_tids)
+        self.negstrand = array('b', [0] * num_tids)
+        self.exon_index = array('l', [0] * (num_tids + 1))
+        self.exon_starts = array('l')
+        self.exon_ends = array('l')
+        self.exon_offsets = array('l')
+
+    @staticmethod
+    def build(feature_iter, rname_tid_map, ref_id_map=None):
+        """
+        builds the map from transcript features.  'rname_tid_map' maps 
+        transcript names to tids.  'ref_id_map' maps chromosome names to
+        the reference ids returned by lookups (such as the tids of a 
+        genome BAM file), otherwise ids are assigned in order of
+        appearance and the names are kept in 'references'
+        """
+        num_tids = (max(rname_tid_map.itervalues()) + 1) if rname_tid_map else 0
+        m = TranscriptCoordinateMap(num_tids)
+        if ref_id_map is None:
+            ref_id_map = {}
+            assign_ids = True
+        else:
+            assign_ids = False
+        tid_exons = {}
+        for f in feature_iter:
+            tid = rname_tid_map[str(f.tx_id)]
+            if tid in tid_exons:
+                logging.error("Duplicate references %s found in bed file" % (f.tx_id))
+            if assign_ids and (f.chrom not in ref_id_map):
+                ref_id_map[f.chrom] = len(m.references)
+                m.references.append(f.chrom)
+            m.ref_ids[tid] = ref_id_map[f.chrom]
+            negstrand = (f.strand == '-')
+            m.negstrand[tid] = negstrand
+            exons = [(start, end) for start, end in f.exons]
+            if negstrand:
+                exons.reverse()
+            tid_exons[tid] = exons
+        # lay out the exons in tid order
+        for tid in xrange(num_tids):
+            m.exon_index[tid] = len(m.exon_starts)
+            offset = 0
+            for start, end in tid_exons.get(tid, ()):
+                m.exon_starts.append(start)
+                m.exon_ends.append(end)
+                m.exon_offsets.append(offset)
+                offset += end - start
+        m.exon_index[num_tids] = len(m.exon_starts)
+        return m
+
+    def __contains__(self, tid):
+        return (0 <= tid < len(self.ref_ids)) and (self.ref_ids[tid] >= 0)
+
+    def transcript_length(self, tid):
+        last = self.exon_index[tid + 1] - 1
+        if last < self.exon_index[tid]:
+            return 0
+        return self.exon_offsets[last] + self.exon_ends[last] - self.exon_starts[last]
+
+    def find_exon(self, tid, pos):
+        """
+        returns the index into the exon arrays of the exon containing
+        transcript position 'pos', or -1 if 'pos' is past the end
+        """
+        lo = self.exon_index[tid]
+        hi = self.exon_index[tid + 1]
+        i = bisect.bisect_right(self.exon_offsets, pos, lo, hi) - 1
+        if (i < lo) or (pos >= self.exon_offsets[i] + self.exon_ends[i] - self.exon_starts[i]):
+            return -1
+        return i
+
+    def genome_pos(self, tid, pos):
+        """
+        translates transcript position 'pos' to the genome.  returns a 
+        tuple (reference id, negative strand, position) or None if 
+        'pos' is outside the transcript
+        """
+        i = self.find_exon(tid, pos)
+        if i < 0:
+            return None
+        toffset = pos - self.exon_offsets[i]
+        if self.negstrand[tid]:
+            return self.ref_ids[tid], 1, self.exon_ends[i] - toffset - 1
+        return self.ref_ids[tid], 0, self.exon_starts[i] + toffset
@@ -7,9 +7,17 @@ import os
 import sys
 import subprocess
 import logging
+import threading
+import Queue
+from itertools import chain, izip
 
 from chimerascan.lib import config
-from chimerascan.lib.base import LibraryTypes
+from chimerascan.lib.base import LibraryTypes, open_compressed
+from chimerascan.lib.fastq import FASTQBatch, parse_fastq_batches
+from chimerascan.lib.resource_usage import wait_process, begin_pipe
+from chimerascan.lib.resource_planner import PipeCalibration
+from chimerascan.lib.sam import soft_pad_sam_fields
+from chimerascan.lib.bam_writer import start_bam_writer, compression_threads
 
 import chimerascan.pipeline
 
@@ -27,6 +35,52 @@ def get_bowtie_library_type(library_type):
     """
     return library_type[0:2]
 
+def max_converter_workers(num_processors):
+    """
+    most converter worker processes given to a pipe so that the aligner
+    keeps at least half of the processors
+    """
+    return max(1, num_processors // 2)
+
+def _convert_to_genome_bam(aln_p, genome_index, transcript_file, 
+                           library_type, bam_file, logfh, plan, 
+                           calibration, pipe_name):
+    """
+    pipes the SAM output of the aligner process 'aln_p' through the
+    transcriptome to genome converter into a genomic BAM file, using the
+    threads given by 'plan'.  when everything succeeds the cpu time of
+    each process is added to 'calibration' under 'pipe_name'
+    """
+    # pipe the bowtie SAM output to a transcriptome to genome conversion
+    # script that writes a genomic BAM file
+    py_script = os.path.join(_pipeline_dir, "transcriptome_to_genome.py")
+    args = [sys.executable, py_script, "--library-type", library_type, 
+            "--input-sam", "--output-sam", "--workers", plan.num_converters,
+            genome_index, transcript_file, "-", "-"]
+    args = map(str, args)
+    logging.debug("Transcriptome to Genome converter args: %s" % 
+                  (' '.join(args)))
+    convert_p = subprocess.Popen(args, stdin=aln_p.stdout, stdout=subprocess.PIPE, stderr=logfh)
+    # pipe the SAM output to a BAM writer with multithreaded compression
+    sam2bam_p, sam2bam_name = start_bam_writer(convert_p.stdout, bam_file, logfh,
+                                               plan.compression_threads)
+    # wait for this to finish
+    retcode = wait_process(sam2bam_p, sam2bam_name)
+    if retcode != 0:
+        convert_p.terminate()
+        aln_p.terminate()
+        return config.JOB_ERROR
+    retcode = wait_process(convert_p, "transcriptome_to_genome")
+    if retcode != 0:
+        aln_p.terminate()
+        return config.JOB_ERROR
+    retcode = wait_process(aln_p, "bowtie2")
+    if retcode != 0:
+        return config.JOB_ERROR
+    calibration.record(pipe_name, aln_p.usage, [convert_p.usage], 
+                       [sam2bam_p.usage])
+    return config.JOB_SUCCESS
+
 def bowtie2_align_transcriptome_pe(transcriptome_index,
                                    genome_index,
                                    transcript_file,                                   
@@ -38,10 +92,13 @@ def bowtie2_align_transcriptome_pe(transcriptome_index,
                                    min_fragment_length=0,
                                    max_fragment_length=1000,
                                    max_transcriptome_hits=1,
-                                   num_processors=1):
+                                   num_processors=1,
+                                   calibration_file=None):
     """
     align reads to a transcriptome index, convert SAM to BAM,
-    and translate alignments to genomic coordinates
+    and translate alignments to genomic coordinates.  the processors
+    are divided between bowtie2, the converter and BAM compression
+    using the measurements in 'calibration_file' (see PipeCalibration)
     """
     # check num processors
     if num_processors < 2:
@@ -55,7 +112,10 @@ def bowtie2_align_transcriptome_pe(transcriptome_index,
     # setup bowtie2 command line args
     args = [config.BOWTIE2_BIN]
     args.extend(_bowtie2_pe_args)
-    args.extend(['-p', num_processors-1, 
+    calibration = PipeCalibration(calibration_file)
+    plan = calibration.plan("transcriptome_pe", num_processors,
+                            max_converters=max_converter_workers(num_processors))
+    args.extend(['-p', plan.aligner_threads, 
                  '-M', max_transcriptome_hits,
                  '-I', min_fragment_length,
                  '-X', max_fragment_length,
@@ -68,35 +128,11 @@ def bowtie2_align_transcriptome_pe(transcriptome_index,
     logging.debug("Alignment args: %s" % (' '.join(args)))    
     # kickoff alignment process
     logfh = open(log_file, "w")
+    begin_pipe()
     aln_p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=logfh)
-    # pipe the bowtie SAM output to a transcriptome to genome conversion
-    # script that writes a genomic BAM file
-    py_script = os.path.join(_pipeline_dir, "transcriptome_to_genome.py")
-    args = [sys.executable, py_script, "--library-type", library_type, 
-            "--input-sam", "--output-sam", genome_index, transcript_file, 
-            "-", "-"]
-    args = map(str, args)
-    logging.debug("Transcriptome to Genome converter args: %s" % 
-                  (' '.join(args)))
-    convert_p = subprocess.Popen(args, stdin=aln_p.stdout, stdout=subprocess.PIPE, stderr=logfh)
-    # pipe the SAM output to a filter that writes in BAM format
-    py_script = os.path.join(_pipeline_dir, "sam_to_bam.py")
-    args = [sys.executable, py_script, "-", bam_file] 
-    logging.debug("SAM to BAM converter args: %s" % (' '.join(args)))
-    sam2bam_p = subprocess.Popen(args, stdin=convert_p.stdout, stderr=logfh)    
-    # wait for this to finish
-    retcode = sam2bam_p.wait()
-    if retcode != 0:
-        convert_p.terminate()
-        aln_p.terminate()
-        return config.JOB_ERROR
-    retcode = convert_p.wait()
-    if retcode != 0:
-        aln_p.terminate()
-        return config.JOB_ERROR
-    retcode = aln_p.wait()
-    if retcode != 0:
-        return config.JOB_ERROR        
+    retcode = _convert_to_genome_bam(aln_p, genome_index, transcript_file,
+                                     library_type, bam_file, logfh, plan,
+                                     calibration, "transcriptome_pe")
     logfh.close()
     return retcode
 
@@ -127,48 +163,127 @@ def bowtie2_align_pe(index,
     logging.debug("Alignment args: %s" % (' '.join(args)))    
     # kickoff alignment process
     logfh = open(log_file, "w")
+    begin_pipe()
     aln_p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=logfh)
-    # pipe the bowtie SAM output to a filter that writes in BAM format
-    py_script = os.path.join(_pipeline_dir, "sam_to_bam.py")
-    args = [sys.executable, py_script, "-", bam_file] 
-    logging.debug("SAM to BAM converter args: %s" % (' '.join(args)))
-    sam2bam_p = subprocess.Popen(args, stdin=aln_p.stdout, stderr=logfh)
+    # pipe the SAM output to a BAM writer with multithreaded compression
+    sam2bam_p, sam2bam_name = start_bam_writer(aln_p.stdout, bam_file, logfh,
+                                               compression_threads(num_processors))
     # wait for this to finish
-    retcode = sam2bam_p.wait()
+    retcode = wait_process(sam2bam_p, sam2bam_name)
     if retcode != 0:
         aln_p.terminate()
         return config.JOB_ERROR
-    retcode = aln_p.wait()
+    retcode = wait_process(aln_p, "bowtie2")
     if retcode != 0:
         return config.JOB_ERROR        
     logfh.close()
     return retcode
 
-def parse_fastq(line_iter):
-    with line_iter:
-        while True:
-            lines = [line_iter.next().rstrip() for x in xrange(4)]
-            yield lines
+# number of batches of full length reads held in memory while their
+# trimmed copies are aligned.  bowtie2 '--reorder' returns the reads
+# in input order so only the reads being aligned need to be kept
+PESR_RING_BATCHES = 8
+
+def merge_fastq_batches(infiles):
+    """
+    generator of FASTQBatch objects with the mates of each fragment
+    interleaved.  the mate index ('0' or '1') is added to the beginning
+    of each read name
+    """
+    fqiters = [parse_fastq_batches(open_compressed(f)) for f in infiles]
+    while True:
+        pe_batches = [next(fqiter, None) for fqiter in fqiters]
+        if all(batch is None for batch in pe_batches):
+            break
+        if (any(batch is None for batch in pe_batches) or
+            len(set(len(batch.names) for batch in pe_batches)) > 1):
+            raise ValueError("mate files %s have different numbers of reads" %
+                             (', '.join(infiles)))
+        # interleave the mates of each fragment
+        names = []
+        seqs = []
+        quals = []
+        for readnum,batch in enumerate(pe_batches):
+            # encode a '0' or '1' as the first character of the line
+            prefix = "@%d" % (readnum)
+            names.append([(prefix + name[1:]) for name in batch.names])
+            seqs.append(batch.seqs)
+            quals.append(batch.quals)
+        yield FASTQBatch(list(chain(*izip(*names))), 
+                         list(chain(*izip(*seqs))),
+                         list(chain(*izip(*quals))))
 
-def trim_and_merge_fastq(infiles, outfh, trimmed_outfh, segment_length):
-    fqiters = [parse_fastq(open(f)) for f in infiles]    
+def _feed_trimmed_reads(infiles, segment_length, outfh, ring, errors):
+    """
+    puts the full length reads in 'ring' and writes their first 
+    'segment_length' bases to 'outfh'.  runs in a separate thread
+    """
     try:
-        while True:
-            pe_lines = [fqiter.next() for fqiter in fqiters]
-            for readnum,lines in enumerate(pe_lines):
-                # encode a '0' or '1' as the first character of the line
-                lines[0] = "@%d%s" % (readnum, lines[0][1:])
-                seqlen = len(lines[1])
-                # output full length reads
-                print >>outfh, '\n'.join(lines)
-                # output trimmed reads                
-                if seqlen > segment_length:
-                    lines[1] = lines[1][:segment_length]
-                    lines[3] = lines[3][:segment_length]
-                print >>trimmed_outfh, '\n'.join(lines)
-    except StopIteration:
-        pass
-    return config.JOB_SUCCESS
+        for batch in merge_fastq_batches(infiles):
+            ring.put(batch)
+            trimmed = FASTQBatch(batch.names, 
+                                 [seq[:segment_length] for seq in batch.seqs],
+                                 [qual[:segment_length] for qual in batch.quals])
+            outfh.write(trimmed.to_string())
+    except:
+        errors.append(sys.exc_info()[1])
+    finally:
+        # close the aligner input before waiting for space in the ring
+        try:
+            outfh.close()
+        except IOError:
+            pass
+        ring.put(None)
+
+def _iter_ring_records(ring):
+    """
+    generator of (qname, readnum, seq, qual) tuples of the full length
+    reads taken from 'ring'
+    """
+    while True:
+        batch = ring.get()
+        if batch is None:
+            break
+        for name,seq,qual in izip(batch.names, batch.seqs, batch.quals):
+            yield name[1:-2], int(name[-1]), seq, qual
+
+def pad_pesr_sam(samfh, ring, outfh):
+    """
+    reads the SAM output of the trimmed reads from 'samfh', restores
+    the full length reads from 'ring', sets the paired-end flags, and
+    writes the records to 'outfh'.  returns the number of records
+    """
+    fqiter = _iter_ring_records(ring)
+    qname = None
+    num_reads = 0
+    for line in samfh:
+        if line.startswith('@'):
+            outfh.write(line)
+            continue
+        fields = line.rstrip('\n').split('\t')
+        # get next fastq record
+        while fields[0] != qname:
+            try:
+                qname, readnum, seq, qual = fqiter.next()
+            except StopIteration:
+                raise ValueError("read %s not found in FASTQ input" % (fields[0]))
+        # remove mate number from qname
+        fields[0] = qname[1:]
+        # pad read that has been trimmed
+        soft_pad_sam_fields(fields, seq, qual)
+        # reset paired-end flags for read, and remove the secondary bit
+        # because it does not make sense for paired-end alignments
+        flag = (int(fields[1]) | 0x1 | (0x40 if readnum == 1 else 0x80)) & ~0x100
+        fields[1] = str(flag)
+        outfh.write('\t'.join(fields))
+        outfh.write('\n')
+        num_reads += 1
+    # every read should have an alignment record.  reading the rest of
+    # the ring also lets the feeding thread finish
+    num_missing = sum(1 for x in fqiter)
+    if num_missing > 0:
+        raise ValueError("%d reads missing from alignment output" % (num_missing))
+    return num_reads
 
 def bowtie2_align_pe_sr(index,
                         transcript_file,
@@ -179,55 +294,66 @@ def bowtie2_align_pe_sr(index,
                         segment_length,
                         max_hits=1,
                         num_processors=1):
-    # create tmp interleaved fastq file
-    interleaved_fastq_file = os.path.join(tmp_dir, config.INTERLEAVED_FASTQ_FILE)
-    interleaved_trimmed_fastq_file = os.path.join(tmp_dir, config.INTERLEAVED_TRIMMED_FASTQ_FILE)
-    fqfh = open(interleaved_fastq_file, 'w')
-    trimmed_fqfh = open(interleaved_trimmed_fastq_file, 'w')
-    retcode = trim_and_merge_fastq(fastq_files, 
-                                   fqfh, trimmed_fqfh,
-                                   segment_length)
-    fqfh.close()
-    trimmed_fqfh.close()
-    if retcode != config.JOB_SUCCESS:
-        logging.error("[FAILED] trimming FASTQ files")
-        if os.path.exists(interleaved_fastq_file):
-            os.remove(interleaved_fastq_file)
-        if os.path.exists(interleaved_trimmed_fastq_file):
-            os.remove(interleaved_trimmed_fastq_file)
-        return config.JOB_ERROR
-    #
-    # Align trimmed reads
-    #
+    """
+    aligns the first 'segment_length' bases of each mate as single reads
+    and writes them to 'bam_file' padded back to full length.  the 
+    trimmed reads are streamed to bowtie2 while the full length reads
+    wait in memory for their alignments, so no temporary files are used
+    """
     logfh = open(log_file, "w")
-    # setup bowtie2 library type param
     args = [config.BOWTIE2_BIN]
     args.extend(_bowtie2_pe_sr_args)
     args.extend(['-p', num_processors, 
                  '-k', max_hits,
                  '-x', index,
-                 '-U', interleaved_trimmed_fastq_file])
+                 '-U', '-'])
     args = map(str, args)
     logging.debug("Alignment args: %s" % (' '.join(args)))
-    aln_p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=logfh)
+    begin_pipe()
+    aln_p = subprocess.Popen(args, stdin=subprocess.PIPE, 
+                             stdout=subprocess.PIPE, stderr=logfh)
+    sam2bam_p, sam2bam_name = start_bam_writer(subprocess.PIPE, bam_file, logfh,
+                                               compression_threads(num_processors))
+    # feed the trimmed reads to bowtie2 from a separate thread
+    ring = Queue.Queue(PESR_RING_BATCHES)
+    feed_errors = []
+    feeder = threading.Thread(target=_feed_trimmed_reads,
+                              args=(fastq_files, segment_length, aln_p.stdin, 
+                                    ring, feed_errors))
+    feeder.daemon = True
+    feeder.start()
     #
-    # Convert to BAM, also extend sequences back to full length by 
-    # adding padding to CIGAR string
+    # Extend sequences back to full length by adding padding to CIGAR 
+    # string and convert to BAM
     #
-    py_script = os.path.join(_pipeline_dir, "sam_to_bam_pesr.py")
-    args = [sys.executable, py_script, "-", interleaved_fastq_file, bam_file]
-    logging.debug("SAM to BAM converter args: %s" % (' '.join(args)))
-    sam2bam_p = subprocess.Popen(args, stdin=aln_p.stdout, stderr=logfh)
-    retcode = sam2bam_p.wait()
-    if retcode != 0:
-        logging.debug("Error during SAM to BAM conversion")
+    retcode = config.JOB_SUCCESS
+    try:
+        num_reads = pad_pesr_sam(aln_p.stdout, ring, sam2bam_p.stdin)
+        logging.debug("Found %d reads" % (num_reads))
+    except (ValueError, IOError) as e:
+        logging.error("Error during SAM to BAM conversion: %s" % (str(e)))
+        retcode = config.JOB_ERROR
+    try:
+        sam2bam_p.stdin.close()
+    except IOError:
+        retcode = config.JOB_ERROR
+    if retcode != config.JOB_SUCCESS:
         aln_p.terminate()
-        return config.JOB_ERROR
-    retcode = aln_p.wait()
-    if retcode != 0:
+        sam2bam_p.terminate()
+    else:
+        feeder.join()
+        if len(feed_errors) > 0:
+            logging.error("Error reading FASTQ files: %s" % (str(feed_errors[0])))
+            retcode = config.JOB_ERROR
+    if wait_process(sam2bam_p, sam2bam_name) != 0:
+        logging.debug("Error during SAM to BAM conversion")
+        retcode = config.JOB_ERROR
+    if wait_process(aln_p, "bowtie2") != 0:
         logging.debug("Error during alignment")
-        return config.JOB_ERROR        
+        retcode = config.JOB_ERROR
     logfh.close()
+    if (retcode != config.JOB_SUCCESS) and os.path.exists(bam_file):
+        os.remove(bam_file)
     return retcode
 
 def bowtie2_align_local(transcriptome_index,
@@ -238,10 +364,12 @@ def bowtie2_align_local(transcriptome_index,
                         log_file,
                         local_anchor_length,
                         local_multihits,
-                        num_processors=1):
+                        num_processors=1,
+                        calibration_file=None):
     """
     align reads to a transcriptome index, convert SAM to BAM,
-    and translate alignments to genomic coordinates
+    and translate alignments to genomic coordinates.  processors are
+    divided as in bowtie2_align_transcriptome_pe
     """
     # check num processors
     if num_processors < 2:
@@ -254,6 +382,9 @@ def bowtie2_align_local(transcriptome_index,
     seed_length = local_anchor_length
     # minimum score to report and alignment is twice local anchor length
     score_min = 2*local_anchor_length
+    calibration = PipeCalibration(calibration_file)
+    plan = calibration.plan("local", num_processors,
+                            max_converters=max_converter_workers(num_processors))
     # setup bowtie2 command line args
     args = [config.BOWTIE2_BIN,
             '-q',
@@ -265,7 +396,7 @@ def bowtie2_align_local(transcriptome_index,
             '--score-min', 'C,%d,0' % (score_min),
             '-k', local_multihits,
             '-R', '2',
-            '-p', num_processors-1,             
+            '-p', plan.aligner_threads,
             '--reorder',
             '-x', transcriptome_index,
             '-U', fastq_file]
@@ -273,36 +404,11 @@ def bowtie2_align_local(transcriptome_index,
     logging.debug("Alignment args: %s" % (' '.join(args)))    
     # kickoff alignment process
     logfh = open(log_file, "w")
+    begin_pipe()
     aln_p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=logfh)
-    # pipe the bowtie SAM output to a transcriptome to genome conversion
-    # script that writes a genomic BAM file
-    py_script = os.path.join(_pipeline_dir, "transcriptome_to_genome.py")
-    args = [sys.executable, py_script, 
-            "--library-type", LibraryTypes.FR_UNSTRANDED,
-            "--input-sam", "--output-sam", genome_index, transcript_file, 
-            "-", "-"]
-    args = map(str, args)
-    logging.debug("Transcriptome to Genome converter args: %s" % 
-                  (' '.join(args)))
-    convert_p = subprocess.Popen(args, stdin=aln_p.stdout, stdout=subprocess.PIPE, stderr=logfh)
-    # pipe the SAM output to a filter that writes in BAM format
-    py_script = os.path.join(_pipeline_dir, "sam_to_bam.py")
-    args = [sys.executable, py_script, "-", bam_file] 
-    logging.debug("SAM to BAM converter args: %s" % (' '.join(args)))
-    sam2bam_p = subprocess.Popen(args, stdin=convert_p.stdout, stderr=logfh)    
-    # wait for this to finish
-    retcode = sam2bam_p.wait()
-    if retcode != 0:
-        convert_p.terminate()
-        aln_p.terminate()
-        return config.JOB_ERROR
-    retcode = convert_p.wait()
-    if retcode != 0:
-        aln_p.terminate()
-        return config.JOB_ERROR
-    retcode = aln_p.wait()
-    if retcode != 0:
-        return config.JOB_ERROR        
+    retcode = _convert_to_genome_bam(aln_p, genome_index, transcript_file,
+                                     LibraryTypes.FR_UNSTRANDED, bam_file, logfh, plan,
+                                     calibration, "local")
     logfh.close()
     return retcode
 
@@ -325,20 +431,19 @@ def bowtie2_align_sr(index,
             '-U', fastq_file]
     args = map(str, args)
     logging.debug("Alignment args: %s" % (' '.join(args)))
+    begin_pipe()
     aln_p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=logfh)
-    # pipe the bowtie SAM output to a filter that writes in BAM format
-    py_script = os.path.join(_pipeline_dir, "sam_to_bam.py")
-    args = [sys.executable, py_script, "-", bam_file] 
-    logging.debug("SAM to BAM converter args: %s" % (' '.join(args)))
-    sam2bam_p = subprocess.Popen(args, stdin=aln_p.stdout, stderr=logfh)
+    # pipe the SAM output to a BAM writer with multithreaded compression
+    sam2bam_p, sam2bam_name = start_bam_writer(aln_p.stdout, bam_file, logfh,
+                                               compression_threads(num_processors))
     # wait for this to finish
-    retcode = sam2bam_p.wait()
+    retcode = wait_process(sam2bam_p, sam2bam_name)
     if retcode != 0:
         if os.path.exists(bam_file):
             os.remove(bam_file)
         aln_p.terminate()
     else:
-        retcode = aln_p.wait()
+        retcode = wait_process(aln_p, "bowtie2")
         if retcode != 0:
             if os.path.exists(bam_file):
                 os.remove(bam_file)
@@ -148,7 +148,8 @@ def realign_across_breakpoints(index_dir,
                         log_file,
                         local_anchor_length=local_anchor_length,
                         local_multihits=local_multihits,
-                        num_processors=num_processors)
+                        num_processors=num_processors,
+                        calibration_file=os.path.join(tmp_dir, config.PIPE_CALIBRATION_FILE))
     cluster_shelve.close()
     return config.JOB_SUCCESS
 
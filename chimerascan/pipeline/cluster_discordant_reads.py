@@ -14,10 +14,11 @@ import pysam
 
 from chimerascan.bx.cluster import ClusterTree
 from chimerascan.lib import config
-from chimerascan.lib.sam import get_aligned_intervals
+from chimerascan.lib.sam import get_aligned_intervals, set_tags
 from chimerascan.lib.chimera import ORIENTATION_TAG, ORIENTATION_5P, \
     ORIENTATION_3P, DISCORDANT_CLUSTER_TAG, DiscordantCluster, \
     discordant_cluster_to_string
+from chimerascan.lib.duplicates import FragmentMultiplicity, count_fragments
 
 def window_overlap(a, b):
     if a[0] != b[0]:
@@ -80,14 +81,13 @@ def get_unpaired_frags(bamfh, rname, start, end, strand, orientation):
     return qnames
 
 def create_cluster(rname, start, end, cluster_id, strand, orientation, 
-                   reads, unpaired_bamfh, concordant_bamfh):
+                   reads, unpaired_bamfh, concordant_bamfh, 
+                   multiplicity=None):
     cluster_tree = ClusterTree(0,1)
     qnames = []
     for i,r in enumerate(reads):
         # add cluster tag to every read
-        tagdict = collections.OrderedDict(r.tags)
-        tagdict[DISCORDANT_CLUSTER_TAG] = cluster_id
-        r.tags = tagdict.items()
+        set_tags(r, [(DISCORDANT_CLUSTER_TAG, cluster_id)])
         # keep read names
         qnames.append(r.qname)
         # cluster "exonic" intervals
@@ -116,11 +116,13 @@ def create_cluster(rname, start, end, cluster_id, strand, orientation,
                                 exons=exons,
                                 qnames=qnames,
                                 unpaired_qnames=unpaired_qnames,                               
-                                concordant_frags=len(concordant_qnames))
+                                concordant_frags=count_fragments(concordant_qnames, 
+                                                                 multiplicity))
     return cluster
 
 def add_reads_to_clusters(reads, next_cluster_id, discordant_bamfh, 
-                          unpaired_bamfh, concordant_bamfh):
+                          unpaired_bamfh, concordant_bamfh, 
+                          multiplicity=None):
     # insert reads into clusters
     cluster_trees = {("+", ORIENTATION_5P): collections.defaultdict(lambda: ClusterTree(0,1)),
                      ("+", ORIENTATION_3P): collections.defaultdict(lambda: ClusterTree(0,1)),
@@ -146,7 +148,7 @@ def add_reads_to_clusters(reads, next_cluster_id, discordant_bamfh,
                 cluster = create_cluster(rname, start, end, cluster_id, 
                                          strand, orientation, 
                                          cluster_reads, unpaired_bamfh, 
-                                         concordant_bamfh)
+                                         concordant_bamfh, multiplicity)
                 clusters.append(cluster)
                 next_cluster_id += 1
     return clusters, next_cluster_id
@@ -156,7 +158,8 @@ def cluster_discordant_reads(discordant_bam_file,
                              concordant_bam_file, 
                              output_bam_file, 
                              cluster_file,
-                             cluster_shelve_file):
+                             cluster_shelve_file,
+                             multiplicity_file=None):
     #
     # iterate through sorted discordant read alignments and form clusters
     # of overlapping alignments
@@ -168,12 +171,16 @@ def cluster_discordant_reads(discordant_bam_file,
     outbamfh = pysam.Samfile(output_bam_file, "wb", template=discordant_bamfh)
     outfh = open(cluster_file, "w")
     db = shelve.open(cluster_shelve_file)
+    # concordant fragments are weighted by their duplicate counts
+    multiplicity = None
+    if multiplicity_file is not None:
+        multiplicity = FragmentMultiplicity(multiplicity_file)
     next_cluster_id = 0
     for locus_reads in cluster_loci(iter(discordant_bamfh)):
         locus_clusters, next_cluster_id = \
             add_reads_to_clusters(locus_reads, next_cluster_id, 
                                   discordant_bamfh, unpaired_bamfh, 
-                                  concordant_bamfh)
+                                  concordant_bamfh, multiplicity)
         for cluster in locus_clusters:
             # write to shelve database
             db[str(cluster.cluster_id)] = cluster
@@ -184,6 +191,8 @@ def cluster_discordant_reads(discordant_bam_file,
             outbamfh.write(r)
     db.close()
     outfh.close()
+    if multiplicity is not None:
+        multiplicity.close()
     outbamfh.close()
     concordant_bamfh.close()
     unpaired_bamfh.close()
@@ -199,6 +208,8 @@ def main():
     logging.basicConfig(level=logging.DEBUG,
                         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     parser = argparse.ArgumentParser()
+    parser.add_argument("--multiplicity-file", dest="multiplicity_file",
+                        default=None)
     parser.add_argument("discordant_bam_file") 
     parser.add_argument("unpaired_bam_file") 
     parser.add_argument("concordant_bam_file") 
@@ -211,7 +222,8 @@ def main():
                                     args.concordant_bam_file, 
                                     args.output_bam_file, 
                                     args.cluster_file,
-                                    args.cluster_shelve_file)
+                                    args.cluster_shelve_file,
+                                    args.multiplicity_file)
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
@@ -5,19 +5,35 @@ Created on Jun 2, 2011
 '''
 import logging
 import collections
+import itertools
+import multiprocessing
 import os
 import sys
+import shutil
+import tempfile
 import argparse
 
 import pysam
 
 from chimerascan.lib import config
 from chimerascan.lib.base import LibraryTypes
-from chimerascan.lib.sam import parse_pe_reads, pair_reads, copy_read, select_best_scoring_pairs
+from chimerascan.lib.sam import parse_pe_reads, pair_reads, copy_read, \
+    select_best_scoring_pairs, set_tags
 from chimerascan.lib.feature import TranscriptFeature
-from chimerascan.lib.transcriptome import build_tid_transcript_genome_map, transcript_to_genome_pos
+from chimerascan.lib.transcriptome import TranscriptCoordinateMap
 from chimerascan.lib.chimera import DiscordantTags, DISCORDANT_TAG_NAME, \
     ORIENTATION_TAG, ORIENTATION_5P, ORIENTATION_3P, get_orientation
+from chimerascan.lib.bam_writer import concatenate_bam_files
+from chimerascan.lib.bgzf import iter_bam_read_names
+
+# fragment categories in the order of the output files
+FRAGMENT_CATEGORIES = ("paired", "discordant", "unpaired", "unmapped", 
+                       "multimap", "unresolved")
+# number of fragments classified by a worker at a time
+CLASSIFY_CHUNK_FRAGMENTS = 50000
+# fewest workers for which a pool beats classifying in one process,
+# since the parent also spends a processor finding the chunks
+CLASSIFY_MIN_POOL_WORKERS = 3
 
 def build_tid_transcript_map(bamfh, feature_iter):
     rname_tid_map = dict((rname,tid) for tid,rname in enumerate(bamfh.references))
@@ -28,16 +44,16 @@ def build_tid_transcript_map(bamfh, feature_iter):
         tid_tx_map[tid] = f
     return tid_tx_map
 
-def count_transcriptome_multimaps(bamfh, reads, tid_tx_genome_map):
+def count_transcriptome_multimaps(reads, coord_map):
     hits = set()
     for r in reads:
         if r.is_unmapped:
             return 0
         # TODO: remove assert statement
-        assert r.tid in tid_tx_genome_map
+        assert r.tid in coord_map
         # use the position that is most 5' relative to genome
-        left_tid, left_strand, left_pos = transcript_to_genome_pos(r.tid, r.pos, tid_tx_genome_map)
-        right_tid, right_strand, right_pos = transcript_to_genome_pos(r.tid, r.aend-1, tid_tx_genome_map)
+        left_tid, left_strand, left_pos = coord_map.genome_pos(r.tid, r.pos)
+        right_tid, right_strand, right_pos = coord_map.genome_pos(r.tid, r.aend-1)
         hits.add((left_tid, left_pos, right_pos))
     return len(hits)
 
@@ -75,8 +91,8 @@ def classify_unpaired_reads(reads, library_type):
             gene_hits_3p.append(r)
         # add a tag to the sam file describing the read orientation and
         # that it is discordant
-        r.tags = r.tags + [(DISCORDANT_TAG_NAME, DiscordantTags.DISCORDANT_GENE),
-                           (ORIENTATION_TAG, orientation)]                               
+        set_tags(r, [(DISCORDANT_TAG_NAME, DiscordantTags.DISCORDANT_GENE),
+                     (ORIENTATION_TAG, orientation)])
     return gene_hits_5p, gene_hits_3p
 
 def find_discordant_pairs(pe_reads, library_type):
@@ -141,19 +157,21 @@ def classify_read_pairs(pe_reads, max_isize,
                 strand_match = (same_strand == (r1.is_reverse == r2.is_reverse))
                 # these reads can be paired
                 found_pair = True
-                cr1 = copy_read(r1)
-                cr2 = copy_read(r2)                    
                 # this is a hit to same transcript (gene)
                 # pair the reads if strand comparison is correct
                 if strand_match:
                     tags = [(DISCORDANT_TAG_NAME, DiscordantTags.CONCORDANT_TX)]
-                    concordant_tx_pairs.append((cr1,cr2))
+                    pairs = concordant_tx_pairs
                 else:
                     # hit to same gene with wrong strand, which
                     # could happen in certain wacky cases
                     tags = [(DISCORDANT_TAG_NAME, DiscordantTags.DISCORDANT_STRAND_TX)]
-                    discordant_tx_pairs.append((cr1,cr2))
-                pair_reads(cr1,cr2,tags)
+                    pairs = discordant_tx_pairs
+                # copy the reads with their tags set
+                cr1 = copy_read(r1, tags)
+                cr2 = copy_read(r2, tags)
+                pair_reads(cr1,cr2)
+                pairs.append((cr1,cr2))
     # at this point, if we have not been able to find a suitable way
     # to pair the reads, then search within the transcript cluster
     if not found_pair:
@@ -168,15 +186,16 @@ def classify_read_pairs(pe_reads, max_isize,
                     strand_match = (same_strand == (r1.is_reverse == r2.is_reverse))
                     # these reads can be paired
                     found_pair = True
-                    cr1 = copy_read(r1)
-                    cr2 = copy_read(r2)                    
                     if strand_match:
                         tags = [(DISCORDANT_TAG_NAME, DiscordantTags.CONCORDANT_GENE)]
-                        concordant_cluster_pairs.append((cr1,cr2))
+                        pairs = concordant_cluster_pairs
                     else:
                         tags = [(DISCORDANT_TAG_NAME, DiscordantTags.DISCORDANT_STRAND_GENE)]
-                        discordant_cluster_pairs.append((cr1,cr2))
-                    pair_reads(cr1,cr2,tags)
+                        pairs = discordant_cluster_pairs
+                    cr1 = copy_read(r1, tags)
+                    cr2 = copy_read(r2, tags)
+                    pair_reads(cr1,cr2)
+                    pairs.append((cr1,cr2))
     # at this point, we have tried all combinations.  if any paired reads
     # are concordant then return them without considering discordant reads 
     gene_pairs = []
@@ -236,9 +255,9 @@ def write_unpaired_reads(pe_reads, mate_num_hits, library_type, bamfh):
         # find whether read is 5' or 3' orientation
         orientation = get_orientation(r, library_type)
         # add tags containing the seq and quals of the mate
-        r.tags = r.tags + [('R2', unmapped_read.seq),
-                           ('Q2', unmapped_read.qual),
-                           (ORIENTATION_TAG, orientation)]                           
+        set_tags(r, [('R2', unmapped_read.seq),
+                     ('Q2', unmapped_read.qual),
+                     (ORIENTATION_TAG, orientation)])
         bamfh.write(r)
 
 def write_pairs(pairs, bamfh):
@@ -246,71 +265,35 @@ def write_pairs(pairs, bamfh):
         bamfh.write(r1)
         bamfh.write(r2)
 
-def find_discordant_fragments(transcripts,
-                              input_bam_file, 
-                              paired_bam_file, 
-                              discordant_bam_file,
-                              unpaired_bam_file,
-                              unmapped_bam_file,
-                              multimap_bam_file,
-                              unresolved_bam_file,
-                              max_isize, 
-                              max_multihits,
-                              library_type):
+def classify_fragments(pe_reads_iter, outfhs, tid_tx_map, coord_map,
+                       max_isize, max_multihits, library_type):
     """
-    parses BAM file and categorizes reads into several groups:
-    - concordant
-    - discordant within gene (splicing isoforms)
-    - discordant between different genes (chimeras)
+    classifies the fragments from 'pe_reads_iter' and writes their reads
+    to the file in 'outfhs' for each category, which holds one output
+    file per category in FRAGMENT_CATEGORIES.  returns a Counter with 
+    the number of fragments in each category
     """
-    logging.debug("Finding discordant read pair combinations")
-    logging.debug("\tInput file: %s" % (input_bam_file))
-    logging.debug("\tMax insert size: '%d'" % (max_isize))
-    logging.debug("\tLibrary type: '%s'" % (library_type))
-    logging.debug("\tPaired BAM file: %s" % (paired_bam_file))
-    logging.debug("\tUnpaired BAM file: %s" % (unpaired_bam_file))
-    logging.debug("\tUnmapped BAM file: %s" % (unmapped_bam_file))
-    logging.debug("\tMultimap BAM file: %s" % (multimap_bam_file))
-    logging.debug("\tUnresolved BAM file: %s" % (unresolved_bam_file))
-    # setup input and output files
-    bamfh = pysam.Samfile(input_bam_file, "rb")
-    pairedfh = pysam.Samfile(paired_bam_file, "wb", template=bamfh)
-    discordantfh = pysam.Samfile(discordant_bam_file, "wb", template=bamfh)
-    unpairedfh = pysam.Samfile(unpaired_bam_file, "wb", template=bamfh)
-    unmappedfh = pysam.Samfile(unmapped_bam_file, "wb", template=bamfh)
-    multimapfh = pysam.Samfile(multimap_bam_file, "wb", template=bamfh)
-    unresolvedfh = pysam.Samfile(unresolved_bam_file, "wb", template=bamfh)
-    # build a lookup table from bam tid index to transcript object
-    logging.debug("Building transcript lookup tables")
-    tid_tx_map = build_tid_transcript_map(bamfh, transcripts)
-    tid_tx_genome_map = build_tid_transcript_genome_map(bamfh, transcripts)
-    # build a transcript to genome coordinate map
-    logging.debug("Parsing and classifying reads")
-    num_unmapped = 0
-    num_unpaired = 0
-    num_multimap = 0
-    num_paired = 0
-    num_discordant = 0
-    num_unresolved = 0
-    for pe_reads in parse_pe_reads(bamfh):
+    pairedfh, discordantfh, unpairedfh, unmappedfh, multimapfh, unresolvedfh = outfhs
+    counts = collections.Counter()
+    for pe_reads in pe_reads_iter:
         # count multimapping
         mate_num_hits = [0, 0]
         for rnum,reads in enumerate(pe_reads):
-            num_hits = count_transcriptome_multimaps(bamfh, reads, tid_tx_genome_map)
+            num_hits = count_transcriptome_multimaps(reads, coord_map)
             mate_num_hits[rnum] = num_hits
         if max(mate_num_hits) > max_multihits:
             # if either mate has many genome mappings then write
             # the reads to the multimapping bam file
-            write_pe_reads(multimapfh, pe_reads)
-            num_multimap += 1
+            write_pe_reads(pe_reads, multimapfh)
+            counts['multimap'] += 1
         elif max(mate_num_hits) == 0:
             # if both mates unmapped write to unmapped bam file
-            write_pe_reads(unmappedfh, pe_reads)
-            num_unmapped += 1
+            write_pe_reads(pe_reads, unmappedfh)
+            counts['unmapped'] += 1
         elif min(mate_num_hits) == 0:
             # if one or other mate unmapped then write to the unpaired bam file
             write_unpaired_reads(pe_reads, mate_num_hits, library_type, unpairedfh)
-            num_unpaired += 1
+            counts['unpaired'] += 1
         else:
             # examine all read pairing combinations and rule out invalid pairings
             concordant_pairs, discordant_pairs, unpaired_reads = \
@@ -318,29 +301,200 @@ def find_discordant_fragments(transcripts,
                                     tid_tx_map)             
             if len(concordant_pairs) > 0:
                 write_pairs(concordant_pairs, pairedfh)
-                num_paired += 1
+                counts['paired'] += 1
             elif len(discordant_pairs) > 0:
                 write_pairs(discordant_pairs, discordantfh)
-                num_discordant += 1
+                counts['discordant'] += 1
             else:
                 # both reads in the pair mapped, but no pairings could 
                 # be resolved
                 write_pe_reads(unpaired_reads, unresolvedfh)
-                num_unresolved += 1
-    pairedfh.close()
-    discordantfh.close()
-    unpairedfh.close()
-    unmappedfh.close()
-    multimapfh.close()
-    unresolvedfh.close()
-    bamfh.close()
+                counts['unresolved'] += 1
+    return counts
+
+def _build_lookup_tables(bamfh, transcripts):
+    # build a lookup table from bam tid index to transcript object
+    logging.debug("Building transcript lookup tables")
+    tid_tx_map = build_tid_transcript_map(bamfh, transcripts)
+    # build a transcript to genome coordinate map
+    coord_map = TranscriptCoordinateMap.build(transcripts,
+                                              dict((rname,tid) for tid,rname in enumerate(bamfh.references)))
+    return tid_tx_map, coord_map
+
+def _iter_fragment_chunks(input_bam_file, chunk_size):
+    """
+    generator of (virtual offset, number of reads) tuples that divide
+    'input_bam_file' into chunks of 'chunk_size' fragments.  the reads 
+    of a fragment (same qname) are never split across chunks.  only the
+    read names are decoded, so the chunks are found while the workers
+    classify the previous ones
+    """
+    offset = None
+    num_reads = 0
+    num_frags = 0
+    prev_qname = None
+    for pos, qname in iter_bam_read_names(input_bam_file):
+        if qname != prev_qname:
+            if num_frags == chunk_size:
+                yield offset, num_reads
+                num_reads = 0
+                num_frags = 0
+            if num_frags == 0:
+                offset = pos
+            num_frags += 1
+            prev_qname = qname
+        num_reads += 1
+    if num_reads > 0:
+        yield offset, num_reads
+
+# state of each classifier worker process, set by _init_classify_worker
+_worker_state = None
+
+def _init_classify_worker(input_bam_file, transcripts, max_isize, 
+                          max_multihits, library_type):
+    global _worker_state
+    bamfh = pysam.Samfile(input_bam_file, "rb")
+    tid_tx_map, coord_map = _build_lookup_tables(bamfh, transcripts)
+    _worker_state = (bamfh, tid_tx_map, coord_map, max_isize, 
+                     max_multihits, library_type)
+
+def _classify_chunk(offset, num_reads, output_prefix):
+    """
+    classifies the fragments of a chunk of the input file and writes 
+    them to one BAM file per category named after 'output_prefix'.
+    returns the list of files and the Counter of fragments
+    """
+    bamfh, tid_tx_map, coord_map, max_isize, max_multihits, \
+        library_type = _worker_state
+    bamfh.seek(offset)
+    reads = itertools.islice(bamfh, num_reads)
+    output_files = ["%s.%s.bam" % (output_prefix, category) 
+                    for category in FRAGMENT_CATEGORIES]
+    outfhs = [pysam.Samfile(f, "wb", template=bamfh) for f in output_files]
+    counts = classify_fragments(parse_pe_reads(reads), outfhs, tid_tx_map, 
+                                coord_map, max_isize, max_multihits, 
+                                library_type)
+    for fh in outfhs:
+        fh.close()
+    return output_files, counts
+
+def _find_discordant_fragments_parallel(transcripts, input_bam_file, 
+                                        output_files, max_isize,
+                                        max_multihits, library_type,
+                                        num_workers, tmp_dir):
+    """
+    classifies fragments with a pool of worker processes.  the input 
+    file is divided into chunks of complete fragments that the workers
+    read and classify into their own BAM files.  the files of the chunks
+    are concatenated in their original order, so the output is the same
+    as when the fragments are classified one at a time
+    """
+    chunk_dir = tempfile.mkdtemp(prefix="tmp", dir=tmp_dir)
+    pool = multiprocessing.Pool(num_workers, _init_classify_worker,
+                                (input_bam_file, transcripts, max_isize,
+                                 max_multihits, library_type))
+    counts = collections.Counter()
+    results = []
+    try:
+        chunk_iter = _iter_fragment_chunks(input_bam_file, CLASSIFY_CHUNK_FRAGMENTS)
+        for i,(offset, num_reads) in enumerate(chunk_iter):
+            output_prefix = os.path.join(chunk_dir, "chunk%06d" % (i))
+            results.append(pool.apply_async(_classify_chunk, 
+                                            (offset, num_reads, output_prefix)))
+        chunk_files = [[] for category in FRAGMENT_CATEGORIES]
+        for result in results:
+            files, chunk_counts = result.get()
+            counts.update(chunk_counts)
+            for category_files, f in zip(chunk_files, files):
+                category_files.append(f)
+        pool.close()
+        pool.join()
+        retcode = config.JOB_SUCCESS
+        logging.debug("Concatenating %d classified chunks" % (len(results)))
+        if len(results) == 0:
+            # write empty files with the header of the input
+            bamfh = pysam.Samfile(input_bam_file, "rb")
+            for f in output_files:
+                pysam.Samfile(f, "wb", template=bamfh).close()
+            bamfh.close()
+        else:
+            for category_files, f in zip(chunk_files, output_files):
+                retcode = concatenate_bam_files(category_files, f)
+                if retcode != config.JOB_SUCCESS:
+                    break
+    except:
+        pool.terminate()
+        raise
+    finally:
+        shutil.rmtree(chunk_dir)
+    return retcode, counts
+
+def find_discordant_fragments(transcripts,
+                              input_bam_file, 
+                              paired_bam_file, 
+                              discordant_bam_file,
+                              unpaired_bam_file,
+                              unmapped_bam_file,
+                              multimap_bam_file,
+                              unresolved_bam_file,
+                              max_isize, 
+                              max_multihits,
+                              library_type,
+                              num_workers=1,
+                              tmp_dir=None):
+    """
+    parses BAM file and categorizes reads into several groups:
+    - concordant
+    - discordant within gene (splicing isoforms)
+    - discordant between different genes (chimeras)
+
+    with at least CLASSIFY_MIN_POOL_WORKERS 'num_workers' the fragments
+    are classified by a pool of worker processes that write temporary
+    files in 'tmp_dir' (by default the directory of 'paired_bam_file')
+    """
+    logging.debug("Finding discordant read pair combinations")
+    logging.debug("\tInput file: %s" % (input_bam_file))
+    logging.debug("\tMax insert size: '%d'" % (max_isize))
+    logging.debug("\tLibrary type: '%s'" % (library_type))
+    logging.debug("\tPaired BAM file: %s" % (paired_bam_file))
+    logging.debug("\tUnpaired BAM file: %s" % (unpaired_bam_file))
+    logging.debug("\tUnmapped BAM file: %s" % (unmapped_bam_file))
+    logging.debug("\tMultimap BAM file: %s" % (multimap_bam_file))
+    logging.debug("\tUnresolved BAM file: %s" % (unresolved_bam_file))
+    # output files in the order of FRAGMENT_CATEGORIES
+    output_files = (paired_bam_file, discordant_bam_file, unpaired_bam_file,
+                    unmapped_bam_file, multimap_bam_file, unresolved_bam_file)
+    if num_workers >= CLASSIFY_MIN_POOL_WORKERS:
+        logging.debug("Parsing and classifying reads with %d workers" % 
+                      (num_workers))
+        if tmp_dir is None:
+            tmp_dir = os.path.dirname(os.path.abspath(paired_bam_file))
+        retcode, counts = \
+            _find_discordant_fragments_parallel(transcripts, input_bam_file,
+                                                output_files, max_isize,
+                                                max_multihits, library_type,
+                                                num_workers, tmp_dir)
+        if retcode != config.JOB_SUCCESS:
+            return retcode
+    else:
+        # setup input and output files
+        bamfh = pysam.Samfile(input_bam_file, "rb")
+        outfhs = [pysam.Samfile(f, "wb", template=bamfh) for f in output_files]
+        tid_tx_map, coord_map = _build_lookup_tables(bamfh, transcripts)
+        logging.debug("Parsing and classifying reads")
+        counts = classify_fragments(parse_pe_reads(bamfh), outfhs, 
+                                    tid_tx_map, coord_map, max_isize, 
+                                    max_multihits, library_type)
+        for fh in outfhs:
+            fh.close()
+        bamfh.close()
     logging.debug("Finished pairing reads")
-    logging.debug("\tUnmapped fragments: %d" % (num_unmapped))
-    logging.debug("\tMultimapping fragments: %d" % (num_multimap))
-    logging.debug("\tUnpaired fragments: %d" % (num_unpaired))
-    logging.debug("\tUnresolvable mapped fragments: %d" % (num_unresolved))
-    logging.debug("\tDiscordant fragments: %d" % (num_discordant))
-    logging.debug("\tPaired fragments: %d" % (num_paired))
+    logging.debug("\tUnmapped fragments: %d" % (counts['unmapped']))
+    logging.debug("\tMultimapping fragments: %d" % (counts['multimap']))
+    logging.debug("\tUnpaired fragments: %d" % (counts['unpaired']))
+    logging.debug("\tUnresolvable mapped fragments: %d" % (counts['unresolved']))
+    logging.debug("\tDiscordant fragments: %d" % (counts['discordant']))
+    logging.debug("\tPaired fragments: %d" % (counts['paired']))
     return config.JOB_SUCCESS
 
 def main():
@@ -353,6 +507,7 @@ def main():
                         default=LibraryTypes.FR_UNSTRANDED)
     parser.add_argument('--max-multihits', dest="max_multihits", 
                         default=config.DEFAULT_MAX_MULTIHITS)
+    parser.add_argument('--workers', dest="num_workers", type=int, default=1)
     parser.add_argument("transcript_file")
     parser.add_argument("input_bam_file")
     parser.add_argument("paired_bam_file")
@@ -375,7 +530,8 @@ def main():
                                      args.unresolved_bam_file,
                                      max_isize=args.max_fragment_length,
                                      max_multihits=args.max_multihits,
-                                     library_type=args.library_type)
+                                     library_type=args.library_type,
+                                     num_workers=args.num_workers)
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
@@ -32,14 +32,16 @@ def parse_and_group_cluster_pairs(fh):
     if len(qnames) > 0:
         yield id5p, id3p, qnames 
 
-def pair_discordant_clusters(discordant_bam_file, cluster_pair_file, tmp_dir):
+def pair_discordant_clusters(discordant_bam_file, cluster_pair_file, tmp_dir,
+                             sort_memory=config.DEFAULT_SORT_MEMORY,
+                             sort_buffer_size=config.DEFAULT_SORT_BUFFER_SIZE):
     #
     # sort the BAM file that has cluster annotations by read name
     #
     logging.debug("Sorting newly annotated discordant BAM file by read name")
     qname_sorted_bam_prefix = os.path.join(tmp_dir, os.path.splitext(discordant_bam_file)[0] + ".byname")
     qname_sorted_bam_file = qname_sorted_bam_prefix + ".bam"
-    pysam.sort("-n", "-m", str(int(1e9)), discordant_bam_file, qname_sorted_bam_prefix)
+    pysam.sort("-n", "-m", str(sort_memory), discordant_bam_file, qname_sorted_bam_prefix)
     #
     # iterate through named-sorted bam file write cluster pairs
     #
@@ -77,7 +79,7 @@ def pair_discordant_clusters(discordant_bam_file, cluster_pair_file, tmp_dir):
     batch_sort(input=tmp_cluster_file,
                output=tmp_sorted_cluster_file,
                key=sortfunc,
-               buffer_size=32000,
+               buffer_size=sort_buffer_size,
                tempdirs=[tmp_dir])
     #
     # write cluster pairs
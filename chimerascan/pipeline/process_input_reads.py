@@ -24,71 +24,203 @@ import logging
 import os
 import argparse
 
-from chimerascan.lib.seq import get_qual_conversion_func
-from chimerascan.lib.base import parse_lines, open_compressed
+from chimerascan.lib.seq import get_qual_batch_conversion_table
+from chimerascan.lib.fastq import parse_fastq_batches, next_pe_batches, \
+    parse_subsample, subsample_pe_batches, take
+from chimerascan.lib.base import open_compressed, open_compressed_writer
+from chimerascan.lib.read_names import ReadNameWriter
+from chimerascan.lib.duplicates import DuplicateFilter
+from chimerascan.lib.input_stats import InputStats, QUAL_FORMAT_MIN_CHAR
 import chimerascan.lib.config as config
 
-def process_input_reads(fastq_files, output_prefix, quals, trim5, trim3):
+# number of records written to each streamed mate file at a time.  the
+# chunks must fit in a pipe buffer because paired aligners read the 
+# mates in lockstep
+STREAM_CHUNK_SIZE = 64
+
+def stream_pe_batches(fhs, batches, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    writes the FASTQBatch of each mate to the files 'fhs' alternating 
+    between the mates every 'chunk_size' records.  each file is flushed
+    after every chunk so that a reader that consumes the mates in 
+    lockstep never waits for a mate that is still buffered
+    """
+    for start in xrange(0, len(batches[0]), chunk_size):
+        indexes = slice(start, start + chunk_size)
+        for fh,batch in zip(fhs, batches):
+            fh.write(batch.subset(indexes).to_string())
+            fh.flush()
+
+def process_input_reads(fastq_files, output_prefix, quals, trim5, trim3,
+                        shard_prefixes=None, compress=False, open_streams=None,
+                        num_threads=1, compress_read_names=False,
+                        collapse_duplicates=False, max_duplicates=None,
+                        subsample=None, subsample_seed=0, stats_file=None):
     """
     uncompresses reads, renames reads, and converts quality scores 
-    to 'sanger' format
+    to 'sanger' format.  when a list of 'shard_prefixes' is given the
+    fragments are dealt round-robin into one set of FASTQ files per 
+    prefix so that each shard can be processed independently.
+
+    with 'compress' the FASTQ files are written with gzip compression.
+    'open_streams' is called with the InputStats of the first batch of
+    reads and returns an open file per shard and mate (for example a 
+    named pipe read by the aligner) that receives a copy of every read.
+    compressed input files are each decompressed with up to 'num_threads'
+    threads.  the original read names are written to a ReadNameStore
+    file, with zlib compressed blocks if 'compress_read_names' is set.
+
+    with 'collapse_duplicates' only the first fragment with each pair of
+    mate sequences is written, and the number of fragments it represents
+    is stored in a '.dups' file read by FragmentMultiplicity.  read ids
+    are assigned before collapsing so they still match the read names.
+    at most 'max_duplicates' fragment hashes are held in memory (see
+    DuplicateFilter).
+
+    'subsample' is a fraction or a number of fragments to keep, chosen
+    reproducibly using 'subsample_seed' before any other processing
+
+    read lengths, quality characters and base composition of the reads
+    are collected before trimming and written to 'stats_file' as JSON
+    (see InputStats).  processing stops with an error as soon as a
+    quality character is seen that is invalid for the 'quals' format,
+    and fails when the most common trimmed read length is shorter than
+    the minimum segment length
     """
-    # setup file iterators for input fastq files
-    infhs = [open_compressed(f) for f in fastq_files]
-    fqiters = [parse_lines(f, numlines=4) for f in infhs]
+    if shard_prefixes is None:
+        shard_prefixes = [output_prefix]
+    num_shards = len(shard_prefixes)
+    # setup batch iterators for input fastq files
+    infhs = [open_compressed(f, num_threads) for f in fastq_files]
+    fqiters = [parse_fastq_batches(f) for f in infhs]
+    if subsample is None:
+        pe_batch_iter = iter(lambda: next_pe_batches(fqiters), None)
+    else:
+        fraction, count = parse_subsample(subsample)
+        pe_batch_iter = subsample_pe_batches(fqiters, fraction=fraction,
+                                             count=count, seed=subsample_seed)
     # setup output files
-    output_files = [(output_prefix + "_%d.fq" % (x+1)) 
-                    for x in xrange(len(fastq_files))]
-    outfhs = [open(f, "w") for f in output_files]
-    read_name_file = output_prefix + ".txt"
-    read_name_fh = open(read_name_file, 'w')
-    # get quality score conversion function
-    qual_func = get_qual_conversion_func(quals)
+    suffix = ".fq.gz" if compress else ".fq"
+    shard_output_files = [[(prefix + "_%d%s" % (x+1, suffix)) 
+                           for x in xrange(len(fastq_files))]
+                          for prefix in shard_prefixes]
+    output_files = [f for files in shard_output_files for f in files]
+    open_func = open_compressed_writer if compress else (lambda f: open(f, "w"))
+    shard_outfhs = [[open_func(f) for f in files] 
+                    for files in shard_output_files]
+    read_name_file = output_prefix + ".names"
+    read_name_writer = ReadNameWriter(read_name_file, compress=compress_read_names)
+    dup_file = output_prefix + ".dups"
+    dup_filter = None
+    if collapse_duplicates:
+        dup_filter = DuplicateFilter(dup_file, max_entries=max_duplicates)
+    # get quality score conversion table
+    qual_tbl = get_qual_batch_conversion_table(quals)
+    min_qual_char = QUAL_FORMAT_MIN_CHAR[quals]
+    input_stats = InputStats(num_mates=len(fastq_files))
+    stream_fhs = None
     linenum = 1
     try:
-        while True:
-            pelines = [it.next() for it in fqiters]
-            # get read1 first line of fq record, and remove "@" symbol
-            read1_name = pelines[0][0][1:]
-            # remove whitespace and/or read number tags /1 or /2
-            read1_name = read1_name.split()[0].split("/")[0]
-            # write to read name database
-            print >>read_name_fh, read1_name
-            # convert reads
-            for i,lines in enumerate(pelines):
-                # rename read using line number
-                lines[0] = "@%d/%d" % (linenum,i+1)
-                # ignore redundant header
-                lines[2] = "+"
-                # trim read
-                total_length = len(lines[1])
-                pos3p = max(trim5+1, total_length - trim3)
-                lines[1] = lines[1][trim5:pos3p]
-                lines[3] = lines[3][trim5:pos3p]
-                # convert quality score to sanger
-                lines[3] = qual_func(lines[3])
-                print >>outfhs[i], '\n'.join(lines)
-            linenum += 1
-    except StopIteration:
-        pass
+        for batches in pe_batch_iter:
+            num_frags = len(batches[0])
+            # get read1 first line of fq record, remove "@" symbol, 
+            # whitespace and/or read number tags /1 or /2, and write 
+            # to read name database
+            read_name_writer.write_many([name[1:].split()[0].split("/")[0]
+                                         for name in batches[0].names])
+            # collect statistics of the untrimmed reads and check 
+            # that the quality scores are valid for the format
+            for i,batch in enumerate(batches):
+                input_stats.update(i, batch)
+            if (input_stats.min_qual is not None) and (input_stats.min_qual < min_qual_char):
+                logging.error("Quality character '%s' is invalid for quality "
+                              "format '%s' (reads look like '%s' format)" %
+                              (chr(input_stats.min_qual), quals, 
+                               input_stats.qual_format()))
+                raise ValueError("invalid quality scores")
+            if (open_streams is not None) and (stream_fhs is None):
+                stream_fhs = open_streams(input_stats)
+            # trim reads
+            for batch in batches:
+                batch.trim(trim5, trim3)
+            frag_ids = range(linenum, linenum + num_frags)
+            if dup_filter is not None:
+                keep = dup_filter.filter([batch.seqs for batch in batches], linenum)
+                batches = [batch.subset(keep) for batch in batches]
+                frag_ids = [frag_ids[j] for j in keep]
+            # convert quality scores to sanger
+            for batch in batches:
+                batch.convert_quals(qual_tbl)
+            # deal fragments to shards
+            for shard in xrange(num_shards):
+                if dup_filter is None:
+                    start = (shard - (linenum - 1)) % num_shards
+                    indexes = slice(start, None, num_shards)
+                else:
+                    indexes = [j for j,n in enumerate(frag_ids)
+                               if (n - 1) % num_shards == shard]
+                shard_frag_ids = take(frag_ids, indexes)
+                shard_batches = []
+                for i,batch in enumerate(batches):
+                    # rename reads using line number
+                    shard_batch = batch.subset(indexes)
+                    shard_batch.names = ["@%d/%d" % (n,i+1) for n in shard_frag_ids]
+                    shard_outfhs[shard][i].write(shard_batch.to_string())
+                    shard_batches.append(shard_batch)
+                if stream_fhs is not None:
+                    stream_pe_batches(stream_fhs[shard], shard_batches)
+            linenum += num_frags
+        # the reads must be long enough to be divided into segments
+        read_length = input_stats.trimmed_read_length(trim5, trim3)
+        if (read_length is not None) and (read_length < config.MIN_SEGMENT_LENGTH):
+            logging.error("Trimmed read length %d is less than the minimum "
+                          "length of %d" % (read_length, config.MIN_SEGMENT_LENGTH))
+            raise ValueError("reads are too short")
     except:
         logging.error("Unexpected error during FASTQ file processing")
-        for fh in outfhs:
-            fh.close()
-        read_name_fh.close()
+        for outfhs in shard_outfhs:
+            for fh in outfhs:
+                try:
+                    fh.close()
+                except IOError:
+                    pass
+        read_name_writer.abort()
+        if dup_filter is not None:
+            dup_filter.abort()
+        if (stats_file is not None) and os.path.exists(stats_file):
+            os.remove(stats_file)
         for f in output_files:
             if os.path.exists(f):
                 os.remove(f)
-        if os.path.exists(read_name_file):
-            os.remove(read_name_file)
         return config.JOB_ERROR
+    finally:
+        # stops and reaps the decompression processes on error too
+        for fh in infhs:
+            fh.close()
     # cleanup
-    for fh in infhs:
-        fh.close()
-    for fh in outfhs:
-        fh.close()
-    read_name_fh.close()
-    logging.debug("Inspected %d fragments" % (linenum))
+    for outfhs in shard_outfhs:
+        for fh in outfhs:
+            fh.close()
+    read_name_writer.close()
+    logging.debug("Inspected %d fragments" % (linenum - 1))
+    if dup_filter is not None:
+        dup_filter.close()
+        logging.debug("\tunique fragments: %d" % (dup_filter.num_unique))
+    read_lengths = input_stats.read_lengths()
+    logging.debug("\tread lengths: %s" % (', '.join(map(str, read_lengths))))
+    for i,mate_stats in enumerate(input_stats.mates):
+        logging.debug("\tmate %d N rate: %f" % (i+1, mate_stats.n_rate))
+    if len(read_lengths) > 1:
+        logging.warning("Input reads have different lengths (%d-%d); the "
+                        "most common length %d will be used to choose the "
+                        "segment length" % (read_lengths[0], read_lengths[-1], 
+                                            input_stats.modal_read_length()))
+    detected_format = input_stats.qual_format()
+    if (detected_format is not None) and (detected_format != quals):
+        logging.warning("Quality format is '%s' but the quality scores "
+                        "look like '%s' format" % (quals, detected_format))
+    if stats_file is not None:
+        input_stats.to_file(stats_file)
     return config.JOB_SUCCESS
 
 def main():
@@ -99,10 +231,12 @@ def main():
                         default="sanger")
     parser.add_argument("--trim5", dest="trim5", type=int, default=0)
     parser.add_argument("--trim3", dest="trim3", type=int, default=0)
+    parser.add_argument("--stats-file", dest="stats_file", default=None)
     parser.add_argument("output_prefix")
     parser.add_argument("fastq_files", nargs="+")    
     args = parser.parse_args()
-    process_input_reads(args.fastq_files, args.output_prefix, args.quals, args.trim5, args.trim3)
+    process_input_reads(args.fastq_files, args.output_prefix, args.quals, args.trim5, args.trim3,
+                        stats_file=args.stats_file)
 
 if __name__ == '__main__':
     main()
@@ -6,13 +6,28 @@ Created on Jun 2, 2011
 import sys
 import logging
 import argparse
+import subprocess
 
 import pysam
 
 # local imports
 from chimerascan.lib import config
+from chimerascan.lib.bam_writer import samtools_sam_to_bam_args
 
-def sam_to_bam(input_sam_file, output_bam_file):
+def sam_to_bam(input_sam_file, output_bam_file, num_threads=1):
+    """
+    converts a SAM file to BAM.  the conversion is done by samtools with
+    'num_threads' compression threads when available since the records
+    do not need to be parsed
+    """
+    args = samtools_sam_to_bam_args(input_sam_file, output_bam_file, num_threads)
+    if args is not None:
+        logging.debug("SAM to BAM converter args: %s" % (' '.join(args)))
+        retcode = subprocess.call(args)
+        if retcode != 0:
+            logging.error("samtools exited with code %d" % (retcode))
+            return config.JOB_ERROR
+        return config.JOB_SUCCESS
     samfh = pysam.Samfile(input_sam_file, "r")
     bamfh = pysam.Samfile(output_bam_file, "wb", template=samfh)
     num_frags = 0
@@ -28,10 +43,11 @@ def main():
     logging.basicConfig(level=logging.DEBUG,
                         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     parser = argparse.ArgumentParser()
+    parser.add_argument("-p", dest="num_threads", type=int, default=1)
     parser.add_argument("input_sam_file")
     parser.add_argument("output_bam_file") 
     args = parser.parse_args()
-    return sam_to_bam(args.input_sam_file, args.output_bam_file)
+    return sam_to_bam(args.input_sam_file, args.output_bam_file, args.num_threads)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,213 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+Streams processed reads to the aligners through named pipes
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import sys
+import time
+import errno
+import fcntl
+import signal
+import logging
+
+from chimerascan.lib import config
+from chimerascan.lib.input_stats import InputStats
+from chimerascan.pipeline.process_input_reads import process_input_reads
+
+# size of the write buffer of each named pipe
+FIFO_BUFFER_SIZE = 1 << 16
+# seconds to wait between attempts to open the named pipes
+FIFO_OPEN_INTERVAL = 0.1
+
+def _read_line(fd):
+    chunks = []
+    while True:
+        buf = os.read(fd, 64)
+        if not buf:
+            break
+        chunks.append(buf)
+        if '\n' in buf:
+            break
+    return ''.join(chunks)
+
+def _fork_aligner(align_func, fastq_files, num_processors, control_fd,
+                  parent_fds):
+    """
+    forks a process that waits for the trimmed read length to be sent 
+    on 'control_fd' and then calls 'align_func'.  'parent_fds' are the
+    parent's ends of the control pipes, which the child closes
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        retcode = config.JOB_ERROR
+        try:
+            for fd in parent_fds:
+                os.close(fd)
+            line = _read_line(control_fd).strip()
+            os.close(control_fd)
+            # the parent closes the pipe without a length when the
+            # reads could not be processed
+            if line:
+                read_length = None if line == "None" else int(line)
+                retcode = align_func(fastq_files, num_processors, read_length)
+        except:
+            logging.exception("Unexpected error during streaming alignment")
+        finally:
+            logging.shutdown()
+            os._exit(int(retcode) & 0xff)
+    return pid
+
+def _exit_code(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return config.JOB_ERROR
+
+def _open_fifos_for_writing(fifos, pids, exit_codes):
+    """
+    opens named pipes for writing in whatever order the readers open
+    them.  returns None if a reader exits before opening its pipe
+    """
+    fhs = [None] * len(fifos)
+    while True:
+        for i,fifo in enumerate(fifos):
+            if fhs[i] is not None:
+                continue
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # no reader has opened the pipe yet
+                if e.errno == errno.ENXIO:
+                    continue
+                raise
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            fhs[i] = os.fdopen(fd, "w", FIFO_BUFFER_SIZE)
+        if all(fh is not None for fh in fhs):
+            return fhs
+        for pid in pids:
+            if pid in exit_codes:
+                continue
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if wpid != 0:
+                exit_codes[pid] = _exit_code(status)
+        if len(exit_codes) > 0:
+            for fh in fhs:
+                if fh is not None:
+                    fh.close()
+            return None
+        time.sleep(FIFO_OPEN_INTERVAL)
+
+def stream_and_align_reads(fastq_files, output_prefix, quals, trim5, trim3,
+                           shard_prefixes, align_funcs, align_processors,
+                           compress_read_names=False, collapse_duplicates=False,
+                           max_duplicates=None, subsample=None,
+                           subsample_seed=0, stats_file=None):
+    """
+    processes the input reads as process_input_reads does while feeding
+    them to one aligner per shard through named pipes.  'align_funcs'
+    holds one function per shard that is called with the FASTQ files
+    to align, 'align_processors', and the most common trimmed read 
+    length of the first batch of reads (None when there are no reads),
+    and returns a job return code.  a gzip compressed copy of the 
+    processed reads is kept for the stages that need them later
+    """
+    num_mates = len(fastq_files)
+    shard_fifos = [[(prefix + "_%d.fifo" % (x+1)) for x in xrange(num_mates)]
+                   for prefix in shard_prefixes]
+    all_fifos = [f for fifos in shard_fifos for f in fifos]
+    for fifo in all_fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+    # the aligners wait for the read length, which is sent once the 
+    # first batch of reads has been inspected
+    control_pipes = [os.pipe() for func in align_funcs]
+    control_fds = [w for r,w in control_pipes]
+    # start the aligners before any pipe is opened for writing so that
+    # they do not inherit the write ends
+    pids = []
+    for func, fifos, (r,w) in zip(align_funcs, shard_fifos, control_pipes):
+        pids.append(_fork_aligner(func, fifos, align_processors, r, control_fds))
+        os.close(r)
+    exit_codes = {}
+    # named pipes once they are opened
+    stream_fhs = []
+    def open_streams(input_stats):
+        read_length = input_stats.trimmed_read_length(trim5, trim3)
+        while control_fds:
+            fd = control_fds.pop()
+            os.write(fd, "%s\n" % (read_length))
+            os.close(fd)
+        fhs = _open_fifos_for_writing(all_fifos, pids, exit_codes)
+        if fhs is None:
+            logging.error("Aligner exited before reading its input")
+            raise OSError("aligner exited before reading its input")
+        stream_fhs.extend(fhs[i:i+num_mates] for i in xrange(0, len(fhs), num_mates))
+        return stream_fhs
+    retcode = config.JOB_ERROR
+    try:
+        retcode = process_input_reads(fastq_files, output_prefix,
+                                      quals=quals, trim5=trim5,
+                                      trim3=trim3,
+                                      shard_prefixes=shard_prefixes,
+                                      compress=True,
+                                      open_streams=open_streams,
+                                      compress_read_names=compress_read_names,
+                                      collapse_duplicates=collapse_duplicates,
+                                      max_duplicates=max_duplicates,
+                                      subsample=subsample,
+                                      subsample_seed=subsample_seed,
+                                      stats_file=stats_file)
+        if (retcode == config.JOB_SUCCESS) and (len(stream_fhs) == 0):
+            # there were no reads, so the aligners get empty input
+            try:
+                open_streams(InputStats(num_mates))
+            except OSError:
+                retcode = config.JOB_ERROR
+        # closing the pipes signals the end of input to the aligners
+        for fhs in stream_fhs:
+            for fh in fhs:
+                try:
+                    fh.close()
+                except IOError:
+                    retcode = config.JOB_ERROR
+        if retcode != config.JOB_SUCCESS:
+            for pid in pids:
+                if pid not in exit_codes:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+        for pid in pids:
+            if pid not in exit_codes:
+                wpid, status = os.waitpid(pid, 0)
+                exit_codes[pid] = _exit_code(status)
+    finally:
+        for fd in control_fds:
+            os.close(fd)
+        for fifo in all_fifos:
+            if os.path.exists(fifo):
+                os.remove(fifo)
+    if retcode != config.JOB_SUCCESS:
+        return config.JOB_ERROR
+    if any(code != config.JOB_SUCCESS for code in exit_codes.itervalues()):
+        logging.error("Streaming alignment failed")
+        return config.JOB_ERROR
+    return config.JOB_SUCCESS
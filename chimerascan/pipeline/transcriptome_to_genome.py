@@ -3,11 +3,14 @@ Created on Jun 6, 2012
 
 @author: mkiyer
 '''
+import os
 import sys
 import logging
 import argparse
+import itertools
 import collections
 import subprocess
+import multiprocessing
 
 import pysam
 
@@ -16,8 +19,19 @@ from chimerascan.lib import config
 from chimerascan.lib.seq import DNA_reverse_complement
 from chimerascan.lib.base import check_executable, LibraryTypes
 from chimerascan.lib.feature import TranscriptFeature
+from chimerascan.lib.transcriptome import TranscriptCoordinateMap
+from chimerascan.lib.bam_writer import SortingBamWriter
 from chimerascan.lib.sam import copy_read, parse_pe_reads, \
-    group_read_pairs, pair_reads, REF_ADVANCING_CIGAR_CODES, CIGAR_N
+    group_read_pairs, pair_reads, parse_sam_line, format_sam_read, \
+    replace_tags, \
+    REF_ADVANCING_CIGAR_CODES, CIGAR_N
+
+# number of fragments sent to a converter worker at a time
+CONVERT_CHUNK_FRAGMENTS = 1000
+# number of chunks waiting for or being converted by each worker
+CONVERT_CHUNKS_PER_WORKER = 4
+# number of converted alignments remembered by AlignmentCache
+CONVERT_CACHE_SIZE = 100000
 
 def get_references_from_bowtie2_index(index):
     # extract sequence names and lengths from bowtie reference
@@ -43,6 +57,46 @@ def get_references_from_bowtie2_index(index):
         sqlist.append((seqname, seqlen))
     return sqlist
 
+def write_genome_refs(refs, filename):
+    """writes the list of (name, length) genome references to 'filename'"""
+    fh = open(filename, "w")
+    for seqname, seqlen in refs:
+        print >>fh, '\t'.join([seqname, str(seqlen)])
+    fh.close()
+
+def read_genome_refs(filename):
+    """returns the list of (name, length) genome references in 'filename'"""
+    refs = []
+    for line in open(filename):
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        seqname, seqlen = line.split('\t')
+        refs.append((seqname, int(seqlen)))
+    return refs
+
+def get_genome_refs(genome_index):
+    """
+    returns the list of (name, length) references of 'genome_index'.
+    the table written next to the index by chimerascan_index is used
+    when present, and bowtie2-inspect is run for older indexes.  returns
+    None if the references cannot be found
+    """
+    refs_file = os.path.join(os.path.dirname(genome_index), 
+                             config.GENOME_REFS_FILE)
+    if os.path.exists(refs_file):
+        return read_genome_refs(refs_file)
+    if not check_executable(config.BOWTIE2_INSPECT_BIN):
+        logging.error("Cannot find bowtie2-inspect binary")
+        return None
+    logging.debug("Reading genome references from bowtie2 index")
+    refs = get_references_from_bowtie2_index(genome_index)
+    # a tuple is returned when bowtie2-inspect fails
+    if not isinstance(refs, list):
+        logging.error("Failed to read references from bowtie2 index")
+        return None
+    return refs
+
 def reverse_complement_MD_tag(md):
     digits = []
     mdops = []
@@ -79,27 +133,28 @@ def get_read_strand(is_read2, is_reverse, negstrand, library_type):
         strand = _library_type_strand_map[rnum][library_type][is_reverse]
     return strand 
 
-def convert_pos(pos, negstrand, exons):
+def convert_pos(pos, tid, coord_map):
     """
-    find position along transcript
+    find position along transcript.  returns the genomic position, the
+    index of the exon in the arrays of 'coord_map', and the offset of
+    the position into the exon
     """
-    eindex = 0
-    testart = 0     
-    exon_size = exons[eindex][1] - exons[eindex][0]
-    while pos >= (testart + exon_size):
-        # skip to next exons
-        testart += exon_size
-        eindex += 1
-        exon_size = exons[eindex][1] - exons[eindex][0]
-    toffset = (pos - testart)
-    if negstrand:
-        newpos = exons[eindex][0] + exon_size - toffset - 1
+    eindex = coord_map.find_exon(tid, pos)
+    if eindex < 0:
+        raise IndexError("position %d is outside transcript %d" % (pos, tid))
+    toffset = (pos - coord_map.exon_offsets[eindex])
+    if coord_map.negstrand[tid]:
+        newpos = coord_map.exon_ends[eindex] - toffset - 1
     else:
-        newpos = exons[eindex][0] + toffset
-    return newpos, eindex, testart, toffset
+        newpos = coord_map.exon_starts[eindex] + toffset
+    return newpos, eindex, toffset
 
-def convert_cigar(cigar, negstrand, exons, eindex, testart, toffset):
-    exon_size = exons[eindex][1] - exons[eindex][0]    
+def convert_cigar(cigar, tid, coord_map, eindex, toffset):
+    negstrand = coord_map.negstrand[tid]
+    last_eindex = coord_map.exon_index[tid + 1] - 1
+    exon_starts = coord_map.exon_starts
+    exon_ends = coord_map.exon_ends
+    exon_size = exon_ends[eindex] - exon_starts[eindex]
     newcigar = []
     alen = 0
     spliced = False
@@ -107,25 +162,27 @@ def convert_cigar(cigar, negstrand, exons, eindex, testart, toffset):
         if cigarcode in REF_ADVANCING_CIGAR_CODES:
             # process the aligned cigar bp
             while cigarbp > (exon_size - toffset):
+                if eindex == last_eindex:
+                    raise IndexError("alignment extends past end of transcript %d" % (tid))
                 # subtract remainder of exon from cigar bp
                 cigarbp -= (exon_size - toffset)
                 # add cigar for remainder of this exon
                 newcigar.append((cigarcode, exon_size - toffset))
                 alen += (exon_size - toffset)                
                 # insert skip CIGAR operation for exon junction
-                prev_estart, prev_eend = exons[eindex]
+                prev_estart = exon_starts[eindex]
+                prev_eend = exon_ends[eindex]
                 eindex += 1
                 if negstrand:
-                    intron_size = (prev_estart - exons[eindex][1])
+                    intron_size = (prev_estart - exon_ends[eindex])
                 else:
-                    intron_size = (exons[eindex][0] - prev_eend)
+                    intron_size = (exon_starts[eindex] - prev_eend)
                 newcigar.append((CIGAR_N, intron_size))
                 alen += intron_size
                 spliced = True     
                 # advance to next exon
-                testart += exon_size
                 toffset = 0
-                exon_size = exons[eindex][1] - exons[eindex][0]     
+                exon_size = exon_ends[eindex] - exon_starts[eindex]
             # update offset into current exon
             toffset += cigarbp
             alen += cigarbp
@@ -136,42 +193,98 @@ def convert_cigar(cigar, negstrand, exons, eindex, testart, toffset):
         newcigar.reverse() 
     return newcigar, alen, spliced
 
-def convert_read(r, transcript_tid_map, library_type):
-    if r.is_unmapped:
-        # return copy of original read
-        return copy_read(r)
-    # copy and modify tags
-    tagdict = collections.OrderedDict(r.tags)
-    if 'XS' in tagdict:
-        del tagdict['XS']
-    if 'NH' in tagdict:
-        del tagdict['NH']
-    # convert transcript reference to genome
-    genome_tid, negstrand, exons = transcript_tid_map[r.tid]
+def convert_alignment(tid, pos, cigar, coord_map):
+    """
+    converts an alignment to transcript 'tid' into genomic coordinates.
+    returns a tuple with the genome tid, the leftmost genomic position,
+    the genomic cigar, the genomic end position and whether the 
+    transcript is on the negative strand
+    """
+    genome_tid = coord_map.ref_ids[tid]
+    negstrand = coord_map.negstrand[tid]
     # find genomic start position of transcript
-    newpos, eindex, testart, toffset = convert_pos(r.pos, negstrand, exons)
+    newpos, eindex, toffset = convert_pos(pos, tid, coord_map)
     # parse and convert transcript cigar string
     newcigar, alen, spliced = \
-        convert_cigar(r.cigar, negstrand, exons, 
-                      eindex, testart, toffset)            
+        convert_cigar(cigar, tid, coord_map, eindex, toffset)
     if negstrand:
         # set position to left end of transcript
-        newpos = newpos - alen + 1            
+        newpos = newpos - alen + 1
+    return genome_tid, newpos, tuple(newcigar), newpos + alen, negstrand
+
+class AlignmentCache(object):
+    """
+    converts alignments with convert_alignment() and remembers the last
+    'maxsize' results keyed by (transcript tid, pos, cigar).  alignments
+    of multimapping reads to overlapping isoforms reach the same genomic
+    alignment many times and are only converted once
+    """
+    def __init__(self, coord_map, maxsize=CONVERT_CACHE_SIZE):
+        self.coord_map = coord_map
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def convert(self, tid, pos, cigar):
+        key = (tid, pos, tuple(cigar))
+        try:
+            # reinserted below as the most recently used
+            value = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = convert_alignment(tid, pos, cigar, self.coord_map)
+            self.misses += 1
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+        self.cache[key] = value
+        return value
+
+    def convert_read(self, r):
+        """genomic alignment of read 'r', or None if it is unmapped"""
+        if r.is_unmapped:
+            return None
+        return self.convert(r.tid, r.pos, r.cigar)
+
+def genome_alignment_key(r, aln):
+    """
+    key identifying the genomic alignment 'aln' of read 'r' without 
+    creating the converted read
+    """
+    if aln is None:
+        # unmapped reads are copied unchanged
+        return (r.tid, r.pos, None)
+    return (aln[0], aln[1], aln[3])
+
+def convert_read(r, aln, library_type, num_hits):
+    """
+    returns a copy of read 'r' with its genomic alignment 'aln' from
+    AlignmentCache.convert_read() and 'num_hits' in the NH tag
+    """
+    if aln is None:
+        # return copy of original read
+        return copy_read(r, [('NH', num_hits)])
+    genome_tid, newpos, newcigar, aend, negstrand = aln
+    tags = r.tags
+    new_tags = []
+    if negstrand:
         # flip is_reverse flag
         is_reverse = (not r.is_reverse)
         # reverse complement seq and quals
         seq = DNA_reverse_complement(r.seq)
         qual = None if r.qual is None else r.qual[::-1]
         # flip MD tag
-        if 'MD' in tagdict:
-            tagdict['MD'] = reverse_complement_MD_tag(tagdict['MD'])
+        md = dict(tags).get('MD')
+        if md is not None:
+            new_tags.append(('MD', reverse_complement_MD_tag(md)))
     else:
         is_reverse = r.is_reverse
         seq = r.seq
         qual = r.qual
-    # add XS tag
+    # replace XS and NH tags
     strand = get_read_strand(r.is_read2, is_reverse, negstrand, library_type)
-    tagdict['XS'] = strand
+    new_tags.append(('XS', strand))
+    new_tags.append(('NH', num_hits))
     # create copy of read
     a = pysam.AlignedRead()
     a.qname = r.qname
@@ -186,36 +299,30 @@ def convert_read(r, transcript_tid_map, library_type):
     a.rnext = r.rnext
     a.pnext = r.pnext
     a.tlen = r.tlen
-    a.tags = tuple(tagdict.iteritems())
+    a.tags = replace_tags(tags, new_tags, ('XS', 'NH'))
     return a
 
-def convert_read_pairs(pairs, transcript_tid_map, library_type):
-    # convert pairs
+def convert_read_pairs(pairs, aln_cache, library_type):
+    # find independent alignments, skipping copies of alignments 
+    # already seen
     pairs_dict = collections.OrderedDict()
     for r1,r2 in pairs:
-        newr1 = convert_read(r1, transcript_tid_map, library_type)
-        newr2 = convert_read(r2, transcript_tid_map, library_type)
-        pair_reads(newr1, newr2)
+        aln1 = aln_cache.convert_read(r1)
+        aln2 = aln_cache.convert_read(r2)
         # key to identify independent alignments
-        k = (newr1.tid, newr1.pos, newr1.aend, 
-             newr2.tid, newr2.pos, newr2.aend)
+        k = genome_alignment_key(r1, aln1) + genome_alignment_key(r2, aln2)
         if k not in pairs_dict:
-            pairs_dict[k] = (newr1, newr2)
+            pairs_dict[k] = (r1, aln1, r2, aln2)
     # compute number of alignment hits
     num_hits = len(pairs_dict)
-    # write reads to BAM file
-    for r1,r2 in pairs_dict.itervalues():
-        tagdict1 = collections.OrderedDict(r1.tags)
-        tagdict2 = collections.OrderedDict(r2.tags)
-        # annotate multihits
-        tagdict1['NH'] = num_hits
-        tagdict2['NH'] = num_hits
-        # write
-        r1.tags = tagdict1.items() 
-        r2.tags = tagdict2.items()
-        yield r1,r2
-
-def convert_unpaired_reads(pe_reads, transcript_tid_map, library_type):
+    # convert reads and annotate multihits
+    for r1,aln1,r2,aln2 in pairs_dict.itervalues():
+        newr1 = convert_read(r1, aln1, library_type, num_hits)
+        newr2 = convert_read(r2, aln2, library_type, num_hits)
+        pair_reads(newr1, newr2)
+        yield newr1, newr2
+
+def convert_unpaired_reads(pe_reads, aln_cache, library_type):
     # convert unpaired reads
     unpaired_reads_dict = (collections.OrderedDict(),
                            collections.OrderedDict())
@@ -223,34 +330,58 @@ def convert_unpaired_reads(pe_reads, transcript_tid_map, library_type):
     mate_num_hits = [0, 0]
     for rnum,reads in enumerate(pe_reads):
         for r in reads:
-            newr = convert_read(r, transcript_tid_map, library_type)
+            aln = aln_cache.convert_read(r)
             # key to identify independent alignments
-            k = (newr.tid, newr.pos, newr.aend)
+            k = genome_alignment_key(r, aln)
             if k not in unpaired_reads_dict[rnum]:
-                unpaired_reads_dict[rnum][k] = newr
+                unpaired_reads_dict[rnum][k] = (r, aln)
                 if not r.is_unmapped:
                     mate_num_hits[rnum] += 1
-    # compute number of alignment hits
+    # convert reads and annotate multihits
     for rnum,reads_dict in enumerate(unpaired_reads_dict):                
-        for r in reads_dict.itervalues():
-            tagdict = collections.OrderedDict(r.tags)
-            # annotate multihits
-            tagdict['NH'] = mate_num_hits[rnum]
-            # annotate multihits
-            r.tags = tuple(tagdict.iteritems())
-            yield r
-
-def _setup_and_open_files(genome_index, transcripts,
-                          input_file, output_file, 
-                          library_type, input_sam, 
-                          output_sam):
+        for r,aln in reads_dict.itervalues():
+            yield convert_read(r, aln, library_type, mate_num_hits[rnum])
+
+def convert_fragment(pe_reads, aln_cache, library_type):
+    """
+    converts the alignments of one fragment using the AlignmentCache
+    'aln_cache'.  returns a tuple with the list of converted reads and
+    whether the fragment was paired
+    """
+    pairs, unpaired_reads = group_read_pairs(pe_reads)
+    reads = []
+    if len(pairs) > 0:
+        # convert pairs
+        for r1,r2 in convert_read_pairs(pairs, aln_cache, library_type):
+            reads.append(r1)
+            reads.append(r2)
+        return reads, True
+    reads.extend(convert_unpaired_reads(unpaired_reads, aln_cache,
+                                        library_type))
+    return reads, False
+
+def build_transcript_tid_map(transcripts, transcriptome_rname_tid_map,
+                             genome_rname_tid_map):
+    """
+    returns a TranscriptCoordinateMap from transcriptome tids to
+    genome tids and coordinates
+    """
+    logging.debug("Creating transcript to genome map")
+    return TranscriptCoordinateMap.build(transcripts, 
+                                         transcriptome_rname_tid_map,
+                                         genome_rname_tid_map)
+
+def _get_genome_refs(genome_index, genome_refs=None):
     # create SAM header from genome index
     logging.debug("Creating genome SAM header")
-    if not check_executable(config.BOWTIE2_INSPECT_BIN):
-        logging.error("Cannot find bowtie2-inspect binary")
-        return config.JOB_ERROR
-    # get references/lengths from bowtie2
-    ref_list = get_references_from_bowtie2_index(genome_index)
+    if genome_refs is not None:
+        return genome_refs
+    return get_genome_refs(genome_index)
+
+def _setup_and_open_files(ref_list, transcripts,
+                          input_file, output_file, 
+                          input_sam, output_sam,
+                          sort_buffer_size=None, tmp_dir=None):
     # open input BAM file and add to header
     if input_sam:
         mode = "r"
@@ -261,59 +392,200 @@ def _setup_and_open_files(genome_index, transcripts,
     header_dict['SQ'] = [{'SN': seqname, 'LN': seqlen} for seqname,seqlen in ref_list]
     # open output BAM file with new header
     if output_sam:
-        mode = "wh"
+        outfh = pysam.Samfile(output_file, "wh", header=header_dict)
+    elif sort_buffer_size is not None:
+        outfh = SortingBamWriter(output_file, header_dict, 
+                                 sort_buffer_size, tmp_dir)
     else:
-        mode = "wb"
-    outfh = pysam.Samfile(output_file, mode, header=header_dict)
+        outfh = pysam.Samfile(output_file, "wb", header=header_dict)
     # setup reference name mappings
-    genome_rname_tid_map = dict((rname,i) for i,rname in enumerate(outfh.references))    
+    genome_rname_tid_map = dict((rname,i) for i,(rname,rlen) in enumerate(ref_list))
     transcriptome_rname_tid_map = dict((rname,i) for i,rname in enumerate(infh.references))
     # read transcript feature and prepare data structure for conversion
-    logging.debug("Creating transcript to genome map")
-    transcript_tid_map = {}
-    for t in transcripts:
-        exons = [(start, end) for start, end in t.exons]
-        negstrand = True if t.strand == "-" else False
-        if negstrand:
-            exons.reverse()
-        transcript_tid = transcriptome_rname_tid_map[str(t.tx_id)]
-        genome_tid = genome_rname_tid_map[t.chrom]
-        transcript_tid_map[transcript_tid] = (genome_tid, negstrand, exons)        
+    transcript_tid_map = build_transcript_tid_map(transcripts,
+                                                  transcriptome_rname_tid_map,
+                                                  genome_rname_tid_map)
     return infh, outfh, transcript_tid_map
 
+# state of each converter worker process, set by _init_convert_worker
+_worker_state = None
+
+def _init_convert_worker(transcript_tid_map, library_type, 
+                         transcriptome_rname_tid_map, genome_references):
+    global _worker_state
+    _worker_state = (AlignmentCache(transcript_tid_map), library_type,
+                     transcriptome_rname_tid_map, genome_references)
+
+def _convert_sam_chunk(lines):
+    """
+    converts SAM text lines holding complete fragments and returns a 
+    tuple with the converted SAM text and the numbers of paired and 
+    unpaired fragments
+    """
+    aln_cache, library_type, rname_tid_map, references = _worker_state
+    # original text of the tags so that unchanged tags are written 
+    # exactly as they were read
+    tag_fields = {}
+    reads = (parse_sam_line(line, rname_tid_map, tag_fields) for line in lines)
+    output = []
+    num_paired_frags = 0
+    num_unpaired_frags = 0
+    for pe_reads in parse_pe_reads(reads):
+        newreads, paired = convert_fragment(pe_reads, aln_cache,
+                                            library_type)
+        if paired:
+            num_paired_frags += 1
+        else:
+            num_unpaired_frags += 1
+        for r in newreads:
+            output.append(format_sam_read(r, references, tag_fields))
+            output.append('\n')
+    return ''.join(output), num_paired_frags, num_unpaired_frags
+
+def _iter_sam_chunks(line_iter, chunk_size):
+    """
+    generator of lists of SAM lines holding 'chunk_size' fragments.
+    the lines of a fragment (same qname) are never split across chunks
+    """
+    chunk = []
+    num_frags = 0
+    prev_qname = None
+    for line in line_iter:
+        qname = line[:line.find('\t')]
+        if qname != prev_qname:
+            if num_frags == chunk_size:
+                yield chunk
+                chunk = []
+                num_frags = 0
+            num_frags += 1
+            prev_qname = qname
+        chunk.append(line)
+    if len(chunk) > 0:
+        yield chunk
+
+def _transcriptome_to_genome_parallel(transcripts, infh, outfh, ref_list,
+                                      library_type, num_workers):
+    """
+    converts SAM text from 'infh' to 'outfh' with a pool of worker
+    processes.  chunks of complete fragments are handed to the workers
+    and the results are written in the original order, with a bounded
+    number of chunks in flight so that memory use stays constant
+    """
+    # parse the SAM header of the transcriptome alignments
+    header_lines = []
+    transcriptome_rnames = []
+    line = infh.readline()
+    while line.startswith('@'):
+        if line.startswith('@SQ'):
+            for field in line.rstrip('\n').split('\t')[1:]:
+                if field.startswith('SN:'):
+                    transcriptome_rnames.append(field[3:])
+        else:
+            header_lines.append(line)
+        line = infh.readline()
+    # write the header with the genome references after the @HD line
+    hd_lines = [x for x in header_lines if x.startswith('@HD')]
+    other_lines = [x for x in header_lines if not x.startswith('@HD')]
+    outfh.writelines(hd_lines)
+    outfh.writelines('@SQ\tSN:%s\tLN:%d\n' % (seqname, seqlen) 
+                     for seqname,seqlen in ref_list)
+    outfh.writelines(other_lines)
+    references = [seqname for seqname,seqlen in ref_list]
+    genome_rname_tid_map = dict((rname,i) for i,rname in enumerate(references))
+    transcriptome_rname_tid_map = dict((rname,i) for i,rname in enumerate(transcriptome_rnames))
+    transcript_tid_map = build_transcript_tid_map(transcripts,
+                                                  transcriptome_rname_tid_map,
+                                                  genome_rname_tid_map)
+    # convert chunks in worker processes
+    logging.debug("Converting transcriptome to genome SAM with %d workers" % 
+                  (num_workers))
+    pool = multiprocessing.Pool(num_workers, _init_convert_worker,
+                                (transcript_tid_map, library_type,
+                                 transcriptome_rname_tid_map, references))
+    num_paired_frags = 0
+    num_unpaired_frags = 0
+    pending = collections.deque()
+    def write_result(result):
+        text, paired, unpaired = result.get()
+        outfh.write(text)
+        return paired, unpaired
+    try:
+        lines = itertools.chain([line], infh) if line else infh
+        for chunk in _iter_sam_chunks(lines, CONVERT_CHUNK_FRAGMENTS):
+            pending.append(pool.apply_async(_convert_sam_chunk, (chunk,)))
+            if len(pending) >= num_workers * CONVERT_CHUNKS_PER_WORKER:
+                paired, unpaired = write_result(pending.popleft())
+                num_paired_frags += paired
+                num_unpaired_frags += unpaired
+        while len(pending) > 0:
+            paired, unpaired = write_result(pending.popleft())
+            num_paired_frags += paired
+            num_unpaired_frags += unpaired
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return num_paired_frags, num_unpaired_frags
+
 def transcriptome_to_genome(genome_index,
                             transcripts, 
                             input_file, 
                             output_file,
                             library_type,
                             input_sam,
-                            output_sam):
+                            output_sam,
+                            genome_refs=None,
+                            num_workers=1,
+                            sort_buffer_size=None,
+                            tmp_dir=None):
+    """
+    converts transcriptome alignments to genomic coordinates.  the list
+    of (name, length) genome references is read from the index (see
+    get_genome_refs) unless 'genome_refs' is provided.  SAM input can be converted to 
+    SAM output by 'num_workers' processes.  BAM output is sorted by 
+    position when 'sort_buffer_size' is given, holding that many reads 
+    in memory at a time and spilling the rest to temporary files in 
+    'tmp_dir' (see SortingBamWriter)
+    """
+    ref_list = _get_genome_refs(genome_index, genome_refs)
+    if ref_list is None:
+        return config.JOB_ERROR
+    if (num_workers > 1) and input_sam and output_sam:
+        infh = sys.stdin if input_file == "-" else open(input_file)
+        outfh = sys.stdout if output_file == "-" else open(output_file, "w")
+        num_paired_frags, num_unpaired_frags = \
+            _transcriptome_to_genome_parallel(transcripts, infh, outfh,
+                                              ref_list, library_type,
+                                              num_workers)
+        logging.debug("Paired fragments: %d" % (num_paired_frags))
+        logging.debug("Unpaired fragments: %d" % (num_unpaired_frags))
+        outfh.close()
+        infh.close()
+        return config.JOB_SUCCESS
     # setup and open files
     infh, outfh, transcript_tid_map = \
-        _setup_and_open_files(genome_index, transcripts,
-                              input_file, output_file, library_type,
-                              input_sam, output_sam)
+        _setup_and_open_files(ref_list, transcripts,
+                              input_file, output_file, 
+                              input_sam, output_sam, 
+                              sort_buffer_size, tmp_dir)
     # now convert BAM reads
     logging.debug("Converting transcriptome to genome BAM")
+    aln_cache = AlignmentCache(transcript_tid_map)
     num_paired_frags = 0
     num_unpaired_frags = 0
     for pe_reads in parse_pe_reads(infh):
-        pairs, unpaired_reads = group_read_pairs(pe_reads)
-        if len(pairs) > 0:
+        reads, paired = convert_fragment(pe_reads, aln_cache, library_type)
+        if paired:
             num_paired_frags += 1
-            # convert pairs
-            for r1,r2 in convert_read_pairs(pairs, transcript_tid_map, 
-                                            library_type):
-                outfh.write(r1)
-                outfh.write(r2)
         else:
             num_unpaired_frags += 1
-            for r in convert_unpaired_reads(unpaired_reads, 
-                                            transcript_tid_map, 
-                                            library_type):
-                outfh.write(r)
+        for r in reads:
+            outfh.write(r)
     logging.debug("Paired fragments: %d" % (num_paired_frags))
     logging.debug("Unpaired fragments: %d" % (num_unpaired_frags))
+    logging.debug("Alignments converted: %d (%d repeated)" % 
+                  (aln_cache.misses, aln_cache.hits))
     outfh.close()
     infh.close()
     return config.JOB_SUCCESS
@@ -328,6 +600,10 @@ def main():
                         default=False)
     parser.add_argument("--output-sam", dest="output_sam", action="store_true", 
                         default=False)
+    parser.add_argument("--workers", dest="num_workers", type=int, default=1)
+    parser.add_argument("--sort-buffer-size", dest="sort_buffer_size", 
+                        type=int, default=None)
+    parser.add_argument("--tmp-dir", dest="tmp_dir", default=None)
     parser.add_argument("genome_index")
     parser.add_argument("transcript_feature_file")
     parser.add_argument("input_sam_file")
@@ -342,7 +618,10 @@ def main():
                                    args.output_sam_file,
                                    args.library_type,
                                    args.input_sam,
-                                   args.output_sam)
+                                   args.output_sam,
+                                   num_workers=args.num_workers,
+                                   sort_buffer_size=args.sort_buffer_size,
+                                   tmp_dir=args.tmp_dir)
 
 if __name__ == '__main__':
     sys.exit(main())
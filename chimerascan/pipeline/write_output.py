@@ -33,6 +33,8 @@ from chimerascan.lib import config
 from chimerascan.lib.chimera import Chimera, \
     parse_discordant_cluster_pair_file, get_chimera_type
 from chimerascan.lib.feature import TranscriptFeature
+from chimerascan.lib.read_names import ReadNameStore
+from chimerascan.lib.duplicates import FragmentMultiplicity, count_fragments
 
 def build_genome_transcript_trees(transcripts):
     genome_tx_trees = collections.defaultdict(lambda: IntervalTree())    
@@ -78,7 +80,8 @@ def make_chimera(cluster_pair,
                  cluster_shelve,
                  transcript_dict,
                  genome_tx_trees,
-                 annotation_source):
+                 annotation_source,
+                 multiplicity=None):
     # lookup 5' and 3' clusters
     cluster5p = cluster_shelve[str(cluster_pair.id5p)]
     cluster3p = cluster_shelve[str(cluster_pair.id3p)]
@@ -103,15 +106,15 @@ def make_chimera(cluster_pair,
     c.chimera_id = "CHIMERA%d" % (cluster_pair.pair_id)
     frags = set(cluster_pair.qnames)
     frags.update(cluster_pair.spanning_qnames)
-    c.num_frags = len(frags)
+    c.num_frags = count_fragments(frags, multiplicity)
     c.strand5p = cluster5p.strand
     c.strand3p = cluster3p.strand
     c.chimera_type = chimera_type
     c.distance = distance
-    c.num_discordant_frags = len(cluster_pair.qnames)
-    c.num_spanning_frags = len(cluster_pair.spanning_qnames)
-    c.num_discordant_frags_5p = len(cluster5p.qnames)
-    c.num_discordant_frags_3p = len(cluster3p.qnames)
+    c.num_discordant_frags = count_fragments(cluster_pair.qnames, multiplicity)
+    c.num_spanning_frags = count_fragments(cluster_pair.spanning_qnames, multiplicity)
+    c.num_discordant_frags_5p = count_fragments(cluster5p.qnames, multiplicity)
+    c.num_discordant_frags_3p = count_fragments(cluster3p.qnames, multiplicity)
     c.num_concordant_frags_5p = cluster5p.concordant_frags
     c.num_concordant_frags_3p = cluster3p.concordant_frags
     c.biotypes_5p = sorted(biotypes_5p)
@@ -122,25 +125,66 @@ def make_chimera(cluster_pair,
     c.transcripts_3p = sorted(tx_names_3p)
     return c
 
+def write_chimera_reads(c, cluster_pair, read_names, fh):
+    """
+    writes the original names of the discordant and spanning reads 
+    of chimera 'c', looked up by read id in the ReadNameStore 
+    'read_names'
+    """
+    fields = [c.chimera_id]
+    for qnames in (cluster_pair.qnames, cluster_pair.spanning_qnames):
+        read_ids = sorted(set(int(qname) for qname in qnames if qname))
+        names = [read_names.get(read_id) for read_id in read_ids]
+        fields.append(','.join(names) if names else 'na')
+    print >>fh, '\t'.join(fields)
+
 def write_output(transcripts, cluster_shelve_file, cluster_pair_file, 
                  read_name_file, output_file, 
-                 annotation_source="ensembl"):
+                 annotation_source="ensembl",
+                 genome_transcript_trees=None,
+                 multiplicity_file=None,
+                 chimera_reads_file=None):
+    """
+    writes the chimeras to 'output_file'.  when 'chimera_reads_file' is
+    given the original names of the discordant and spanning reads of 
+    each chimera are written to it, one chimera per line
+    """
     # load cluster and read name database files
     cluster_shelve = shelve.open(cluster_shelve_file, 'r')
-    read_name_fh = open(read_name_file, 'r')   
-    # map genome coordinates to transcripts
-    logging.debug("Creating mapping between genome coordinates and transcripts")
-    transcript_dict, genome_tx_trees = build_genome_transcript_trees(transcripts)
+    read_names = None
+    reads_fh = None
+    if chimera_reads_file is not None:
+        read_names = ReadNameStore(read_name_file)
+        reads_fh = open(chimera_reads_file, "w")
+        print >>reads_fh, '#' + '\t'.join(('chimera_id', 'discordant_reads', 
+                                            'spanning_reads'))
+    # fragment counts include the collapsed duplicates
+    multiplicity = None
+    if multiplicity_file is not None:
+        multiplicity = FragmentMultiplicity(multiplicity_file)
+    # map genome coordinates to transcripts unless the mapping
+    # was built in advance by the caller
+    if genome_transcript_trees is None:
+        logging.debug("Creating mapping between genome coordinates and transcripts")
+        genome_transcript_trees = build_genome_transcript_trees(transcripts)
+    transcript_dict, genome_tx_trees = genome_transcript_trees
     logging.debug("Writing output")
     outfh = open(output_file, "w")
     print >>outfh, '#' + '\t'.join(Chimera._fields)
     for cluster_pair in parse_discordant_cluster_pair_file(open(cluster_pair_file)):
         c = make_chimera(cluster_pair, cluster_shelve, transcript_dict, 
-                         genome_tx_trees, annotation_source)
+                         genome_tx_trees, annotation_source, 
+                         multiplicity)
         print >>outfh, str(c)
+        if reads_fh is not None:
+            write_chimera_reads(c, cluster_pair, read_names, reads_fh)
     # cleanup
     outfh.close()
-    read_name_fh.close()
+    if reads_fh is not None:
+        reads_fh.close()
+        read_names.close()
+    if multiplicity is not None:
+        multiplicity.close()
     cluster_shelve.close()
     return config.JOB_SUCCESS
 
@@ -149,6 +193,10 @@ def main():
                         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     parser = argparse.ArgumentParser()
     parser.add_argument("--ann", dest="annotation_source", default="ensembl")
+    parser.add_argument("--multiplicity-file", dest="multiplicity_file",
+                        default=None)
+    parser.add_argument("--chimera-reads-file", dest="chimera_reads_file",
+                        default=None)
     parser.add_argument("transcript_file")
     parser.add_argument("cluster_shelve_file")
     parser.add_argument("cluster_pair_file")
@@ -161,7 +209,9 @@ def main():
     # run main function
     retcode = write_output(transcripts, args.cluster_shelve_file, 
                            args.cluster_pair_file, args.read_name_file, 
-                           args.output_file, args.annotation_source)
+                           args.output_file, args.annotation_source,
+                           multiplicity_file=args.multiplicity_file,
+                           chimera_reads_file=args.chimera_reads_file)
     return retcode
 
 if __name__ == "__main__":
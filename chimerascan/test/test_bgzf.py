@@ -0,0 +1,83 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from chimerascan.lib.bgzf import iter_bam_read_names
+
+def bgzf_block(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    bsize = 12 + 6 + len(cdata) + 8 - 1
+    header = struct.pack("<BBBBIBBH", 31, 139, 8, 4, 0, 0, 255, 6)
+    extra = struct.pack("<BBHH", 66, 67, 2, bsize)
+    trailer = struct.pack("<Ii", zlib.crc32(data) & 0xffffffff, len(data))
+    return header + extra + cdata + trailer
+
+def bam_record(qname):
+    core = struct.pack("<iiBBHHHiiii", -1, -1, len(qname) + 1, 0, 4680,
+                       0, 4, 0, -1, -1, 0)
+    data = core + qname + "\0"
+    return struct.pack("<i", len(data)) + data
+
+class TestBGZF(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bam_file = os.path.join(self.tmp_dir, "reads.bam")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testReadNameOffsets(self):
+        text = "@HD\tVN:1.0\n"
+        header = "BAM\1" + struct.pack("<i", len(text)) + text + \
+            struct.pack("<i", 1) + struct.pack("<i", 4) + "chr\0" + \
+            struct.pack("<i", 1000)
+        qnames = ["read%d" % (i) for i in xrange(50)]
+        data = header
+        starts = []
+        for qname in qnames:
+            starts.append(len(data))
+            data += bam_record(qname)
+        # blocks of uneven size so that records span blocks, followed
+        # by an empty end of file block
+        block_size = 97
+        blocks = [data[i:i+block_size] for i in xrange(0, len(data), block_size)]
+        blocks.append("")
+        fh = open(self.bam_file, "wb")
+        coffsets = []
+        for block in blocks:
+            coffsets.append(fh.tell())
+            fh.write(bgzf_block(block))
+        fh.close()
+        expected = [((coffsets[s // block_size] << 16) | (s % block_size), qname)
+                    for s, qname in zip(starts, qnames)]
+        self.assertEqual(list(iter_bam_read_names(self.bam_file)), expected)
+
+    def testNotBAM(self):
+        fh = open(self.bam_file, "wb")
+        fh.write(bgzf_block("SAM\1"))
+        fh.close()
+        self.assertRaises(ValueError, list, iter_bam_read_names(self.bam_file))
+
+if __name__ == "__main__":
+    unittest.main()
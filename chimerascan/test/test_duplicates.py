@@ -0,0 +1,63 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from chimerascan.lib.duplicates import DuplicateFilter, FragmentMultiplicity
+
+class TestDuplicateFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dup_file = os.path.join(self.tmp_dir, "reads.dups")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _filter(self, batches, max_entries=None):
+        dup_filter = DuplicateFilter(self.dup_file, max_entries=max_entries)
+        keep = []
+        read_id = 1
+        for seqs1, seqs2 in batches:
+            keep.append(dup_filter.filter([seqs1, seqs2], read_id))
+            read_id += len(seqs1)
+        dup_filter.close()
+        multiplicity = FragmentMultiplicity(self.dup_file)
+        counts = [multiplicity.get(i+1) for i in xrange(multiplicity.num_fragments)]
+        multiplicity.close()
+        return keep, counts
+
+    def testCollapse(self):
+        batches = [(["A", "C", "A"], ["G", "G", "G"]),
+                   (["A", "C", "T"], ["G", "T", "G"])]
+        keep, counts = self._filter(batches)
+        self.assertEqual(keep, [[0, 1], [1, 2]])
+        self.assertEqual(counts, [3, 1, 0, 0, 1, 1])
+
+    def testBoundedTable(self):
+        # only the first two sequences are remembered, so later copies
+        # of the third are kept and each counts once
+        batches = [(["A", "C", "T", "A", "T", "C"], ["G"] * 6)]
+        keep, counts = self._filter(batches, max_entries=2)
+        self.assertEqual(keep, [[0, 1, 2, 4]])
+        self.assertEqual(counts, [2, 2, 1, 0, 1, 0])
+        self.assertEqual(sum(counts), 6)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from chimerascan.lib import config
+from chimerascan.lib.scheduler import Stage, StageScheduler
+from chimerascan.lib.stage_cache import StageCache
+
+class TestReleasedIntermediates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmp_dir, "log.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def _stage(self, name, inputs, output, params=None):
+        def func(num_processors):
+            data = ''.join(open(f).read() for f in inputs)
+            with open(output, "w") as f:
+                f.write(data + name)
+            with open(self.log_file, "a") as f:
+                f.write(name + "\n")
+            return config.JOB_SUCCESS
+        return Stage(name, name, func, inputs=inputs, outputs=[output],
+                     params=params)
+
+    def _run(self, c_params=None):
+        """
+        runs the chain a -> b -> c where the output of 'b' is released
+        and returns the names of the stages that ran
+        """
+        if os.path.exists(self.log_file):
+            os.remove(self.log_file)
+        a_file, b_file, c_file = [self._path(x) for x in ("a.txt", "b.txt", "c.txt")]
+        stages = [self._stage("a", [], a_file),
+                  self._stage("b", [a_file], b_file),
+                  self._stage("c", [b_file], c_file, params=c_params)]
+        cache = StageCache(self._path("manifests"), base_dir=self.tmp_dir)
+        scheduler = StageScheduler(stages, 1, cache=cache,
+                                   release_files=[b_file])
+        self.assertEqual(scheduler.run(), config.JOB_SUCCESS)
+        self.assertFalse(os.path.exists(b_file))
+        if not os.path.exists(self.log_file):
+            return []
+        return open(self.log_file).read().split()
+
+    def testResumeSkipsProducer(self):
+        self.assertEqual(self._run(), ["a", "b", "c"])
+        self.assertEqual(self._run(), [])
+
+    def testStaleConsumerRerunsProducer(self):
+        self.assertEqual(self._run(), ["a", "b", "c"])
+        self.assertEqual(self._run(c_params={'x': 1}), ["b", "c"])
+        self.assertEqual(open(self._path("c.txt")).read(), "abc")
+        self.assertEqual(self._run(c_params={'x': 1}), [])
+
+if __name__ == "__main__":
+    unittest.main()
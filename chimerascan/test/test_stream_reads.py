@@ -0,0 +1,96 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from chimerascan.lib import config
+from chimerascan.lib.fastq import FASTQ_BATCH_SIZE
+from chimerascan.pipeline.stream_reads import stream_and_align_reads
+
+def _write_fastq(filename, num_frags, mate, read_length=100):
+    seq = ("ACGT" * read_length)[:read_length]
+    qual = ("#5?I" * read_length)[:read_length]
+    with open(filename, "w") as f:
+        for i in xrange(num_frags):
+            f.write("@read%d/%d\n%s\n+\n%s\n" % (i, mate, seq, qual))
+
+def _lockstep_aligner(count_file):
+    """
+    returns an align function that reads the mates one record at a
+    time in turn, as a paired aligner does
+    """
+    def align(fastq_files, num_processors, read_length):
+        fhs = [open(f) for f in fastq_files]
+        num_frags = 0
+        while True:
+            records = [[fh.readline() for x in xrange(4)] for fh in fhs]
+            if not records[0][0]:
+                break
+            names = [r[0].strip() for r in records]
+            if names != ["@%s/%d" % (names[0][1:-2], i+1) for i in xrange(len(fhs))]:
+                return config.JOB_ERROR
+            num_frags += 1
+        with open(count_file, "w") as f:
+            f.write("%d %s\n" % (num_frags, read_length))
+        return config.JOB_SUCCESS
+    return align
+
+class TestStreamReads(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _stream(self, num_frags, num_shards):
+        fastq_files = [os.path.join(self.tmp_dir, "input_%d.fq" % (i+1))
+                       for i in xrange(2)]
+        for i,f in enumerate(fastq_files):
+            _write_fastq(f, num_frags, i+1)
+        shard_prefixes = [os.path.join(self.tmp_dir, "shard%d" % (x+1))
+                          for x in xrange(num_shards)]
+        count_files = [prefix + ".count" for prefix in shard_prefixes]
+        align_funcs = [_lockstep_aligner(f) for f in count_files]
+        retcode = stream_and_align_reads(fastq_files,
+                                         os.path.join(self.tmp_dir, "reads"),
+                                         quals="sanger", trim5=4, trim3=6,
+                                         shard_prefixes=shard_prefixes,
+                                         align_funcs=align_funcs,
+                                         align_processors=1)
+        self.assertEqual(retcode, config.JOB_SUCCESS)
+        results = [open(f).read().split() for f in count_files]
+        self.assertEqual([int(read_length) for n,read_length in results], 
+                         [90] * num_shards)
+        return [int(n) for n,read_length in results]
+
+    def testSingleBatch(self):
+        self.assertEqual(self._stream(100, 1), [100])
+
+    def testManyBatches(self):
+        num_frags = 2 * FASTQ_BATCH_SIZE + 100
+        self.assertEqual(self._stream(num_frags, 1), [num_frags])
+
+    def testManyBatchesSharded(self):
+        num_frags = 2 * FASTQ_BATCH_SIZE + 101
+        counts = self._stream(num_frags, 2)
+        self.assertEqual(counts, [num_frags // 2 + 1, num_frags // 2])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+'''
+chimerascan: chimeric transcript discovery using RNA-seq
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+# one transcript on each strand of chr1
+TRANSCRIPTS = ["chr1\t1000\t1200\t0\t0\t+\t1\t1000,\t1200,\tprotein_coding\tT0,\tG0,\tref,",
+               "chr1\t2000\t2300\t1\t1\t-\t2\t2000,2200,\t2100,2300,\tprotein_coding\tT1,\tG1,\tref,"]
+
+SAM_HEADER = ["@HD\tVN:1.0\tSO:unsorted",
+              "@SQ\tSN:0\tLN:200",
+              "@SQ\tSN:1\tLN:200"]
+
+SAM_READS = ["frag1\t99\t0\t11\t255\t10M\t=\t51\t50\tACGTACGTAC\tIIIIIIIIII\tAS:i:0\tXS:i:-5\tNM:i:0\tMD:Z:10\tXA:A:x\tYS:Z:abc\tZF:f:0.5",
+             "frag1\t147\t0\t51\t255\t10M\t=\t11\t-50\tGTACGTACGT\tIIIIIIIIII\tAS:i:-2\tNM:i:1\tMD:Z:4A5",
+             "frag2\t99\t1\t91\t255\t20M\t=\t131\t50\tACGTACGTACGTACGTACGT\tIIIIIIIIIIIIIIIIIIII\tNM:i:1\tMD:Z:0C19\tYS:Z:abc",
+             "frag2\t147\t1\t131\t255\t10M\t=\t91\t-50\tGTACGTACGT\tIIIIIIIIII\tNM:i:0\tMD:Z:10",
+             "frag3\t77\t*\t0\t0\t*\t*\t0\t0\tACGTACGTAC\tIIIIIIIIII\tYT:Z:UP",
+             "frag3\t141\t*\t0\t0\t*\t*\t0\t0\tGTACGTACGT\tIIIIIIIIII\tYT:Z:UP"]
+
+GENOME_REFS = [("chr1", 10000)]
+
+@unittest.skipIf(pysam is None, "pysam is not installed")
+class TestTranscriptomeToGenome(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.tmp_dir, "transcriptome.sam")
+        fh = open(self.input_file, "w")
+        fh.write('\n'.join(SAM_HEADER + SAM_READS) + '\n')
+        fh.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _convert(self, num_workers):
+        from chimerascan.lib.base import LibraryTypes
+        from chimerascan.lib.feature import TranscriptFeature
+        from chimerascan.pipeline.transcriptome_to_genome import transcriptome_to_genome
+        transcripts = [TranscriptFeature.from_string(line) for line in TRANSCRIPTS]
+        output_file = os.path.join(self.tmp_dir, "genome%d.sam" % (num_workers))
+        transcriptome_to_genome(None, transcripts, self.input_file,
+                                output_file, LibraryTypes.FR_UNSTRANDED,
+                                input_sam=True, output_sam=True,
+                                genome_refs=GENOME_REFS,
+                                num_workers=num_workers)
+        return [line for line in open(output_file) if not line.startswith('@')]
+
+    def testWorkersMatchSerial(self):
+        serial_lines = self._convert(1)
+        self.assertEqual(len(serial_lines), len(SAM_READS))
+        self.assertEqual(self._convert(2), serial_lines)
+
+    def testTagTypes(self):
+        from chimerascan.lib.sam import parse_sam_line, format_sam_read
+        line = "frag1\t99\t0\t11\t255\t10M\t=\t51\t50\tACGTACGTAC\tIIIIIIIIII\tXF:f:0.123456789\tXH:H:1AE3\tXA:A:x\tYS:Z:y\tNM:i:0"
+        tag_fields = {}
+        r = parse_sam_line(line, {"0": 0}, tag_fields)
+        self.assertEqual(format_sam_read(r, ["0"], tag_fields), line)
+        # new tags are typed by their values
+        r.tags = r.tags + [("XS", "+")]
+        self.assertTrue(format_sam_read(r, ["0"], tag_fields).endswith("\tXS:A:+"))
+
+if __name__ == "__main__":
+    unittest.main()
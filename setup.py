@@ -30,6 +30,7 @@ setup_kwargs = {"name": "chimerascan",
                 "package_data": {'chimerascan.tools': ['table_template.html']},                             
                 "scripts": ["chimerascan/chimerascan_run.py",
                             "chimerascan/chimerascan_index.py",
+                            "chimerascan/chimerascan_batch.py",
                             "chimerascan/tools/chimerascan_html_table.py",
                             "chimerascan/tools/chimerascan_build_annotation.py"]}
 